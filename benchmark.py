@@ -0,0 +1,486 @@
+"""
+Micro benchmarks on a real document, run with
+
+    python -m python_sketch_api.benchmark [path/to/file.sketch]
+"""
+import io
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+import numpy as np
+
+from . import sketch_api
+from . import sketch_decoders
+from . import sketch_io
+from . import sketch_stream
+from . import sketch_text
+from . import sketch_zip
+
+DEFAULT_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'Icons.sketch')
+
+
+def _best_of(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def _read_json_entries(path):
+    with zipfile.ZipFile(path, mode='r') as f:
+        return {n: json.loads(f.read(n)) for n in f.namelist() if n.endswith('.json')}
+
+
+def bench_decode(path=DEFAULT_FILE, repeat=5):
+    """Compares the generic schema interpreter of SketchToPy with the generated per-class decoders."""
+    contents = _read_json_entries(path)
+    pages = {n: v for n, v in contents.items() if n.startswith('pages/')}
+
+    t = time.perf_counter()
+    engine = sketch_decoders.DecoderEngine(sketch_io.SketchToPy()._schema)
+    build = time.perf_counter() - t
+
+    def generic():
+        parser = sketch_io.SketchToPy()
+        ft = parser._schema.field_type_for(sketch_io.sketch_types.SketchPage)
+        for n, v in pages.items():
+            parser._decode(ft, v, p=n)
+
+    def specialized():
+        parser = sketch_io.SketchToPy()
+        parser._engine = engine
+        for n, v in pages.items():
+            parser.parse_page(v, n)
+
+    t_generic = _best_of(generic, repeat)
+    t_specialized = _best_of(specialized, repeat)
+
+    return {
+        'pages': len(pages),
+        'engine_build_s': build,
+        'generic_s': t_generic,
+        'specialized_s': t_specialized,
+        'speedup': t_generic / t_specialized
+    }
+
+
+def _peak_of(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def bench_stream(path=DEFAULT_FILE, repeat=3):
+    """Compares peak memory and time of parsing the largest page via json.loads and via the streaming parser."""
+    with zipfile.ZipFile(path, mode='r') as f:
+        page = max((i for i in f.infolist() if i.filename.startswith('pages/')), key=lambda i: i.file_size).filename
+
+    def loads():
+        with zipfile.ZipFile(path, mode='r') as f:
+            sketch_io.SketchToPy().parse_page(json.loads(f.read(page)), page)
+
+    def stream():
+        with zipfile.ZipFile(path, mode='r') as f, f.open(page) as s:
+            sketch_stream.parse_page(s, sketch_io.SketchToPy(), page)
+
+    def scan():
+        with zipfile.ZipFile(path, mode='r') as f, f.open(page) as s:
+            for _ in sketch_stream.iter_page_layers(s, page):
+                pass
+
+    sketch_io.SketchToPy()  # build the decoders outside of the measurements
+    result = {'page': page}
+    for name, fn in [('loads', loads), ('stream', stream), ('iter_layers', scan)]:
+        result[name + '_s'] = _best_of(fn, repeat)
+        result[name + '_peak_mb'] = _peak_of(fn) / 2 ** 20
+    return result
+
+
+def bench_retention(path=DEFAULT_FILE):
+    """Reports the memory still held after opening a file (and the peak while opening it) for each retention policy."""
+    sketch_io.SketchToPy()  # build the decoders outside of the measurements
+    result = {}
+    for policy in sketch_api.Retention:
+        tracemalloc.start()
+        f = sketch_api.SketchFile.from_file(path, retention=policy)
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report = f.memory_report()
+        del f
+        result[policy.value + '_held_mb'] = held / 2 ** 20
+        result[policy.value + '_peak_mb'] = peak / 2 ** 20
+        result[policy.value + '_raw_mb'] = report['raw_bytes'] / 2 ** 20
+        result[policy.value + '_parsed_mb'] = report['parsed_bytes'] / 2 ** 20
+    return result
+
+
+def bench_workers(path=DEFAULT_FILE, copies=16, repeat=3):
+    """
+    Opens the file, with its pages repeated copies times, on one core and with the pages converted in a process pool
+    of cpu_count workers, and times unpickling the converted pages, which the main process pays with workers on top
+    of merging their lookups.
+    """
+    workers = os.cpu_count() or 1
+    sketch_io.SketchToPy()  # build the decoders outside of the measurements
+    fd, copy = tempfile.mkstemp(suffix='.sketch')
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(path, mode='r') as src, zipfile.ZipFile(copy, mode='w') as dst:
+            for info in src.infolist():
+                if not info.filename.startswith('pages/'):
+                    dst.writestr(info, src.read(info.filename))
+                    continue
+                page = json.loads(src.read(info.filename))
+                for i in range(copies):
+                    page['do_objectID'] = '%s-%d' % (page['do_objectID'][:-3], i)
+                    dst.writestr('pages/%s.json' % page['do_objectID'], json.dumps(page))
+        t_serial = _best_of(lambda: sketch_api.SketchFile.from_file(copy), repeat)
+        t_parallel = _best_of(lambda: sketch_api.SketchFile.from_file(copy, workers=workers), repeat)
+        pages = sketch_api.SketchFile.from_file(copy).sketch_pages
+        pickled = [pickle.dumps(page, pickle.HIGHEST_PROTOCOL) for page in pages]
+        t_unpickle = _best_of(lambda: [pickle.loads(p) for p in pickled], repeat)
+    finally:
+        os.remove(copy)
+    return {
+        'workers': workers,
+        'serial_s': t_serial,
+        'parallel_s': t_parallel,
+        'unpickle_s': t_unpickle,
+    }
+
+
+def bench_compact(path=DEFAULT_FILE, repeat=3):
+    """Compares memory per layer and decode time of the regular and the compact (__slots__) object model."""
+    contents = _read_json_entries(path)
+    pages = {n: v for n, v in contents.items() if n.startswith('pages/')}
+    layer_classes = set(sketch_io.sketch_types.SJLayer.__args__)
+
+    def parse(compact):
+        parser = sketch_io.SketchToPy(compact=compact)
+        return [parser.parse_page(v, n) for n, v in pages.items()], parser
+
+    result = {}
+    for compact in (False, True):
+        parse(compact)  # build the decoders outside of the measurements
+        tracemalloc.start()
+        parsed, parser = parse(compact)
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        layers = sum(len(v) for v in parser._class_maps.values() for c in [v[0].__class__] if c in layer_classes)
+        name = 'compact' if compact else 'regular'
+        result['layers'] = layers
+        result[name + '_mb'] = held / 2 ** 20
+        result[name + '_bytes_per_layer'] = held / max(1, layers)
+        result[name + '_s'] = _best_of(lambda: parse(compact), repeat)
+        del parsed, parser
+    result['reduction'] = 1 - result['compact_mb'] / result['regular_mb']
+    return result
+
+
+def bench_frames(path=DEFAULT_FILE, repeat=5):
+    """Moves all layers of every page once per layer object and once through the columnar frame store."""
+    file = sketch_api.SketchFile.from_file(path)
+    pages = [(file.frames(p), p) for p in file.sketch_pages]
+
+    def by_object():
+        for frames, _ in pages:
+            for l in frames.layers_at(frames.rows()):
+                l.frame.x += 1
+                l.frame.y -= 1
+
+    def by_store():
+        for frames, _ in pages:
+            frames.translate(1, -1)
+
+    return {
+        'layers': sum(len(frames) for frames, _ in pages),
+        'object_s': _best_of(by_object, repeat),
+        'store_s': _best_of(by_store, repeat),
+        'bounds_s': _best_of(lambda: [frames.bounds() for frames, _ in pages], repeat),
+    }
+
+
+def bench_spatial(path=DEFAULT_FILE, queries=200, repeat=3):
+    """Rectangle queries on the largest page, brute force over the frame store against the grid index."""
+    file = sketch_api.SketchFile.from_file(path)
+    page = max(file.sketch_pages, key=lambda p: len(file.frames(p)))
+    frames, index = file.frames(page), file.spatial_index(page)
+    x1, y1, x2, y2 = frames.bounds()
+    rng = np.random.default_rng(0)
+    rects = [(x, y, (x2 - x1) / 20, (y2 - y1) / 20) for x, y in rng.uniform((x1, y1), (x2, y2), (queries, 2))]
+
+    build = _best_of(lambda: (setattr(index, '_grid', None), index._ensure_built()), repeat)
+    return {
+        'layers': len(frames),
+        'build_s': build,
+        'brute_ms_per_query': _best_of(lambda: [frames.overlapping(*r) for r in rects], repeat) * 1000 / queries,
+        'index_ms_per_query': _best_of(lambda: [index.query_rect(*r) for r in rects], repeat) * 1000 / queries,
+    }
+
+
+def bench_symbols(path=DEFAULT_FILE, repeat=5):
+    """Resolves the symbolIDs of all instances and masters, by scanning all masters and through the symbol registry."""
+    file = sketch_api.SketchFile.from_file(path)
+    masters = file.get_available_symbols()
+    ids = [l.symbolID for l in file.get_objects_by_class('symbolInstance')] + [s.symbolID for s in masters]
+
+    def scan():
+        for i in ids:
+            next((s for s in masters if s.do_objectID == i or s.symbolID == i), None)
+
+    return {
+        'lookups': len(ids),
+        'masters': len(masters),
+        'build_s': _best_of(lambda: sketch_api.sketch_index.SymbolRegistry(file), repeat),
+        'scan_s': _best_of(scan, repeat),
+        'registry_s': _best_of(lambda: [file.get_symbol_by_id(i) for i in ids], repeat),
+    }
+
+
+def bench_expand(path=DEFAULT_FILE, repeat=5):
+    """find_all_text_layers for every master, with an empty expansion cache and with the cache filled."""
+    file = sketch_api.SketchFile.from_file(path)
+    masters = file.get_available_symbols()
+
+    def run():
+        return sum(len(list(m.find_all_text_layers(file))) for m in masters)
+
+    def cold():
+        file.symbol_expansion.invalidate()
+        run()
+
+    return {
+        'masters': len(masters),
+        'paths': run(),
+        'cold_s': _best_of(cold, repeat),
+        'warm_s': _best_of(run, repeat),
+    }
+
+
+def bench_overrides(path=DEFAULT_FILE, copies=50, repeat=3):
+    """Resolves all symbol instances of every page, with each instance repeated copies times on its page."""
+    file = sketch_api.SketchFile.from_file(path)
+    for page in file.sketch_pages:
+        instances = [l for l in _walk(page) if l._class == 'symbolInstance']
+        page.layers = (page.layers or []) + instances * (copies - 1)
+
+    def cold():
+        file.overrides.invalidate()
+        return sum(1 for page in file.sketch_pages for _ in file.overrides.resolve_page(page))
+
+    return {
+        'instances': cold(),
+        'cold_s': _best_of(cold, repeat),
+        'warm_s': _best_of(lambda: [list(file.overrides.resolve_page(p)) for p in file.sketch_pages], repeat),
+    }
+
+
+def bench_texts(path=DEFAULT_FILE, copies=50, repeat=3):
+    """Extracts all texts as json lines, with each top-level layer repeated copies times on its page."""
+    file = sketch_api.SketchFile.from_file(path)
+    for page in file.sketch_pages:
+        page.layers = (page.layers or []) * copies
+
+    def extract():
+        return sketch_text.extract_texts(file, io.StringIO())
+
+    return {
+        'records': extract(),
+        'time_s': _best_of(extract, repeat),
+    }
+
+
+def bench_search(path=DEFAULT_FILE, copies=200, repeat=3):
+    """Searches the texts of a file with each top-level layer repeated copies times, by index and by scanning."""
+    file = sketch_api.SketchFile.from_file(path)
+    for page in file.sketch_pages:
+        page.layers = (page.layers or []) * copies
+    words = sorted({w for r in sketch_text.iter_texts(file) for w in sketch_text.tokenize(r.string)})
+    query = words[len(words) // 2] if words else 'a'
+
+    def build():
+        file.text_index.rebuild()
+
+    return {
+        'entries': len(file.text_index),
+        'build_s': _best_of(build, repeat),
+        'search_s': _best_of(lambda: file.search_texts(query), repeat),
+        'substring_s': _best_of(lambda: file.search_texts(query[1:], 'substring'), repeat),
+        'scan_s': _best_of(lambda: [r for r in sketch_text.iter_texts(file) if query in sketch_text.tokenize(r.string)],
+                           repeat),
+    }
+
+
+def bench_write(path=DEFAULT_FILE, repeat=5):
+    """Serializes meta, document, user and all pages, for regular and compact objects."""
+    result = {}
+    for compact in (False, True):
+        file = sketch_api.SketchFile.from_file(path, compact=compact)
+        objects = [file.sketch_meta, file.sketch_document, file.sketch_user] + file.sketch_pages
+        key = 'compact' if compact else 'regular'
+        result[key + '_s'] = _best_of(lambda: [sketch_io.PyToSketch.write(o) for o in objects], repeat)
+    return result
+
+
+def bench_save(path=DEFAULT_FILE, repeat=3):
+    """
+    Saves to memory after renaming a layer of the smallest page, incrementally converting only that page and converting
+    every object, and the peak memory the full save allocates next to the objects.
+    """
+    file = sketch_api.SketchFile.from_file(path)
+    page = min(file.sketch_pages, key=lambda p: sum(1 for _ in _walk(p)))
+    layer = page.layers[0]
+
+    def save(incremental):
+        layer.set_name(layer.name)
+        file.save_to(io.BytesIO(), incremental=incremental)
+
+    return {
+        'incremental_s': _best_of(lambda: save(True), repeat),
+        'full_s': _best_of(lambda: save(False), repeat),
+        'full_peak_mb': _peak_of(lambda: save(False)) / 1e6,
+    }
+
+
+def bench_compression(path=DEFAULT_FILE, repeat=3):
+    """Converts and saves every entry to memory per compression policy, with and without a pool of deflate threads."""
+    file = sketch_api.SketchFile.from_file(path)
+    result = {}
+    for policy in ('store', 'fast', 'default', 'best'):
+        for workers in (1, 4):
+            def save():
+                buffer = io.BytesIO()
+                file.save_to(buffer, compression=policy, workers=workers)
+                return buffer
+
+            result['%s_w%d_s' % (policy, workers)] = _best_of(save, repeat)
+        result[policy + '_kb'] = len(save().getvalue()) / 1024
+    return result
+
+
+def bench_images(path=DEFAULT_FILE, count=100, size=512, touched=3, repeat=3):
+    """
+    Opens the file with count random size x size images added, decoding all of them at open and decoding the touched
+    ones on access, and the peak memory of both.
+    """
+    archive = _with_images(path, count, size)
+
+    def eager():
+        sketch_api.SketchFile.from_file(archive, load_images=True)
+
+    def lazy():
+        file = sketch_api.SketchFile.from_file(archive)
+        for name in list(file.images)[:touched]:
+            file.images[name].array
+
+    return {
+        'eager_s': _best_of(eager, repeat),
+        'lazy_s': _best_of(lazy, repeat),
+        'eager_peak_mb': _peak_of(eager) / 1e6,
+        'lazy_peak_mb': _peak_of(lazy) / 1e6,
+    }
+
+
+def bench_dedupe(path=DEFAULT_FILE, count=100, distinct=10, size=256, repeat=3):
+    """Saves the file with count images of only distinct different ones, as they are and deduplicated."""
+    archive = _with_images(path, count, size, distinct)
+    sizes = {}
+
+    def save(dedupe):
+        out = io.BytesIO()
+        sketch_api.SketchFile.from_file(archive).save_to(out, dedupe_images=dedupe)
+        sizes[dedupe] = out.tell()
+
+    return {
+        'save_s': _best_of(lambda: save(False), repeat),
+        'dedupe_s': _best_of(lambda: save(True), repeat),
+        'save_mb': sizes[False] / 1e6,
+        'dedupe_mb': sizes[True] / 1e6,
+    }
+
+
+def bench_entry(path=DEFAULT_FILE, files=200, repeat=3):
+    """Reads meta.json of the file files times, as a service inspecting many files does, mapped and with zipfile."""
+    def mapped():
+        for _ in range(files):
+            with sketch_zip.MappedArchive(path) as f:
+                json.loads(f.read('meta.json'))
+
+    def unmapped():
+        for _ in range(files):
+            with zipfile.ZipFile(path, mode='r') as f:
+                json.loads(f.read('meta.json'))
+
+    return {
+        'mapped_ms_per_file': _best_of(mapped, repeat) * 1000 / files,
+        'zipfile_ms_per_file': _best_of(unmapped, repeat) * 1000 / files,
+    }
+
+
+def _with_images(path, count, size, distinct=None) -> io.BytesIO:
+    """The file as an archive in memory with count random size x size images, repeating after distinct ones."""
+    rng = np.random.default_rng(0)
+    pngs = []
+    archive = io.BytesIO()
+    with zipfile.ZipFile(path, mode='r') as src, zipfile.ZipFile(archive, mode='w') as dst:
+        for info in src.infolist():
+            dst.writestr(info, src.read(info.filename))
+        for i in range(count):
+            if distinct is None or len(pngs) < distinct:
+                png = io.BytesIO()
+                sketch_api.Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)).save(png, format='png')
+                pngs.append(png.getvalue())
+            dst.writestr('images/%d.png' % i, pngs[i % len(pngs)])
+    return archive
+
+
+def _walk(layer):
+    yield layer
+    for l in getattr(layer, 'layers', None) or []:
+        yield from _walk(l)
+
+
+BENCHMARKS = {
+    'decode': bench_decode,
+    'stream': bench_stream,
+    'retention': bench_retention,
+    'workers': bench_workers,
+    'compact': bench_compact,
+    'frames': bench_frames,
+    'spatial': bench_spatial,
+    'symbols': bench_symbols,
+    'expand': bench_expand,
+    'overrides': bench_overrides,
+    'texts': bench_texts,
+    'search': bench_search,
+    'write': bench_write,
+    'save': bench_save,
+    'compression': bench_compression,
+    'images': bench_images,
+    'dedupe': bench_dedupe,
+    'entry': bench_entry,
+}
+
+
+def main(argv):
+    path = argv[1] if len(argv) > 1 else DEFAULT_FILE
+    names = argv[2:] if len(argv) > 2 else list(BENCHMARKS.keys())
+    for name in names:
+        result = BENCHMARKS[name](path)
+        print('%s: %s' % (name, ', '.join('%s=%s' % (k, round(v, 4) if isinstance(v, float) else v)
+                                          for k, v in result.items())))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
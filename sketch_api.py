@@ -1,18 +1,45 @@
+import concurrent.futures
+import contextlib
 import json
 import numpy as np
+import os
+import shutil
+import sys
+import tempfile
 import zipfile
+import zlib
 from PIL import Image, ImageFile
-from io import BytesIO
+from enum import Enum
+from io import BytesIO, TextIOWrapper
 from typing import List, Dict
 
+from . import sketch_changes
+from . import sketch_geometry
+from . import sketch_images
+from . import sketch_index
 from . import sketch_io
+from . import sketch_overrides
+from . import sketch_stream
+from . import sketch_text
 from . import sketch_types
+from . import sketch_zip
+
+PREVIEW = 'previews/preview.png'
+
+
+class Retention(Enum):
+    """What a SketchFile keeps of the file it was read from, besides the converted objects."""
+    ALL = 'all'  # raw bytes and parsed json of every entry, needed for check_file
+    RAW = 'raw'  # raw bytes only, pages are converted one at a time
+    NONE = 'none'  # nothing, entries are re-read from the file on demand (the file must stay in place)
 
 
 class SketchFile:
     @staticmethod
-    def from_file(path, load_images=False, debug=False):
-        return SketchFile(path, load_images, debug)
+    def from_file(path, load_images=False, debug=False, lazy_pages=False, lazy_layers=False, stream_pages=False,
+                  retention=Retention.ALL, workers=1, compact=False):
+        return SketchFile(path, load_images, debug, lazy_pages, lazy_layers, stream_pages, retention, workers,
+                          compact)
 
     @staticmethod
     def create_empty():
@@ -27,13 +54,27 @@ class SketchFile:
         s.sketch_user['16FC7444-C1AC-4FA3-9003-F6C778254BFF'] = ent
         return s
 
-    def __init__(self, path=None, load_images=False, debug=False):
-        self._linked_symbols = []
+    def __init__(self, path=None, load_images=False, debug=False, lazy_pages=False, lazy_layers=False,
+                 stream_pages=False, retention=Retention.ALL, workers=1, compact=False):
+        self._path = path
+        self._archive = path  # the archive the unchanged entries are copied from when saving
+        sketch_types.add_mutation_owner(self)
+        self._changes = sketch_changes.ChangeTracker(self)
+        self._lazy_layers = lazy_layers
+        self._compact = compact
+        self._stream_pages = stream_pages
+        self._retention = Retention(retention)
         self._file_contents = {}
         self._file_sizes = {}
 
-        self._available_symbols = None
+        self._symbols = None
+        self._symbol_expansion = None
+        self._overrides = None
+        self._text_index = None
         self._raw = {}
+        self._index = None
+        self._frames: Dict[str, sketch_geometry.FrameStore] = {}
+        self._spatial: Dict[tuple, sketch_geometry.SpatialIndex] = {}
 
         self.debug = debug
 
@@ -42,212 +83,523 @@ class SketchFile:
         self.sketch_document: sketch_types.SketchDocument = sketch_types.SketchDocument()
         self.sketch_pages: List[sketch_types.SketchPage] = []
 
-        self.images: Dict[str, np.ndarray] = {}
+        # decoded on access, the decoded arrays are held up to images.cache.max_bytes
+        self.images = sketch_images.ImageStore()
 
-        self.preview = np.zeros((100, 100, 3)) + 255  # all white
+        self._preview_image: np.ndarray = None  # the decoded preview, if _preview holds the bytes from the file
+        self.preview = np.full((100, 100, 3), 255, dtype=np.uint8)  # all white
 
         if path is not None:
-            f = zipfile.ZipFile(path, mode='r')
+            parallel = workers > 1 and not lazy_pages
+            if parallel and lazy_layers:
+                # the pages come back from the workers pickled, which converts every lazy layer list
+                raise ValueError('lazy_layers cannot be combined with workers > 1')
+            f = sketch_zip.MappedArchive(path)
             # print(f.start_dir)
             # print(f.compression)
+            defer_pages = lazy_pages or stream_pages or self._retention != Retention.ALL or parallel
             for info in f.infolist():
 
+                is_page = info.filename.startswith('pages/')
+                if is_page and (lazy_pages or stream_pages or self._retention == Retention.NONE):
+                    self._file_sizes[info.filename] = info.file_size
+                    continue
+                is_image = info.filename != PREVIEW and ('images/' in info.filename or '.png' in info.filename)
+                if is_image and self._retention == Retention.NONE and not load_images:
+                    self._file_sizes[info.filename] = info.file_size
+                    self.images.add(info.filename, read=self._read_archived)
+                    continue
+
                 # print(info.filename, info.compress_type)
                 fc = f.read(info.filename)
 
-                self._raw[info.filename] = fc
+                if self._retention != Retention.NONE:
+                    self._raw[info.filename] = fc
 
                 self._file_sizes[info.filename] = len(fc)
                 if info.filename.endswith(".json"):
+                    if is_page and defer_pages and (self._retention != Retention.ALL or parallel):
+                        continue  # converted one at a time below, or parsed by the workers
                     j = json.loads(fc)
 
                     self._file_contents[info.filename] = j
 
-                elif 'images/' in info.filename or '.png' in info.filename:
+                elif info.filename == PREVIEW:
+                    self._preview = fc  # decoded on first access of preview, or below with load_images
+
+                elif is_image:
+                    handle = self.images.add(info.filename, None if self._retention == Retention.NONE else fc,
+                                             self._read_archived)
                     if not load_images:
                         if self.debug:
                             print('Leaving image %s untouched' % info.filename)
-                        self.images[info.filename] = fc
                         continue
-
                     try:
-                        img = self.str_to_img(fc)
-
-                        if 'preview' in info.filename:
-                            self.preview = img
-                        else:
-                            self.images[info.filename] = img
-                        self._file_contents[info.filename] = img
+                        self.images.cache.put(handle, handle.decode(fc))
                     except OSError as e:
                         if self.debug:
                             print('Couldnt load image from file %s, using byte data' % info.filename)
-                        self.images[info.filename] = fc
-
 
                 else:
                     self._file_contents[info.filename] = fc
 
+            deferred_page_files = [i.filename for i in f.infolist() if i.filename.startswith('pages/')] \
+                if defer_pages else []
             f.close()
 
-            self._read_json_to_objects()
+            for name, image in self.images.items():
+                self._changes.clean(name, image.content)
+            if PREVIEW in self._file_sizes:
+                self._changes.clean(PREVIEW, self._preview)
+                if load_images:
+                    try:
+                        self.preview  # the bytes are kept and saved as they are unless the preview is replaced
+                    except OSError:
+                        if self.debug:
+                            print('Couldnt load image from file %s, using byte data' % PREVIEW)
+
+            self._read_json_to_objects(include_pages=not defer_pages)
+            if self._retention != Retention.ALL:
+                self._file_contents = {}
+
+            if parallel:
+                self.sketch_pages.extend(self._load_pages_parallel(deferred_page_files, workers))
+                deferred_page_files = []
+
+            for fn in deferred_page_files:
+                if not lazy_pages:
+                    self.sketch_pages.append(self._load_page(fn))
+                    continue
+                pid = fn[len('pages/'):-len('.json')]
+                mapping = self.sketch_meta.pagesAndArtboards.get(pid)
+                self.sketch_pages.append(LazySketchPage(self, fn, pid, mapping.name if mapping is not None else None))
 
         _link_to_parent(self.sketch_meta, self)
         _link_to_parent(self.sketch_document, self)
         _link_to_parent(self.sketch_user, self)
         _link_to_parent(self.sketch_pages, self)
 
-    def save_to(self, fn, force_include_pages=None):
+    def save_to(self, fn, force_include_pages=None, incremental=False, compression='default', workers=1,
+                dedupe_images=False):
+        """
+        Saves the file to fn, a path or a writable file object. Every entry is written to the archive while it is
+        converted, json one layer at a time. The objects of the file are converted, the images and the preview read
+        from the file are copied from the archive they were read from (or last saved to as a path) as they are stored
+        there, unless they were replaced.
 
-        assert len(
-            self.sketch_pages) > 0, 'At least one content page is required for sketch to correctly read the file.'
+        With incremental, only the entries that changed since then are converted, the others are copied. An entry
+        changed when its top-level object was replaced, when a mutation helper of sketch_types or a write through a
+        FrameStore (see frames) changed it or when it was marked (see mark_dirty), which is required for fields
+        assigned and lists or dicts changed in place. The pages named in force_include_pages are always converted.
+        Returns the names of the converted entries.
 
-        c = zipfile.ZipFile(fn, mode='w', compression=8)
+        compression is a policy of sketch_zip.COMPRESSION ('store', 'fast', 'default' or 'best') for all entries or
+        a function from the entry name to the policy. With more than one worker, entries are deflated in blocks by a
+        pool of threads while the next data is converted.
 
-        _contents = self._convert_objects_to_json(force_include_pages)
-        if self.debug:
-            print('Saving dict with entries: %s' % _contents.keys())
-        for fname, fcont in _contents.items():
-            c.writestr(fname, fcont, compress_type=8)
+        With dedupe_images, images with the same content are collapsed to one entry first (see dedupe_images).
+        """
 
-        c.close()
+        assert len(
+            self.sketch_pages) > 0, 'At least one content page is required for sketch to correctly read the file.'
 
-        return _contents
+        if dedupe_images:
+            self.dedupe_images()
+        entries = self._entries()
+        loaded = {name: obj for name, obj in entries.items() if obj is not None}
+        if self._archive is None:
+            converted = set(loaded)
+        elif incremental:
+            converted = self._changes.changed(loaded)
+            forced = force_include_pages or ()
+            converted.update(t for t, obj in loaded.items() if t.startswith('pages/') and obj.name in forced)
+        else:
+            # objects and arrays set by the caller can be changed in place, stored images and the preview can not
+            stored = {name: obj for name, obj in loaded.items()
+                      if isinstance(obj, (sketch_images.ImageHandle, bytes)) or obj is self._preview_image}
+            converted = set(loaded).difference(stored).union(self._changes.changed(stored))
 
-    def _read_json_to_objects(self):
-        self._parser = sketch_io.SketchToPy(debug=self.debug)
-        self.sketch_meta: sketch_types.SketchMeta = self._parser.parse_meta(self._file_contents['meta.json'])
-        self.sketch_document: sketch_types.SketchDocument = self._parser.parse_document(
-            self._file_contents['document.json'])
-        self.sketch_user: sketch_types.SketchUserData = self._parser.parse_user(self._file_contents['user.json'])
+        if self.debug:
+            print('Saving entries: %s' % list(entries))
+
+        # the entries that are copied and the unloaded pages are read from the source while writing
+        target = fn
+        replace = _same_file(fn, self._archive) or _same_file(fn, self._path)
+        if replace:
+            fd, target = tempfile.mkstemp(suffix='.sketch', dir=os.path.dirname(os.path.abspath(fn)))
+            os.close(fd)
+            shutil.copymode(fn, target)
+        try:
+            policy = compression if callable(compression) else lambda name: compression
+            if workers > 1:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                    written = self._write_archive(target, entries, converted, policy, pool, workers)
+            else:
+                written = self._write_archive(target, entries, converted, policy)
+            if replace:
+                os.replace(target, fn)
+        finally:
+            if replace and os.path.exists(target):
+                os.remove(target)
+
+        if isinstance(fn, (str, bytes, os.PathLike)):
+            self._changes.saved(written, entries)
+            self._archive = fn
+            for name in written:
+                self._raw.pop(name, None)  # differs from what the new archive holds
+                image = self.images.get(name)
+                if image is not None and image.modified:
+                    array = image.array
+                    image.stored(self._read_archived)
+                    self._changes.replace(name, array, image)
+
+        return list(written)
+
+    def dedupe_images(self, fill_sha1=False) -> Dict[str, str]:
+        """
+        Removes images with the same content as another one (see ImageStore.duplicates) and points the references to
+        them at the one that is kept. Unloaded pages are only loaded if they mention a removed image. With fill_sha1,
+        the sha1 of image data references is set as well, which loads all pages with data references. Returns the
+        removed names -> the names they were merged into.
+        """
+        renamed = self.images.duplicates()
+        sha1s = None
+        if fill_sha1:
+            sha1s = {name: image.sha1 for name, image in self.images.items()
+                     if name not in renamed and not image.modified}
+        if not renamed and not sha1s:
+            return renamed
+
+        needles = [form for n in renamed for form in sketch_images.json_forms(n)]
+        if sha1s:
+            needles.append(b'MSJSONOriginalDataReference')
+        entries = self._entries()
+        for page in self.sketch_pages:
+            name = 'pages/' + page.do_objectID + '.json'
+            if isinstance(page, LazySketchPage) and not page.is_loaded:
+                data = self._read_entry(name)
+                if not any(n in data for n in needles):
+                    continue
+                entries[name] = page.load()
+            if sketch_images.rewrite_refs(entries[name], renamed, sha1s):
+                self._changes.mark(name)
+        for name in ('meta.json', 'document.json', 'user.json'):
+            if sketch_images.rewrite_refs(entries[name], renamed, sha1s):
+                self._changes.mark(name)
+
+        for name in renamed:
+            del self.images[name]
+            self._raw.pop(name, None)
+        if self._symbol_expansion is not None:
+            self._symbol_expansion.invalidate()  # holds the image refs of the fills
+        return renamed
+
+    def mark_dirty(self, target):
+        """
+        Marks an entry (i.e. 'document.json') or the entry an object belongs to as changed, for edits an incremental
+        save does not see by itself: fields assigned and lists or dicts changed without the helpers of sketch_types.
+        """
+        self._changes.mark(target)
+
+    def owns(self, obj) -> bool:
+        """Whether obj is the file or one of the objects read for it, written for it or added to it by the helpers."""
+        return obj is self or self._changes.owns(obj)
+
+    def _read_json_to_objects(self, include_pages=True):
+        self._parser = sketch_io.SketchToPy(debug=self.debug, lazy_layers=self._lazy_layers, compact=self._compact)
+        with self._parser.recording('meta.json'):
+            self.sketch_meta: sketch_types.SketchMeta = self._parser.parse_meta(self._file_contents['meta.json'])
+        with self._parser.recording('document.json'):
+            self.sketch_document: sketch_types.SketchDocument = self._parser.parse_document(
+                self._file_contents['document.json'])
+        with self._parser.recording('user.json'):
+            self.sketch_user: sketch_types.SketchUserData = self._parser.parse_user(self._file_contents['user.json'])
         self.sketch_pages: List[sketch_types.SketchPage] = []
 
         for p, v in self._file_contents.items():
-            if 'pages/' in p:
-                self.sketch_pages.append(self._parser.parse_page(v, p))
+            if include_pages and 'pages/' in p:
+                with self._parser.recording(p):
+                    self.sketch_pages.append(self._parser.parse_page(v, p))
+                self._changes.clean(p, self.sketch_pages[-1], self._parser.registries[p])
+
+        self._changes.clean('meta.json', self.sketch_meta, self._parser.registries['meta.json'])
+        self._changes.clean('document.json', self.sketch_document, self._parser.registries['document.json'])
+        self._changes.clean('user.json', self.sketch_user, self._parser.registries['user.json'])
+
+    def _read_archived(self, filename) -> bytes:
+        """The content of filename in the archive the file was read from or last saved to."""
+        with sketch_zip.MappedArchive(self._archive) as f:
+            return f.read(filename)
+
+    def _read_entry(self, filename) -> bytes:
+        if filename in self._raw:
+            return self._raw[filename]
+        with sketch_zip.MappedArchive(self._path) as f:
+            return f.read(filename)
+
+    def _load_page(self, filename) -> 'sketch_types.SketchPage':
+        with self._parser.recording(filename):
+            if self._stream_pages and filename not in self._raw:
+                with sketch_zip.MappedArchive(self._path) as f, f.open(filename) as stream:
+                    page = sketch_stream.parse_page(stream, self._parser, filename)
+            else:
+                page = self._parser.parse_page(json.loads(self._read_entry(filename)), filename)
+        _link_to_parent(page, self)
+        self._changes.clean(filename, page, self._parser.registries[filename])
+        return page
+
+    def _load_pages_parallel(self, filenames, workers):
+        """Converts pages in a process pool, the lookup maps of the workers are merged in page order."""
+        args = [(self._path, fn, self.debug, self._stream_pages, self._compact) for fn in filenames]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_parse_page_worker, args))
+
+        pages = []
+        for fn, (page, object_maps, class_maps, objects) in zip(filenames, results):
+            self._parser.merge_maps(object_maps, class_maps)
+            _link_to_parent(page, self)
+            self._changes.clean(fn, page, objects)
+            pages.append(page)
+        return pages
+
+    def iter_page_layers(self, page_id):
+        """
+        Yields the top-level layers (i.e. artboards) of a page one at a time, parsed straight from the file.
+        The layers are neither linked nor indexed, which keeps memory bounded for scan-and-discard jobs.
+        """
+        filename = 'pages/%s.json' % page_id
+        if filename in self._raw:
+            yield from sketch_stream.iter_page_layers(BytesIO(self._raw[filename]), filename, self.debug)
+            return
+        with sketch_zip.MappedArchive(self._path) as f, f.open(filename) as stream:
+            yield from sketch_stream.iter_page_layers(stream, filename, self.debug)
+
+    def memory_report(self):
+        """Approximate bytes held next to the object graph under the retention policy of this file."""
+        return {
+            'retention': self._retention.value,
+            'raw_bytes': sum(len(v) for k, v in self._raw.items() if k not in self.images),
+            'image_bytes': sum(len(v) for k, v in self._raw.items() if k in self.images),
+            'decoded_image_bytes': self.images.cache.nbytes,
+            'parsed_bytes': _json_sizeof([v for k, v in self._file_contents.items() if k.endswith('.json')]),
+        }
+
+    @property
+    def index(self) -> sketch_index.DocumentIndex:
+        """Index of all pages and layers by id, class, name and parent, built on first access."""
+        if self._index is None:
+            self._index = sketch_index.DocumentIndex(self)
+        return self._index
+
+    def frames(self, page) -> sketch_geometry.FrameStore:
+        """Columnar store of the frames of all layers of page (a page or its id), built on first access."""
+        pid = page if isinstance(page, str) else page.do_objectID
+        if pid not in self._frames:
+            page = next(p for p in self.sketch_pages if p.do_objectID == pid)
+            self._frames[pid] = sketch_geometry.FrameStore.for_page(page.load() if hasattr(page, 'load') else page,
+                                                                    self)
+        return self._frames[pid]
+
+    def spatial_index(self, target) -> sketch_geometry.SpatialIndex:
+        """
+        Grid index of the layers of a page (a page or its id) or of the layers below an artboard or symbol master,
+        built on first access and kept up to date with the frames of the page.
+        """
+        if isinstance(target, (str, sketch_types.SketchPage, LazySketchPage)):
+            frames, within = self.frames(target), None
+        else:
+            frames = next((self.frames(p) for p in self.sketch_pages if target in self.frames(p)), None)
+            if frames is None:
+                raise ValueError('%r is not on a page of this file' % (target,))
+            within = target
+
+        key = (id(frames), id(within))
+        if key not in self._spatial:
+            self._spatial[key] = sketch_geometry.SpatialIndex(frames, within)
+        return self._spatial[key]
 
     def get_object_by_id(self, idx):
-        return self._parser._object_maps[idx]
+        return self._parser.get_objects_by_id(idx)
 
     def get_objects_by_class(self, cls: str):
-        return self._parser._class_maps[cls]
+        return self._parser.get_objects_by_class(cls)
 
     def img_to_str(self, img: np.ndarray):
         bio = BytesIO()
-        img = Image.fromarray(img, mode='RGB')
-        img.save(bio, format='png')
+        self.write_img(img, bio)
         val = bio.getvalue()
         bio.close()
         return val
 
+    def write_img(self, img: np.ndarray, fp):
+        """Writes img (rows, columns and 3 or 4 channels of 0-255) as png to the binary stream fp."""
+        img = Image.fromarray(_to_uint8(img))
+        img.save(fp, format='png')
+
     def str_to_img(self, imgstr: bytes):
         img: ImageFile = Image.open(BytesIO(imgstr))
         img = np.array(img)
         img.setflags(write=True)
         return img
 
-    def set_preview(self, img: np.ndarray):
-        self.preview = img
+    @property
+    def preview(self) -> np.ndarray:
+        """
+        The preview image. The png of the file is decoded (read-only) on first access, or when the file is read with
+        load_images, and saved as it is unless the preview is replaced.
+        """
+        if isinstance(self._preview, bytes):
+            if self._preview_image is None:
+                self._preview_image = self.str_to_img(self._preview)
+                self._preview_image.setflags(write=False)  # stands for the bytes, which are saved as they are
+                self._changes.replace(PREVIEW, self._preview, self._preview_image)
+            return self._preview_image
+        return self._preview
+
+    @preview.setter
+    def preview(self, img: np.ndarray):
+        self._preview = img
+        self._preview_image = None
+
+    def set_preview(self, img: np.ndarray, max_size: int = None):
+        """Replaces the preview, downsampled to fit max_size (i.e. from a rendered page) if given."""
+        self.preview = img if max_size is None else downsample(img, max_size)
 
     def get_preview(self):
         return self.preview
 
-    def _convert_objects_to_json(self, force_include_pages=None):
-        if force_include_pages is None:
-            force_include_pages = []
-
-        _contents = {}
-        _contents['meta.json'] = sketch_io.PyToSketch.write(self.sketch_meta)  # meta.json
-        _contents['document.json'] = sketch_io.PyToSketch.write(self.sketch_document)  # document.json
-        _contents['user.json'] = sketch_io.PyToSketch.write(self.sketch_user)  # user.json
-
+    def _entries(self) -> Dict[str, object]:
+        """The entries of the archive in order, name -> top-level object, None for pages that were not loaded."""
+        entries = {'meta.json': self.sketch_meta, 'document.json': self.sketch_document, 'user.json': self.sketch_user}
         for page in self.sketch_pages:
             t = 'pages/' + page.do_objectID + '.json'
-
-            # print(page.name)
-            if page.name.startswith('- ') and page.name not in force_include_pages:
-                if self.debug:
-                    print('Skipping page %s and copying original content' % page.name)
-                _contents[t] = self._raw[t]
-            else:
-                if self.debug:
-                    print('Saving page %s' % page.name)
-                _contents[t] = sketch_io.PyToSketch.write(page)
-
-        for name, image in self.images.items():
-
-            if isinstance(image, np.ndarray):
-                if self.debug:
-                    print('Saving image %s from array' % name)
-                _contents[name] = self.img_to_str(image)
-            else:
-                if self.debug:
-                    print('Using original image %s' % name)
-                _contents[name] = image
-
-        _contents['previews/preview.png'] = self.img_to_str(self.preview)
-
-        _fsizes = {}
-        for k, v in _contents.items():
-            _fsizes[k] = len(v)
-
-        return _contents
-
-    def get_available_symbols(self) -> List['sketch_types.SJSymbolMaster']:
-        if self._available_symbols is not None:
-            return self._available_symbols
-
-        self._available_symbols = []
-
-        def search_layers(layers):
-            if layers is None:
-                return
-            for l in layers:
-                if l is None:
+            if isinstance(page, LazySketchPage):
+                page = page._page
+            entries[t] = page
+        entries.update((name, image.content) for name, image in self.images.items())
+        entries[PREVIEW] = self._preview if self._preview_image is None else self._preview_image
+        return entries
+
+    def _write_archive(self, fn, entries: Dict[str, object], converted, policy, pool=None,
+                       workers=1) -> Dict[str, tuple]:
+        """
+        Writes entries to the archive fn, converting the ones in converted and copying the others from the source,
+        compressed as policy (entry name -> policy) says. Returns the converted entries, name -> (top-level object,
+        objects written for it).
+        """
+        written = {}
+        with contextlib.ExitStack() as stack:
+            c = stack.enter_context(sketch_zip.ArchiveWriter(fn))
+            source = None
+            for name, obj in entries.items():
+                if name not in converted:
+                    if self.debug:
+                        print('Copying original content of %s' % name)
+                    if source is None:
+                        source = stack.enter_context(sketch_zip.MappedArchive(self._archive))
+                    self._copy_entry(source, name, c, policy(name), pool, workers)
                     continue
-                if l._class == 'symbolMaster':
-                    self._available_symbols.append(l)
-                if hasattr(l, 'layers') and l.layers is not None:
-                    search_layers(l.layers)
 
-        for p in self.sketch_pages:
-            if p is not None:
-                search_layers(p.layers)
-
-        for s in self.sketch_document.foreignSymbols:
-            self._available_symbols.append(s.originalMaster)
+                if name.endswith('.json'):
+                    if self.debug:
+                        print('Saving %s' % name)
+                    objects = []
+                    with TextIOWrapper(sketch_zip.open_entry(c, name, policy(name), pool, workers=workers),
+                                       encoding='utf-8', newline='') as fp:
+                        sketch_io.PyToSketch.write_to(obj, fp, objects)
+                    written[name] = (obj, objects)
+                elif isinstance(obj, np.ndarray):
+                    if self.debug:
+                        print('Saving image %s from array' % name)
+                    with sketch_zip.open_entry(c, name, policy(name), pool, workers=workers) as fp:
+                        self.write_img(obj, fp)
+                    written[name] = (obj, ())
+                else:
+                    if self.debug:
+                        print('Using original image %s' % name)
+                    with sketch_zip.open_entry(c, name, policy(name), pool, workers=workers) as fp:
+                        fp.write(obj.data if isinstance(obj, sketch_images.ImageHandle) else obj)
+                    written[name] = (obj, ())
+        return written
+
+    def _copy_entry(self, source: sketch_zip.MappedArchive, name, target: sketch_zip.ArchiveWriter, policy, pool=None,
+                    workers=1):
+        """Copies the entry name, or its retained content if the source no longer holds that."""
+        retained = self._raw.get(name)
+        if retained is not None and zlib.crc32(retained) != source.getinfo(name).CRC:
+            with sketch_zip.open_entry(target, name, policy, pool, workers=workers) as fp:
+                fp.write(retained)  # the file was replaced since it was read
+        else:
+            sketch_zip.copy_entry(source, name, target, policy, pool, workers)
+
+    @property
+    def symbols(self) -> sketch_index.SymbolRegistry:
+        """Local and foreign symbol masters by id and name, built on first access."""
+        if self._symbols is None:
+            self._symbols = sketch_index.SymbolRegistry(self)
+        return self._symbols
+
+    @property
+    def symbol_expansion(self) -> sketch_index.SymbolExpansion:
+        """Cached flattened symbol trees used by find_layers."""
+        if self._symbol_expansion is None:
+            self._symbol_expansion = sketch_index.SymbolExpansion(self)
+        return self._symbol_expansion
+
+    @property
+    def overrides(self) -> sketch_overrides.OverrideResolver:
+        """Resolves symbol instances to the layers they show, see SJSymbolInstanceLayer.resolve."""
+        if self._overrides is None:
+            self._overrides = sketch_overrides.OverrideResolver(self)
+        return self._overrides
+
+    @property
+    def text_index(self) -> sketch_text.TextIndex:
+        """
+        Full text index of the texts and text overrides, loaded from next to the file if it was saved there for this
+        version of the file (see save_text_index), built on first search otherwise.
+        """
+        if self._text_index is None:
+            if isinstance(self._path, str):
+                self._text_index = sketch_text.TextIndex.load(self)
+            if self._text_index is None:
+                self._text_index = sketch_text.TextIndex(self)
+        return self._text_index
+
+    def save_text_index(self, fn=None, source=None):
+        """
+        Saves text_index next to the file it was opened from or to source (the path it was saved to), or to fn, so
+        that opening the same file again does not rescan it.
+        """
+        self.text_index.save(fn, source)
+
+    def search_texts(self, query: str, mode='token') -> List['sketch_text.TextHit']:
+        """Texts containing all words of query ('token'), a word starting with it ('prefix') or it ('substring')."""
+        index = self.text_index
+        if mode == 'token':
+            return index.search(query)
+        if mode == 'prefix':
+            return index.search_prefix(query)
+        if mode == 'substring':
+            return index.search_substring(query)
+        raise ValueError('mode has to be token, prefix or substring, not %r' % mode)
 
-        return self._available_symbols
+    def get_available_symbols(self) -> List['sketch_types.SJSymbolMaster']:
+        return self.symbols.available()
 
     def get_linked_symbols(self) -> List['sketch_types.SJSymbolMaster']:
-        self._linked_symbols = []
-        for s in self.sketch_document.foreignSymbols:
-            self._linked_symbols.append(s.symbolMaster)
-
-        return self._linked_symbols
+        return self.symbols.linked()
 
     def get_symbol_by_id(self, idx):
-        m = self.get_available_symbols()
-        for s in m:
-            if s.do_objectID == idx or s.symbolID == idx:
-                return s
-
-    def search_symbols_by_name(self, name: str, exact=True) -> List['sketch_types.SJSymbolMaster']:
-        m = self.get_available_symbols()
-        search = []
-        for s in m:
-            if not exact and name in s.name:
-                search.append(s)
-            elif exact and name == s.name:
-                search.append(s)
-
-        m = self.get_linked_symbols()
-        search = []
-        for s in m:
-            if not exact and name in s.name:
-                search.append(s)
-            elif exact and name == s.name:
-                search.append(s)
-        return search
+        return self.symbols.get(idx)
+
+    def search_symbols_by_name(self, name: str, exact=True, prefix=False) -> List['sketch_types.SJSymbolMaster']:
+        """Local, foreign and linked masters named name, starting with it if prefix or containing it if not exact."""
+        if prefix:
+            return self.symbols.with_prefix(name)
+        if exact:
+            return self.symbols.by_name(name)
+        return self.symbols.containing(name)
 
     def add_page(self, name: str):
         pg = sketch_types.SketchPage()
@@ -267,7 +619,11 @@ class SketchFile:
         mapping.name = name
 
         self.sketch_meta.pagesAndArtboards[pg.do_objectID] = mapping
+        for entry in ('meta.json', 'document.json', 'user.json'):
+            self._changes.mark(entry)
 
+        pg._parent = self
+        sketch_types.notify_mutation('add', pg, self)
         return pg
 
     def remove_page(self, name: str):
@@ -282,6 +638,15 @@ class SketchFile:
 
         del self.sketch_meta.pagesAndArtboards[pid]
         del self.sketch_user[pid]
+        for entry in ('meta.json', 'document.json', 'user.json'):
+            self._changes.mark(entry)
+        frames = self._frames.pop(pid, None)
+        self._spatial = {k: v for k, v in self._spatial.items() if v.frames is not frames}
+
+        if isinstance(page, LazySketchPage):
+            page = page._page  # never indexed if it was not loaded
+        if page is not None:
+            sketch_types.notify_mutation('remove', page, self)
 
     def get_page_by_name(self, name: str):
         for p in self.sketch_pages:
@@ -293,6 +658,111 @@ class SketchFile:
         return self.get_page_by_name(name) is not None
 
 
+class LazySketchPage:
+    """
+    Placeholder for a page of a file opened with lazy_pages=True.
+
+    The id and name are known from the file's document.json and meta.json, the page json itself is only read,
+    decoded and converted to a SketchPage on first access of any other attribute. Unloaded pages are saved by
+    copying their original content.
+    """
+    __slots__ = ('_file', '_filename', '_page', '_do_objectID', '_name')
+
+    def __init__(self, file: SketchFile, filename: str, do_objectID: 'sketch_types.SJObjectId', name: str):
+        object.__setattr__(self, '_file', file)
+        object.__setattr__(self, '_filename', filename)
+        object.__setattr__(self, '_page', None)
+        object.__setattr__(self, '_do_objectID', do_objectID)
+        object.__setattr__(self, '_name', name)
+
+    @property
+    def is_loaded(self):
+        return self._page is not None
+
+    def load(self) -> 'sketch_types.SketchPage':
+        if self._page is None:
+            object.__setattr__(self, '_page', self._file._load_page(self._filename))
+        return self._page
+
+    @property
+    def do_objectID(self):
+        return self._page.do_objectID if self._page is not None else self._do_objectID
+
+    @property
+    def name(self):
+        if self._page is None and self._name is not None:
+            return self._name
+        return self.load().name
+
+    def get_ref(self):
+        return 'pages/%s' % self.do_objectID
+
+    def __getattr__(self, item):
+        if item in LazySketchPage.__slots__ or item.startswith('__'):
+            raise AttributeError(item)
+        return getattr(self.load(), item)
+
+    def __setattr__(self, key, value):
+        setattr(self.load(), key, value)
+
+    def __repr__(self):
+        return '%s(name=%s, loaded=%s)' % (self.__class__.__name__, self.name, self.is_loaded)
+
+
+def _parse_page_worker(args):
+    path, filename, debug, stream, compact = args
+    parser = sketch_io.SketchToPy(debug=debug, compact=compact)
+    with sketch_zip.MappedArchive(path) as f, parser.recording(filename):
+        if stream:
+            with f.open(filename) as s:
+                page = sketch_stream.parse_page(s, parser, filename)
+        else:
+            page = parser.parse_page(json.loads(f.read(filename)), filename)
+    # pickled together, so the maps and the recorded objects keep referring to the objects of the page
+    return page, parser._object_maps, parser._class_maps, parser.registries[filename]
+
+
+def downsample(img: np.ndarray, max_size: int) -> np.ndarray:
+    """
+    Shrinks img (i.e. a rendered page) to fit both sides into max_size, averaging the pixels each pixel covers (a box
+    filter, mostly over whole blocks of pixels). img is returned if it fits.
+    """
+    h, w = img.shape[:2]
+    scale = max_size / max(h, w)
+    if scale >= 1:
+        return img
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    return np.asarray(Image.fromarray(_to_uint8(img)).resize(size, Image.BOX, reducing_gap=2.0))
+
+
+def _to_uint8(img: np.ndarray) -> np.ndarray:
+    return img if img.dtype == np.uint8 else np.clip(np.round(img), 0, 255).astype(np.uint8)
+
+
+def _same_file(a, b) -> bool:
+    paths = (str, bytes, os.PathLike)
+    return isinstance(a, paths) and isinstance(b, paths) and os.path.exists(a) and os.path.exists(b) and \
+        os.path.samefile(a, b)
+
+
+def _json_sizeof(obj):
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue  # keys and small values are shared
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, list):
+            stack.extend(o)
+    return size
+
+
 def _link_to_parent(obj, parent=None):
     """if type(obj) in [int, str, bool, float]:
         return
@@ -369,7 +839,9 @@ def compare_dict(source, target, path=''):
 def check_file(path):
     fe = SketchFile.from_file(path)
     _target_contents = fe._file_contents
-    _contents = fe.save_to('xyz.sketch')
+    fe.save_to('xyz.sketch')
+    with zipfile.ZipFile('xyz.sketch', mode='r') as f:
+        _contents = {n: f.read(n).decode('utf-8') if n.endswith('.json') else f.read(n) for n in f.namelist()}
     compare_dict(_contents, _target_contents)
 
 
@@ -385,13 +857,8 @@ if __name__ == '__main__':
 
     main_file = SketchFile.from_file('Icons.sketch')
 
-    text_layers: List[sketch_types.SJTextLayer] = main_file.get_objects_by_class('text')
-
-    for t in text_layers:
-        txt = t.get_text()
-        print(txt, t.get_font_family())
-        if 'sij' in txt:
-            break
+    for record in sketch_text.iter_texts(main_file):
+        print(record.string, record.font_name, record.source)
 
     symbol_hello = main_file.search_symbols_by_name('HALLO')[0]
     symbol_comp = main_file.search_symbols_by_name('Comp')[0]
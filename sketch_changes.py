@@ -0,0 +1,130 @@
+"""
+Tracking of the entries of a file (meta.json, document.json, user.json, the pages, images and the preview) that
+changed since they were read from or written to an archive, so that saving can copy the other ones as they are.
+"""
+from typing import Dict, Any, Optional, Set, Iterable
+
+from . import sketch_index
+from . import sketch_types
+
+
+class ChangeTracker:
+    """
+    An entry is changed when its top-level object was replaced on the file, when a mutation helper of sketch_types
+    or a write through a FrameStore changed an object of it or when it was marked. The objects of an entry are the
+    ones converted while reading it (SketchToPy.recording) and, after a save, the ones written for it. Fields
+    assigned and lists or dicts changed in place outside of the helpers are not seen, mark their entry for those.
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self._roots: Dict[str, Any] = {}  # entry -> its top-level object (or bytes / array) when it was clean
+        self._objects: Dict[str, Optional[list]] = {}  # entry -> its objects, None if they are not known
+        self._dirty: Set[str] = set()
+        self._touched: Dict[int, Any] = {}  # id -> objects changed by the helpers, resolved to entries on save
+        self._adopted: Dict[int, Any] = {}  # id -> objects the helpers added to the file since it was read or saved
+        self._known: Set[int] = set()  # ids of the objects of the entries, see owns
+        self._seen: Dict[str, int] = {}  # entry -> how many of its objects are in _known
+        self._synced = False  # _known holds all objects and no lazy layer list can add more
+        sketch_types.add_mutation_listener(self, file)
+
+    def clean(self, entry: str, root, objects: Optional[list] = ()):
+        """
+        Records entry as equal to what the archive holds. objects are the objects of json entries, the list is kept
+        as it is so that lazy layer lists can add the objects they convert later.
+        """
+        self._roots[entry] = root
+        self._objects[entry] = objects
+        self._dirty.discard(entry)
+        self._seen.pop(entry, None)
+        self._synced = False
+        if self._known:
+            self._known = set()  # the objects the entry had before may be gone, their ids reused
+            self._seen.clear()
+
+    def replace(self, entry: str, old, new):
+        """Records new as the top-level object of entry in place of old, which holds the same content (i.e. decoded)."""
+        if entry in self._roots and self._roots[entry] is old:
+            self._roots[entry] = new
+
+    def mark(self, target):
+        """Marks an entry (by name) or the entry that contains an object as changed."""
+        if isinstance(target, str):
+            self._dirty.add(target)
+        else:
+            self._touched[id(target)] = target
+
+    def owns(self, obj) -> bool:
+        """Whether obj is one of the objects of the entries or was added to one of them by the helpers."""
+        key = id(obj)
+        if key in self._known or key in self._adopted:
+            return True
+        if self._synced:
+            return False
+        for entry, objects in self._objects.items():
+            seen = self._seen.get(entry, 0)
+            if objects and len(objects) > seen:  # lazy layer lists add the objects they convert
+                self._known.update(map(id, objects[seen:]))
+                self._seen[entry] = len(objects)
+        self._synced = not getattr(self._file, '_lazy_layers', False)
+        return key in self._known
+
+    def changed(self, entries: Dict[str, Any]) -> Set[str]:
+        """The entries (name -> current top-level object) that differ from what the archive holds."""
+        ids = set(self._touched)
+        ret = set()
+        for entry, root in entries.items():
+            objects = self._objects.get(entry)
+            if entry in self._dirty or objects is None or self._roots.get(entry) is not root or \
+                    objects and not ids.isdisjoint(map(id, objects)):
+                ret.add(entry)
+        return ret
+
+    def saved(self, written: Dict[str, tuple], entries: Iterable[str]):
+        """
+        Records a save that wrote the entries in written (name -> (root, objects)) and copied the other ones of
+        entries from the archive.
+        """
+        entries = set(entries)
+        for entry in list(self._roots):
+            if entry not in entries:
+                del self._roots[entry]
+                del self._objects[entry]
+
+        for entry, (root, objects) in written.items():
+            registry = self._objects.get(entry)
+            if objects and registry:
+                registry[:] = objects  # still referenced by the lazy layer lists of the entry
+                objects = registry
+            self.clean(entry, root, objects)
+        self._touched = {}
+        self._adopted = {}
+        self._known = set()
+        self._seen.clear()
+        self._synced = False
+        self._dirty &= entries
+
+    def on_mutation(self, event, obj, container, details):
+        # mutations of objects no file owns reach every file, only the ones of this file are recorded
+        if event in ('add', 'remove'):
+            if container is not self._file and not self.owns(container):
+                return
+            if event == 'add':
+                stack = [obj]
+                while stack:
+                    l = stack.pop()
+                    self._adopted[id(l)] = l
+                    stack.extend(getattr(l, 'layers', None) or [])
+            if container is self._file:
+                return  # add_page and remove_page mark the entries they change
+            self._touched[id(container)] = container
+            if getattr(container, '_class', None) == 'page' and \
+                    getattr(obj, '_class', None) in sketch_index.ARTBOARD_CLASSES:
+                self._dirty.add('meta.json')  # add_artboard and remove_artboard update pagesAndArtboards
+        elif event in ('rename', 'text', 'override', 'change') and self.owns(obj):
+            self._touched[id(obj)] = obj
+        elif event == 'frames':
+            if container is not None and self.owns(container):
+                self._touched[id(container)] = container  # the store of a page, which is part of the same entry
+            else:
+                self._touched.update((id(l), l) for l in details['layers'] if self.owns(l))
@@ -0,0 +1,219 @@
+"""
+Compact, __slots__ based variants of the sketch_types classes, used by SketchToPy(compact=True).
+
+A compact class has one slot per field of its source class and copies the source's methods. Fields that were never
+set read as the class-level default (mutable defaults such as frame or exportOptions are created on first read), so
+an instance only pays for what the json contained. __class__ reports the source class, which keeps isinstance()
+and the __repr__ of the source working. __dict__ is a live view that reads, writes and deletes the slots, so code
+written against plain instances (SketchToPy.js_to_py, AdvancedEncoder) works on compact instances as well.
+"""
+import copy
+from collections.abc import MutableMapping
+from enum import Enum
+from typing import Dict
+
+_IMMUTABLE = (type(None), bool, int, float, str, bytes, Enum)
+_SKIPPED = {'__init__', '__dict__', '__weakref__', '__module__', '__qualname__', '__doc__', '__slots__'}
+
+
+class SlotDict(MutableMapping):
+    """The __dict__ of a compact instance. Fields that were deleted are absent, unset fields hold their default."""
+    __slots__ = ('_obj',)
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __getitem__(self, k):
+        obj = self._obj
+        try:
+            return getattr(obj, k) if k in type(obj)._slot_getters else obj._extra[k]
+        except AttributeError:
+            raise KeyError(k) from None
+        except TypeError:
+            raise KeyError(k) from None
+
+    def __setitem__(self, k, v):
+        if k in type(self._obj)._slot_getters:
+            object.__setattr__(self._obj, k, v)
+        else:
+            setattr(self._obj, k, v)
+
+    def __delitem__(self, k):
+        try:
+            delattr(self._obj, k)
+        except AttributeError:
+            raise KeyError(k) from None
+
+    def __iter__(self):
+        for k, _ in self._iter_items():
+            yield k
+
+    def __len__(self):
+        return sum(1 for _ in self._iter_items())
+
+    def __contains__(self, k):
+        obj = self._obj
+        cls = type(obj)
+        getter = cls._slot_getters.get(k)
+        if getter is None:
+            return obj._extra is not None and k in obj._extra
+        try:
+            getter(obj)
+            return True
+        except AttributeError:
+            return obj._absent is None or k not in obj._absent
+
+    def items(self):
+        """Unlike item access, does not store the mutable defaults it creates for unset fields."""
+        return list(self._iter_items())
+
+    def _iter_items(self):
+        obj = self._obj
+        cls = type(obj)
+        absent = obj._absent
+        for k, getter in cls._slot_getters.items():
+            try:
+                yield k, getter(obj)
+            except AttributeError:
+                if absent is not None and k in absent:
+                    continue
+                if k in cls._defaults:
+                    yield k, cls._defaults[k]
+                else:
+                    yield k, cls._factories[k]()
+        if obj._extra is not None:
+            yield from obj._extra.items()
+
+
+def _getattr(self, name):
+    # only called for unset slots and unknown names
+    cls = type(self)
+    if name in cls._slot_getters:
+        if self._absent is not None and name in self._absent:
+            raise AttributeError(name)
+        if name in cls._defaults:
+            return cls._defaults[name]
+        value = cls._factories[name]()
+        object.__setattr__(self, name, value)
+        return value
+    if name[:2] != '__' and self._extra is not None and name in self._extra:
+        return self._extra[name]
+    raise AttributeError('%r object has no attribute %r' % (cls._source.__name__, name))
+
+
+def _setattr(self, name, value):
+    if name in type(self)._slot_getters or name in _OWN_SLOTS:
+        object.__setattr__(self, name, value)
+    else:  # attributes outside of the schema, i.e. set by user code
+        if self._extra is None:
+            object.__setattr__(self, '_extra', {})
+        self._extra[name] = value
+
+
+def _delattr(self, name):
+    if name in type(self)._slot_getters:
+        if name not in SlotDict(self):
+            raise AttributeError(name)
+        try:
+            object.__delattr__(self, name)
+        except AttributeError:
+            pass
+        if self._absent is None:
+            object.__setattr__(self, '_absent', set())
+        self._absent.add(name)
+    elif self._extra is not None and name in self._extra:
+        del self._extra[name]
+    else:
+        raise AttributeError(name)
+
+
+def _reduce_ex(self, protocol):
+    return _restore, (type(self)._source,), _get_state(self)
+
+
+def _get_state(self):
+    values = {}
+    for k, getter in type(self)._slot_getters.items():
+        try:
+            values[k] = getter(self)
+        except AttributeError:
+            pass
+    return values, self._absent, self._extra
+
+
+def _set_state(self, state):
+    values, absent, extra = state
+    for k, v in values.items():
+        object.__setattr__(self, k, v)
+    object.__setattr__(self, '_absent', None if absent is None else set(absent))
+    object.__setattr__(self, '_extra', None if extra is None else dict(extra))
+
+
+def _restore(source):
+    return compact_class(source)()
+
+
+def _init(self):
+    object.__setattr__(self, '_absent', None)
+    object.__setattr__(self, '_extra', None)
+
+
+_OWN_SLOTS = ('_absent', '_extra', '__weakref__')
+
+_compact_classes: Dict[type, type] = {}
+
+
+def field_defaults(proto):
+    """
+    Splits the fields of an instance created by the constructor into shareable immutable defaults and factories
+    that create a copy of the mutable ones.
+    """
+    defaults = {}
+    factories = {}
+    for k, v in proto.__dict__.items():
+        if isinstance(v, _IMMUTABLE):
+            defaults[k] = v
+        elif type(v) is list and not v:
+            factories[k] = list
+        elif type(v) is dict and not v:
+            factories[k] = dict
+        else:
+            factories[k] = (lambda v: lambda: copy.deepcopy(v))(v)
+    return defaults, factories
+
+
+def compact_class(source: type) -> type:
+    """Returns the compact variant of a sketch_types class, which has to be constructible without arguments."""
+    if source in _compact_classes:
+        return _compact_classes[source]
+
+    proto = source()
+    fields = list(proto.__dict__.keys())
+
+    ns = {}
+    for klass in reversed(source.__mro__[:-1]):
+        ns.update({k: v for k, v in vars(klass).items() if k not in _SKIPPED})
+
+    defaults, factories = field_defaults(proto)
+
+    ns.update({
+        '__slots__': tuple(fields) + _OWN_SLOTS,
+        '__module__': __name__,
+        '__qualname__': 'Compact' + source.__name__,
+        '__init__': _init,
+        '__getattr__': _getattr,
+        '__setattr__': _setattr,
+        '__delattr__': _delattr,
+        '__reduce_ex__': _reduce_ex,
+        '__setstate__': _set_state,
+        '__dict__': property(SlotDict),
+        '__class__': property(lambda self: source),
+        '_source': source,
+        '_defaults': defaults,
+        '_factories': factories,
+    })
+    cls = type('Compact' + source.__name__, (), ns)
+    cls._slot_getters = {k: vars(cls)[k].__get__ for k in fields}
+
+    _compact_classes[source] = cls
+    return cls
@@ -0,0 +1,401 @@
+from typing import Dict, Callable
+
+from . import sketch_compact
+from . import sketch_schema
+
+# Signature of every generated decoder: (js, path, parser) -> decoded value
+Decoder = Callable
+
+
+class DecoderEngine:
+    """
+    Generates one specialized decode function per sketch_types class from the schema.
+
+    Each class decoder has the field list, the default-value checks of SketchToPy._do_types_match and the child
+    decoders of its fields resolved ahead of time, so decoding an object does no type inspection at runtime.
+
+    With lazy_layers, the layers of every layer below a page are decoded into a LazyLayerList instead. With compact,
+    objects are created as their sketch_compact variants.
+    """
+
+    def __init__(self, schema: 'sketch_schema.Schema', lazy_layers=False, compact=False):
+        self.schema = schema
+        self.lazy_layers = lazy_layers
+        self.compact = compact
+        self._ns = {'print': print, 'NEW': object.__new__}
+        self._value_decoders: Dict[int, Decoder] = {}
+        self._pending = []
+
+        sources = []
+        for cs in schema.classes.values():
+            if cs.raw_dict:
+                continue
+            try:
+                proto = cs.cls()
+            except TypeError:  # needs constructor arguments, never decoded from json
+                continue
+            sources.append(self._class_source(cs, proto))
+
+        exec(compile('\n\n'.join(sources), '<sketch_decoders>', 'exec'), self._ns)
+
+        for name, ft in self._pending:
+            self._ns[name] = self.decoder_for(ft)
+            if self.lazy_layers and name.endswith('__layers') and name != 'V_SketchPage__layers':
+                self._ns[name] = _lazy_list_decoder(self.decoder_for(ft.item))
+
+    def decoder_for(self, ft: 'sketch_schema.FieldType') -> Decoder:
+        """Returns the decoder for a field type, or None if values of that type are kept as-is."""
+        key = id(ft)
+        if key not in self._value_decoders:
+            self._value_decoders[key] = self._build_decoder(ft)
+        return self._value_decoders[key]
+
+    def decode(self, ft: 'sketch_schema.FieldType', js, ctx, p=''):
+        fn = self.decoder_for(ft)
+        return js if fn is None else fn(js, p, ctx)
+
+    def _build_decoder(self, ft: 'sketch_schema.FieldType'):
+        kind = ft.kind
+
+        if kind == sketch_schema.FieldType.OBJECT:
+            return self._ns.get('dec_' + ft.ref)
+        if kind == sketch_schema.FieldType.ENUM or kind == sketch_schema.FieldType.SCALAR and ft.py is not str:
+            conv = ft.py
+            return lambda js, p, ctx: conv(js)
+        if kind == sketch_schema.FieldType.LIST and ft.item is not None:
+            return _list_decoder(ft, self.decoder_for(ft.item))
+        if kind == sketch_schema.FieldType.DICT and ft.value is not None:
+            return _dict_decoder(ft, self.decoder_for(ft.value))
+        if kind == sketch_schema.FieldType.UNION:
+            return _union_decoder(ft, self.schema.union_dispatch(ft), {id(m): self.decoder_for(m) for m in ft.members})
+
+        return None
+
+    def _bind(self, name, value):
+        self._ns[name] = value
+        return name
+
+    def _class_source(self, cs, proto):
+        cname = cs.name
+        factories = {}
+        if self.compact:
+            lines = ['def dec_%s(js, p, ctx):' % cname,
+                     '    ret = %s()' % self._bind('C_' + cname, self._target_class(cs))]
+        else:
+            # the constructor is not run: the fields are filled in its order, from the defaults of a prototype and
+            # copies of its mutable defaults for fields missing from js
+            defaults, factories = sketch_compact.field_defaults(proto)
+            # (one store per field keeps the instance dict sharing its keys with the class, unlike dict.update)
+            lines = ['def dec_%s(js, p, ctx):' % cname,
+                     '    ret = NEW(%s)' % self._bind('C_' + cname, cs.cls),
+                     '    d = ret.__dict__']
+            for k in proto.__dict__:
+                v = defaults.get(k)
+                literal = repr(v) if v is None or type(v) in (bool, int, str) else self._bind('D_%s__%s' % (cname, k), v)
+                lines.append('    d[%r] = %s' % (k, literal))
+
+        for k, default in proto.__dict__.items():
+            ft = cs.fields.get(k) or sketch_schema.FieldType(sketch_schema.FieldType.ANY)
+            lines.append('    if %r in js:' % k)
+            lines.append('        vn = js[%r]' % k)
+            lines.extend(self._converted(cs, k, default, ft))
+            if k in factories:
+                lines.append('    else:')
+                lines.append('        d[%r] = %s()' % (k, self._bind('F_%s__%s' % (cname, k), factories[k])))
+
+        lines.extend([
+            '    sid = None',
+            "    if 'do_objectID' in js:",
+            "        sid = js['do_objectID']",
+            "    if 'sharedObjectID' in js:",
+            "        sid = js['sharedObjectID']",
+            "    if 'symbolID' in js:",
+            "        sid = js['symbolID']",
+            '    if sid is not None:',
+            '        om = ctx._object_maps',
+            '        if sid in om:',
+            '            om[sid].append(ret)',
+            '        else:',
+            '            om[sid] = [ret]',
+            '    dl = ctx._decoded',
+            '    if dl is not None:',
+            '        dl.append(ret)',
+            "    if '_class' in js:",
+            "        c = js['_class']",
+            '        cm = ctx._class_maps',
+            '        if c in cm:',
+            '            cm[c].append(ret)',
+            '        else:',
+            '            cm[c] = [ret]',
+            '    return ret'
+        ])
+        return '\n'.join(lines)
+
+    def _converted(self, cs, k, default, ft) -> list:
+        """Statements storing the value vn read from js as field k, indented for the body of the 'in js' check."""
+        if ft.kind == sketch_schema.FieldType.ANY:
+            return ['        ' + self._assign(cs, k, 'vn')]
+
+        convert = self._convert_source(cs, k, ft)
+        if default is None:
+            return ['        if vn is not None:'] + ['            ' + c for c in convert]
+
+        cname = cs.name
+        dname = self._bind('D_%s__%s' % (cname, k), default)
+        t = type(default)
+        if t is bool:
+            cond = 'vn.__class__ is bool or vn == %s' % dname
+        elif t is int or t is float:
+            cond = 'vn.__class__ is int or vn.__class__ is float or vn == %s' % dname
+        elif t is str:
+            cond = 'vn.__class__ is str or vn == %s' % dname
+        elif t is dict:
+            cond = 'vn == %s' % dname
+        elif t is list:
+            cond = self._bind('M_%s__%s' % (cname, k), _list_matcher(default, ft)) + '(vn)'
+        else:
+            cond = 'vn.__class__ is %s.__class__' % dname
+
+        return ['        if %s:' % cond,
+                '            ' + self._assign(cs, k, 'vn'),
+                '        else:'] + ['            ' + c for c in convert]
+
+    def _target_class(self, cs):
+        return sketch_compact.compact_class(cs.cls) if self.compact else cs.cls
+
+    def _assign(self, cs, k, expr):
+        """Statement storing expr as field k of ret, compact instances are written through their slot descriptor."""
+        if not self.compact:
+            return 'd[%r] = %s' % (k, expr)
+        setter = self._bind('S_%s__%s' % (cs.name, k), vars(self._target_class(cs))[k].__set__)
+        return '%s(ret, %s)' % (setter, expr)
+
+    def _convert_source(self, cs, k, ft: 'sketch_schema.FieldType'):
+        FieldType = sketch_schema.FieldType
+        cname = cs.name
+        prop = "p + %r" % ('.' + k)
+
+        if ft.kind == FieldType.ENUM:
+            return [self._assign(cs, k, '%s(vn)' % self._bind('E_' + ft.ref, ft.py))]
+        if ft.kind == FieldType.SCALAR:
+            return [self._assign(cs, k, 'vn' if ft.py is str else '%s(vn)' % ft.ref)]
+        if ft.kind in (FieldType.NEWTYPE, FieldType.ANY) or \
+                ft.kind == FieldType.OBJECT and self.schema.classes[ft.ref].raw_dict:
+            return [self._assign(cs, k, 'vn')]
+
+        vname = 'V_%s__%s' % (cname, k)
+        self._pending.append((vname, ft))
+
+        if ft.kind == FieldType.DICT and ft.value is not None or ft.kind == FieldType.LIST and ft.item is not None:
+            kind = 'dict' if ft.kind == FieldType.DICT else 'list'
+            return ['if vn.__class__ is %s:' % kind,
+                    '    ' + self._assign(cs, k, '%s(vn, %s, ctx)' % (vname, prop)),
+                    'else:',
+                    "    print('Couldnt match %s property %%s to type %s' %% (%s))" % (kind, ft, prop)]
+        if ft.kind in (FieldType.DICT, FieldType.LIST):
+            return [self._assign(cs, k, 'vn')]
+        return [self._assign(cs, k, '%s(vn, %s, ctx)' % (vname, prop))]
+
+
+def _list_matcher(default: list, ft: 'sketch_schema.FieldType'):
+    exp_type = ft.item.py if ft.kind == sketch_schema.FieldType.LIST and ft.item is not None and \
+                             ft.item.kind == sketch_schema.FieldType.SCALAR else None
+    check_item = ft.kind == sketch_schema.FieldType.LIST and ft.item is not None
+
+    def match(vn):
+        if vn.__class__ is not list:
+            return False
+        if len(default) == 0 or len(vn) == 0:
+            if check_item and len(vn) > 0:
+                return vn[0].__class__ is exp_type
+            return True
+        i, j = default[0], vn[0]
+        return i == j or type(i) == type(j) or type(i) in (int, float) and type(j) in (int, float)
+
+    return match
+
+
+def _list_decoder(ft: 'sketch_schema.FieldType', item: Decoder):
+    if item is None:
+        return lambda js, p, ctx: list(js)
+
+    if ft.item.kind in (sketch_schema.FieldType.SCALAR, sketch_schema.FieldType.ENUM):
+        conv = ft.item.py
+        return lambda js, p, ctx: [conv(v) for v in js]
+
+    def dec(js, p, ctx):
+        return [item(v, p + '[%d]' % i, ctx) for i, v in enumerate(js)]
+
+    return dec
+
+
+def _lazy_list_decoder(item: Decoder):
+    return lambda js, p, ctx: LazyLayerList(ctx, js, p, item)
+
+
+class LazyLayerList(list):
+    """
+    List of layers that holds the raw json dicts of its layers until it is first read or modified.
+
+    Materializing converts the dicts in place with the layer decoder and registers the new objects with the parser.
+    """
+    __slots__ = ('_parser', '_p', '_item', '_lazy', '_origin', '_indexed', '_registry')
+
+    def __init__(self, parser, raw: list, p: str, item: Decoder):
+        list.__init__(self, raw)
+        self._parser = parser
+        self._p = p
+        self._item = item
+        self._lazy = True
+        self._origin = None  # id of raw dict => decoded layer, kept while the parser has a lazy index
+        self._registry = parser._decoded  # the objects of the entry the list is part of, see SketchToPy.recording
+        # lists created while materializing an indexed list are covered by the index entries of that list
+        self._indexed = parser._lazy_covering > 0
+        if not self._indexed:
+            parser._lazy_unindexed.append(self)
+
+    @property
+    def is_materialized(self):
+        return not self._lazy
+
+    def materialize(self) -> 'LazyLayerList':
+        if self._lazy:
+            self._lazy = False
+            raw = list(list.__iter__(self))
+            parser = self._parser
+            parser._lazy_covering += self._indexed
+            decoded, parser._decoded = parser._decoded, self._registry
+            try:
+                items = [self._item(v, self._p + '[%d]' % i, parser) for i, v in enumerate(raw)]
+            finally:
+                parser._lazy_covering -= self._indexed
+                parser._decoded = decoded
+            list.__setitem__(self, slice(None), items)
+            if self._parser._lazy_ids is not None:
+                self._origin = {id(r): o for r, o in zip(raw, items)}
+        return self
+
+    def __reduce_ex__(self, protocol):
+        return list, (list(self),)
+
+    def __iter__(self):
+        return list.__iter__(self.materialize())
+
+    def __reversed__(self):
+        return list.__reversed__(self.materialize())
+
+    def __getitem__(self, i):
+        return list.__getitem__(self.materialize(), i)
+
+    def __setitem__(self, i, v):
+        list.__setitem__(self.materialize(), i, v)
+
+    def __delitem__(self, i):
+        list.__delitem__(self.materialize(), i)
+
+    def __contains__(self, v):
+        return list.__contains__(self.materialize(), v)
+
+    def __eq__(self, other):
+        return list.__eq__(self.materialize(), other)
+
+    def __ne__(self, other):
+        return list.__ne__(self.materialize(), other)
+
+    def __add__(self, other):
+        return list.__add__(self.materialize(), other)
+
+    def __iadd__(self, other):
+        return list.__iadd__(self.materialize(), other)
+
+    def __repr__(self):
+        return list.__repr__(self.materialize())
+
+    def copy(self):
+        return list(self)
+
+    def append(self, v):
+        list.append(self.materialize(), v)
+
+    def extend(self, v):
+        list.extend(self.materialize(), v)
+
+    def insert(self, i, v):
+        list.insert(self.materialize(), i, v)
+
+    def remove(self, v):
+        list.remove(self.materialize(), v)
+
+    def pop(self, i=-1):
+        return list.pop(self.materialize(), i)
+
+    def index(self, *args):
+        return list.index(self.materialize(), *args)
+
+    def count(self, v):
+        return list.count(self.materialize(), v)
+
+    def sort(self, *args, **kwargs):
+        list.sort(self.materialize(), *args, **kwargs)
+
+    def reverse(self):
+        list.reverse(self.materialize())
+
+    def clear(self):
+        list.clear(self.materialize())
+
+
+def _dict_decoder(ft: 'sketch_schema.FieldType', value: Decoder):
+    key = ft.key.py if ft.key.kind == sketch_schema.FieldType.SCALAR else None
+
+    if value is None and key is None:
+        return lambda js, p, ctx: dict(js)
+
+    def dec(js, p, ctx):
+        dn = {}
+        for sk, sv in js.items():
+            dn[key(sk) if key is not None else sk] = value(sv, p + '.' + sk, ctx) if value is not None else sv
+        return dn
+
+    return dec
+
+
+def _identity(js, p, ctx):
+    return js
+
+
+def _union_decoder(ft: 'sketch_schema.FieldType', dispatch: 'sketch_schema.UnionDispatch', decoders):
+    def unknown(js, p, ctx):
+        sketch_schema.report_unknown_value(ft, js, p)
+        return js
+
+    def member(m):
+        if m is None:
+            return unknown
+        return decoders[id(m)] or _identity
+
+    # the lookups of dispatch.resolve, with the member decoders in place of the members
+    by_class = {c: member(m) for c, m in dispatch.by_class.items()}
+    class_fallback = member(dispatch.class_fallback)
+    symbol = member(dispatch.symbol)
+    plain = member(dispatch.plain)
+    string = member(dispatch.string)
+
+    def dec(js, p, ctx):
+        if js.__class__ is dict:
+            if '_class' in js:
+                return by_class.get(js['_class'], class_fallback)(js, p, ctx)
+            return (symbol if 'symbolID' in js else plain)(js, p, ctx)
+        return (string if js.__class__ is str else unknown)(js, p, ctx)
+
+    return dec
+
+
+_engines: Dict[tuple, DecoderEngine] = {}
+
+
+def get_engine(lazy_layers=False, compact=False) -> DecoderEngine:
+    key = (lazy_layers, compact)
+    if key not in _engines:
+        _engines[key] = DecoderEngine(sketch_schema.get_schema(), lazy_layers, compact)
+    return _engines[key]
@@ -0,0 +1,551 @@
+"""
+Columnar (numpy) view of the frames of a layer tree, for bulk geometric reads and writes.
+"""
+import weakref
+from typing import Dict, List, Iterable
+
+import numpy as np
+
+from . import sketch_types
+
+# column -> (attribute, whether it is an attribute of layer.frame instead of the layer)
+COLUMNS = {
+    'x': ('x', True),
+    'y': ('y', True),
+    'width': ('width', True),
+    'height': ('height', True),
+    'rotation': ('rotation', False),
+    'flipped_horizontal': ('isFlippedHorizontal', False),
+    'flipped_vertical': ('isFlippedVertical', False),
+}
+_BOOL_COLUMNS = ('flipped_horizontal', 'flipped_vertical')
+_FRAME_COLUMNS = ('x', 'y', 'width', 'height')
+
+ALIGN_EDGES = ('left', 'right', 'top', 'bottom', 'center', 'middle')
+
+
+class FrameStore:
+    """
+    Holds x, y, width, height, rotation and the flip flags of a set of layers in numpy arrays, one row per layer.
+
+    The SJRect objects stay the source of truth: all writes through the store (set, translate, scale, align) are
+    written back to the layers at once. Frame values that were ints stay ints while the results are integral. Frames
+    assigned directly (i.e. layer.frame.x = ...) are picked up by refresh().
+
+    A store built from a page with for_page() covers every layer below it and follows add_layer, remove_layer,
+    add_artboard, remove_artboard and group_coords. Rows of removed layers are reused after compaction, so row numbers
+    are only stable until the next structural change. Coordinates in Sketch are relative to the parent layer, the
+    absolute_* methods add up the origins of the parents. Rotation is stored but not applied to bounds.
+    """
+
+    def __init__(self, layers: Iterable = (), recursive=False):
+        self.layers: List = []  # row -> layer, None for removed rows
+        self._rows: Dict[int, int] = {}  # id(layer) -> row
+        self._size = 0
+        self._dead = 0
+        self._root = None
+        self._columns: Dict[str, np.ndarray] = {}
+        for name in COLUMNS:
+            self._columns[name] = np.zeros(16, dtype=bool if name in _BOOL_COLUMNS else np.float64)
+        self._ints = {name: np.zeros(16, dtype=bool) for name in _FRAME_COLUMNS}  # the value of the frame was an int
+        self._parent = np.zeros(16, dtype=np.int64)  # row of the parent, -1 for top-level rows
+        self._depth = np.zeros(16, dtype=np.int64)
+        self._alive = np.zeros(16, dtype=bool)
+        self._observers = weakref.WeakSet()
+
+        for layer in layers:
+            self._add(layer, None, recursive)
+
+    @classmethod
+    def for_page(cls, page: 'sketch_types.SketchPage', file=None) -> 'FrameStore':
+        """Store over all layers of page, kept up to date by the mutation helpers (of the objects of file if given)."""
+        store = cls(page.layers or [], recursive=True)
+        store._root = page
+        sketch_types.add_mutation_listener(store, file)
+        return store
+
+    def __len__(self):
+        return self._size - self._dead
+
+    def add_observer(self, observer):
+        """
+        Registers an object whose on_frames(event, rows) is called with 'add', 'remove' or 'change' and the affected
+        rows, and with 'compact' and None when rows were renumbered. Observers are held weakly.
+        """
+        self._observers.add(observer)
+
+    def _notify(self, event: str, rows):
+        for observer in list(self._observers):
+            observer.on_frames(event, rows)
+
+    def __contains__(self, layer):
+        return id(layer) in self._rows
+
+    def rows(self, layers: Iterable = None) -> np.ndarray:
+        """Row numbers of layers, of all layers if None."""
+        if layers is None:
+            return np.flatnonzero(self._alive[:self._size])
+        rows = self._rows
+        return np.fromiter((rows[id(l)] for l in layers), dtype=np.int64)
+
+    def layers_at(self, rows: np.ndarray) -> list:
+        layers = self.layers
+        return [layers[r] for r in rows.tolist()]
+
+    def get(self, column: str, layers: Iterable = None) -> np.ndarray:
+        """Copy of a column for layers (all layers if None), in the order of layers."""
+        return self._columns[column][self.rows(layers)]
+
+    def __getattr__(self, name):
+        # read-only views of the columns by row, i.e. store.x, store.flipped_vertical
+        if name in COLUMNS:
+            view = self._columns[name][:self._size]
+            view.flags.writeable = False
+            return view
+        raise AttributeError(name)
+
+    def set(self, column: str, values, layers: Iterable = None):
+        """Sets a column for layers (all layers if None) to values (a scalar or one value per layer)."""
+        rows = self.rows(layers)
+        self._columns[column][rows] = values
+        self._write_back(rows, (column,))
+
+    def translate(self, dx, dy, layers: Iterable = None):
+        """Moves layers (all layers if None) by dx, dy (scalars or one value per layer)."""
+        rows = self.rows(layers)
+        self._columns['x'][rows] += dx
+        self._columns['y'][rows] += dy
+        self._write_back(rows, ('x', 'y'))
+
+    def scale(self, sx, sy=None, layers: Iterable = None, origin=(0, 0)):
+        """
+        Scales the frames of layers (all layers if None) around origin in page coordinates. Only the frames are
+        changed, not the frames of the layers below them.
+        """
+        sy = sx if sy is None else sy
+        rows = self.rows(layers)
+        ax, ay = self._absolute_origin(rows)
+        cols = self._columns
+        cols['x'][rows] += (origin[0] + (ax - origin[0]) * sx) - ax
+        cols['y'][rows] += (origin[1] + (ay - origin[1]) * sy) - ay
+        cols['width'][rows] *= sx
+        cols['height'][rows] *= sy
+        self._write_back(rows, _FRAME_COLUMNS)
+
+    def align(self, edge: str, layers: Iterable = None, to: float = None):
+        """
+        Aligns the 'left', 'right', 'top', 'bottom', 'center' (horizontal) or 'middle' (vertical) edge of layers (all
+        layers if None) to the page coordinate to, by default to the matching edge of their common bounds.
+        """
+        if edge not in ALIGN_EDGES:
+            raise ValueError('edge has to be one of %s, not %r' % (ALIGN_EDGES, edge))
+
+        rows = self.rows(layers)
+        if len(rows) == 0:
+            return
+        ax, ay = self._absolute_origin(rows)
+        w, h = self._columns['width'][rows], self._columns['height'][rows]
+
+        horizontal = edge in ('left', 'right', 'center')
+        start, size = (ax, w) if horizontal else (ay, h)
+        if edge in ('left', 'top'):
+            current = start
+            target = start.min() if to is None else to
+        elif edge in ('right', 'bottom'):
+            current = start + size
+            target = current.max() if to is None else to
+        else:
+            current = start + size / 2
+            target = (start.min() + (start + size).max()) / 2 if to is None else to
+
+        column = 'x' if horizontal else 'y'
+        self._columns[column][rows] += target - current
+        self._write_back(rows, (column,))
+
+    def absolute_origins(self, layers: Iterable = None):
+        """x and y arrays of the top left corners of layers (all layers if None) in page coordinates."""
+        return self._absolute_origin(self.rows(layers))
+
+    def bounds(self, layers: Iterable = None, absolute=True):
+        """
+        (min_x, min_y, max_x, max_y) of the frames of layers (all layers if None), in page coordinates or relative to
+        their parents, (inf, inf, -inf, -inf) without layers. Each one is an int if it comes from int frame values of its
+        layer, as the min and max of the SJRect values would be.
+        """
+        rows = self.rows(layers)
+        if len(rows) == 0:
+            return np.inf, np.inf, -np.inf, -np.inf
+        if absolute:
+            x, y = self._absolute_origin(rows)
+        else:
+            x, y = self._columns['x'][rows], self._columns['y'][rows]
+        x2 = x + self._columns['width'][rows]
+        y2 = y + self._columns['height'][rows]
+        ints = self._ints
+        i, j, k, m = x.argmin(), y.argmin(), x2.argmax(), y2.argmax()
+        ret = ((x[i], ints['x'][rows[i]]), (y[j], ints['y'][rows[j]]),
+               (x2[k], ints['x'][rows[k]] and ints['width'][rows[k]]),
+               (y2[m], ints['y'][rows[m]] and ints['height'][rows[m]]))
+        return tuple(int(v) if is_int and v.is_integer() else v.item() for v, is_int in ret)
+
+    def at_point(self, x: float, y: float) -> list:
+        """Layers whose frame contains the page coordinate x, y, in row order (parents before their children)."""
+        rows = self.rows()
+        ax, ay = self._absolute_origin(rows)
+        cols = self._columns
+        hit = (ax <= x) & (x <= ax + cols['width'][rows]) & (ay <= y) & (y <= ay + cols['height'][rows])
+        return self.layers_at(rows[hit])
+
+    def overlapping(self, x: float, y: float, width: float, height: float) -> list:
+        """Layers whose frame intersects the rectangle given in page coordinates, in row order."""
+        rows = self.rows()
+        ax, ay = self._absolute_origin(rows)
+        cols = self._columns
+        hit = (ax <= x + width) & (x <= ax + cols['width'][rows]) & \
+              (ay <= y + height) & (y <= ay + cols['height'][rows])
+        return self.layers_at(rows[hit])
+
+    def refresh(self, layers: Iterable = None):
+        """Re-reads the columns from the layers (all layers if None), after frames were assigned directly."""
+        rows = self.rows(layers)
+        for r in rows.tolist():
+            self._load_row(r, self.layers[r])
+        self._notify('change', rows)
+
+    def on_mutation(self, event, obj, container, details):
+        if event == 'add':
+            if container is self._root and self._root is not None:
+                self._add(obj, None, True)
+            elif id(container) in self._rows:
+                self._add(obj, container, True)
+        elif event == 'remove':
+            row = self._rows.get(id(obj))
+            if row is None:
+                return
+            parent = self._parent[row]
+            if parent < 0 and container is self._root or parent >= 0 and self.layers[parent] is container:
+                self._remove(obj)
+
+    def _absolute_origin(self, rows: np.ndarray):
+        n = self._size
+        x, y = self._columns['x'][:n], self._columns['y'][:n]
+        if self._depth[rows].max(initial=0) == 0:
+            return x[rows], y[rows]
+
+        if len(rows) * 4 < n:  # few rows, follow their parents
+            ax, ay = x[rows], y[rows]
+            at = self._parent[rows]
+            while True:
+                up = at >= 0
+                if not up.any():
+                    return ax, ay
+                ax[up] += x[at[up]]
+                ay[up] += y[at[up]]
+                at = np.where(up, self._parent[np.maximum(at, 0)], -1)
+
+        ax, ay = x.copy(), y.copy()
+        parent, depth = self._parent[:n], self._depth[:n]
+        for level in range(1, depth.max() + 1):  # parents always have lower depths than their children
+            at = np.flatnonzero(depth == level)
+            ax[at] += ax[parent[at]]
+            ay[at] += ay[parent[at]]
+        return ax[rows], ay[rows]
+
+    def _add(self, layer, parent, recursive: bool):
+        """Adds layer (and the layers below it if recursive) below the layer parent, at the top level if None."""
+        if id(layer) in self._rows:
+            self._remove(layer)  # might compact, so the row of parent is looked up afterwards
+
+        start = self._size
+        stack = [(layer, -1 if parent is None else self._rows[id(parent)])]
+        while stack:
+            obj, parent = stack.pop()
+            if getattr(obj, 'frame', None) is None:  # unknown layer types are kept as raw dicts
+                continue
+            row = self._append(obj, parent)
+            if recursive and obj.layers:
+                stack.extend((c, row) for c in reversed(obj.layers))
+        if self._observers:
+            self._notify('add', np.arange(start, self._size))
+
+    def _append(self, layer, parent: int) -> int:
+        row = self._size
+        if row == len(self._alive):
+            self._grow()
+        self._size += 1
+        self.layers.append(layer)
+        self._rows[id(layer)] = row
+        self._parent[row] = parent
+        self._depth[row] = 0 if parent < 0 else self._depth[parent] + 1
+        self._alive[row] = True
+        self._load_row(row, layer)
+        return row
+
+    def _load_row(self, row: int, layer):
+        frame = layer.frame
+        cols = self._columns
+        for name, (attr, on_frame) in COLUMNS.items():
+            v = getattr(frame if on_frame else layer, attr)
+            if on_frame:
+                self._ints[name][row] = type(v) is int
+            cols[name][row] = v
+
+    def _grow(self):
+        size = len(self._alive) * 2
+        for name, col in self._columns.items():
+            self._columns[name] = _resized(col, size)
+        self._ints = {name: _resized(col, size) for name, col in self._ints.items()}
+        self._parent = _resized(self._parent, size)
+        self._depth = _resized(self._depth, size)
+        self._alive = _resized(self._alive, size)
+
+    def _remove(self, layer):
+        removed = []
+        stack = [layer]
+        while stack:
+            obj = stack.pop()
+            row = self._rows.pop(id(obj), None)
+            if row is None:
+                continue
+            self.layers[row] = None
+            self._alive[row] = False
+            self._dead += 1
+            removed.append(row)
+            stack.extend(obj.layers or [])
+        self._notify('remove', np.array(removed, dtype=np.int64))
+
+        if self._dead * 2 > self._size:
+            self._compact()
+
+    def _compact(self):
+        n = self._size
+        alive = self._alive[:n]
+        new_row = np.cumsum(alive) - 1
+        keep = np.flatnonzero(alive)
+        parent = self._parent[keep]
+        self._parent[:len(keep)] = np.where(parent < 0, -1, new_row[parent])
+        for arr in list(self._columns.values()) + list(self._ints.values()) + [self._depth, self._alive]:
+            arr[:len(keep)] = arr[keep]
+        self._alive[len(keep):n] = False
+
+        self.layers = [self.layers[r] for r in keep.tolist()]
+        self._rows = {id(l): r for r, l in enumerate(self.layers)}
+        self._size = len(keep)
+        self._dead = 0
+        self._notify('compact', None)
+
+    def _write_back(self, rows: np.ndarray, columns):
+        layers = self.layers
+        rows_list = rows.tolist()
+        frame_columns = [name for name in columns if name in _FRAME_COLUMNS]
+        if frame_columns:
+            frames = [layers[r].frame for r in rows_list]
+            for name in frame_columns:
+                column = self._columns[name][rows]
+                ints = self._ints[name][rows] & (column == np.round(column))
+                self._ints[name][rows] = ints
+                values = column.astype(object)  # python floats
+                values[ints] = column[ints].astype(np.int64)
+                attr = COLUMNS[name][0]
+                for f, v in zip(frames, values.tolist()):
+                    setattr(f, attr, v)
+
+        for name in columns:
+            attr, on_frame = COLUMNS[name]
+            if on_frame:
+                continue
+            for r, v in zip(rows_list, self._columns[name][rows].tolist()):
+                if type(getattr(layers[r], attr)) is int and v.__class__ is float and v.is_integer():
+                    v = int(v)
+                setattr(layers[r], attr, v)
+
+        sketch_types.notify_mutation('frames', None, self._root, layers=[layers[r] for r in rows_list])
+        self._notify('change', rows)
+
+
+def _resized(arr: np.ndarray, size: int) -> np.ndarray:
+    ret = np.zeros(size, dtype=arr.dtype)
+    ret[:len(arr)] = arr
+    return ret
+
+
+class SpatialIndex:
+    """
+    Uniform grid over the page coordinates of the frames in a FrameStore, for hit-testing and region queries.
+
+    The grid is kept as (cell, row) pairs sorted by cell, so the rows of a range of cells are contiguous slices. Rows
+    that were added or moved after the grid was built (including the layers below a moved layer) are kept in an
+    overflow set that every query checks directly, the grid is rebuilt on the next query once the overflow grows past
+    an eighth of the rows. Layers spanning more than MAX_CELLS cells (i.e. artboards) are always checked directly too.
+
+    With within set (an artboard or any other layer of the store) only the layers below it are indexed.
+    """
+    MAX_CELLS = 64
+
+    def __init__(self, frames: FrameStore, within=None):
+        self.frames = frames
+        self.within = within
+        self._member = np.zeros(0, dtype=bool)  # row is indexed
+        self._overflow = np.zeros(0, dtype=bool)  # row is indexed but not (correctly) in the grid
+        self._boxes = np.zeros((4, 0))  # x1, y1, x2, y2 in page coordinates
+        self._changes = 0
+        self._grid = None
+        frames.add_observer(self)
+
+    def __len__(self):
+        self._ensure_built()
+        return int(self._member.sum())
+
+    def query_rect(self, x: float, y: float, width: float, height: float) -> list:
+        """Layers whose frame intersects the rectangle, in the order of the FrameStore rows."""
+        rows = self._candidates(x, y, x + width, y + height)
+        x1, y1, x2, y2 = self._boxes[:, rows]
+        hit = (x1 <= x + width) & (x <= x2) & (y1 <= y + height) & (y <= y2)
+        return self.frames.layers_at(rows[hit])
+
+    def query_point(self, x: float, y: float) -> list:
+        """Layers whose frame contains the point, in the order of the FrameStore rows (parents first)."""
+        return self.query_rect(x, y, 0, 0)
+
+    def query_nearest(self, x: float, y: float, k=1) -> list:
+        """The k layers closest to the point (distance 0 inside their frame), closest first."""
+        self._ensure_built()
+        rows = np.flatnonzero(self._member)
+        if len(rows) == 0:
+            return []
+        x1, y1, x2, y2 = self._boxes[:, rows]
+        dx = np.maximum(np.maximum(x1 - x, x - x2), 0)
+        dy = np.maximum(np.maximum(y1 - y, y - y2), 0)
+        dist = dx * dx + dy * dy
+        k = min(k, len(rows))
+        nearest = np.argpartition(dist, k - 1)[:k]
+        nearest = nearest[np.lexsort((rows[nearest], dist[nearest]))]
+        return self.frames.layers_at(rows[nearest])
+
+    def on_frames(self, event, rows):
+        if event == 'compact' or self._grid is None:
+            self._grid = None
+            return
+
+        self._fit()
+        if event == 'remove':
+            self._member[rows] = False
+            self._overflow[rows] = False
+            self._changes += len(rows)
+            return
+
+        if event == 'change':
+            rows = self._with_descendants(rows)
+        rows = rows[self._inside(rows)]
+        self._member[rows] = True
+        self._overflow[rows] = True
+        self._boxes[:, rows] = self._page_boxes(rows)
+        self._changes += len(rows)
+
+    def _candidates(self, x1, y1, x2, y2) -> np.ndarray:
+        self._ensure_built()
+        origin_x, origin_y, cell, nx, ny, starts, grid_rows, large = self._grid
+
+        parts = [large, np.flatnonzero(self._overflow)]
+        cx1, cx2 = max(int((x1 - origin_x) // cell), 0), min(int((x2 - origin_x) // cell), nx - 1)
+        cy1, cy2 = max(int((y1 - origin_y) // cell), 0), min(int((y2 - origin_y) // cell), ny - 1)
+        if cx1 <= cx2 and cy1 <= cy2:
+            for cy in range(cy1, cy2 + 1):  # the cells of a grid row are contiguous
+                parts.append(grid_rows[starts[cy * nx + cx1]:starts[cy * nx + cx2 + 1]])
+
+        rows = np.unique(np.concatenate(parts))
+        return rows[self._member[rows]]
+
+    def _ensure_built(self):
+        if self._grid is not None and self._changes * 8 <= max(len(self._member), 512):
+            return
+
+        self._fit()
+        frames = self.frames
+        rows = frames.rows()
+        rows = rows[self._inside(rows)]
+        self._member[:] = False
+        self._member[rows] = True
+        self._overflow[:] = False
+        self._boxes[:, rows] = boxes = self._page_boxes(rows)
+        self._changes = 0
+
+        if len(rows) == 0:
+            self._grid = (0.0, 0.0, 1.0, 1, 1, np.zeros(2, dtype=np.int64), rows, rows)
+            return
+
+        x1, y1, x2, y2 = boxes
+        origin_x, origin_y = x1.min(), y1.min()
+        extent = max(x2.max() - origin_x, y2.max() - origin_y, 1e-9)
+        size = np.maximum(x2 - x1, y2 - y1)
+        # about one cell per layer, but no smaller than the typical layer
+        cell = max(extent / np.sqrt(len(rows)), float(np.median(size)), 1e-9)
+        nx = int((x2.max() - origin_x) // cell) + 1
+        ny = int((y2.max() - origin_y) // cell) + 1
+
+        cx1 = ((x1 - origin_x) // cell).astype(np.int64)
+        cy1 = ((y1 - origin_y) // cell).astype(np.int64)
+        wx = ((x2 - origin_x) // cell).astype(np.int64) - cx1 + 1
+        wy = ((y2 - origin_y) // cell).astype(np.int64) - cy1 + 1
+        counts = wx * wy
+        small = counts <= self.MAX_CELLS
+        large = rows[~small]
+
+        rows, cx1, cy1, wx, counts = rows[small], cx1[small], cy1[small], wx[small], counts[small]
+        # one (cell, row) pair for every cell a layer covers
+        pair_rows = np.repeat(rows, counts)
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        wx = np.repeat(wx, counts)
+        cells = (np.repeat(cy1, counts) + offset // wx) * nx + np.repeat(cx1, counts) + offset % wx
+        order = np.argsort(cells, kind='stable')
+        starts = np.searchsorted(cells[order], np.arange(nx * ny + 1))
+        self._grid = (origin_x, origin_y, cell, nx, ny, starts, pair_rows[order], large)
+
+    def _fit(self):
+        size = len(self.frames._alive)
+        if len(self._member) != size:
+            self._member = _resized(self._member, size)
+            self._overflow = _resized(self._overflow, size)
+            boxes = np.zeros((4, size))
+            boxes[:, :self._boxes.shape[1]] = self._boxes[:, :size]
+            self._boxes = boxes
+
+    def _page_boxes(self, rows: np.ndarray) -> np.ndarray:
+        frames = self.frames
+        x, y = frames._absolute_origin(rows)
+        return np.stack([x, y, x + frames._columns['width'][rows], y + frames._columns['height'][rows]])
+
+    def _inside(self, rows: np.ndarray) -> np.ndarray:
+        """Mask of the rows that are below within."""
+        frames = self.frames
+        if self.within is None:
+            return np.ones(len(rows), dtype=bool)
+        root = frames._rows.get(id(self.within))
+        if root is None:
+            return np.zeros(len(rows), dtype=bool)
+        inside = np.zeros(len(rows), dtype=bool)
+        at = frames._parent[rows]
+        while True:
+            up = at >= 0
+            if not up.any():
+                return inside
+            inside |= at == root
+            at = np.where(up, frames._parent[np.maximum(at, 0)], -1)
+
+    def _with_descendants(self, rows: np.ndarray) -> np.ndarray:
+        """rows and the rows of all layers below them, whose page coordinates change with them."""
+        frames = self.frames
+        if not any(frames.layers[r].layers for r in rows.tolist()):
+            return rows
+        moved = np.zeros(frames._size, dtype=bool)
+        moved[rows] = True
+        candidates = np.flatnonzero(frames._alive[:frames._size] & ~moved)
+        below = np.zeros(len(candidates), dtype=bool)
+        at = frames._parent[candidates]
+        while True:
+            up = at >= 0
+            if not up.any():
+                break
+            below |= up & moved[np.maximum(at, 0)]
+            at = np.where(up, frames._parent[np.maximum(at, 0)], -1)
+        return np.concatenate([rows, candidates[below]])
@@ -0,0 +1,273 @@
+"""
+The bitmaps of a file (images/...) as handles that decode on demand, with the decoded arrays held in a cache bounded
+by their size in bytes, and the references to them in the objects of a file.
+"""
+import base64
+import hashlib
+import json
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from enum import Enum
+from io import BytesIO
+from typing import Callable, Dict, Iterator, Set, Union
+
+import numpy as np
+from PIL import Image
+
+from . import sketch_types
+
+DEFAULT_CACHE_BYTES = 256 << 20
+
+
+class ImageCache:
+    """Decoded arrays of image handles, the least recently used ones are dropped above max_bytes."""
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self._max_bytes = max_bytes
+        self.nbytes = 0
+        self._arrays: 'OrderedDict[ImageHandle, np.ndarray]' = OrderedDict()
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value: int):
+        self._max_bytes = value
+        self._evict()
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def __contains__(self, handle):
+        return handle in self._arrays
+
+    def get(self, handle: 'ImageHandle') -> np.ndarray:
+        array = self._arrays.get(handle)
+        if array is not None:
+            self._arrays.move_to_end(handle)
+            return array
+        array = handle.decode()
+        self.put(handle, array)
+        return array
+
+    def put(self, handle: 'ImageHandle', array: np.ndarray):
+        self.discard(handle)
+        self._arrays[handle] = array
+        self.nbytes += array.nbytes
+        self._evict()
+
+    def _evict(self):
+        while self.nbytes > self._max_bytes and len(self._arrays) > 1:  # the newest one is kept in any case
+            _, evicted = self._arrays.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def discard(self, handle: 'ImageHandle'):
+        array = self._arrays.pop(handle, None)
+        if array is not None:
+            self.nbytes -= array.nbytes
+
+    def clear(self):
+        self._arrays.clear()
+        self.nbytes = 0
+
+
+class ImageHandle:
+    """
+    An image of a file. The stored bytes (png, jpg, ...) are held or read from the archive when needed, the decoded
+    array is held by the cache. Arrays from decoding are read-only, an image is modified by assigning array, which
+    keeps the new array until the file is saved to a path.
+    """
+    __slots__ = ('name', '_data', '_read', '_array', '_cache', '_sha1')
+
+    def __init__(self, name: str, cache: ImageCache, data: bytes = None, read: Callable[[str], bytes] = None,
+                 array: np.ndarray = None):
+        self.name = name
+        self._cache = cache
+        self._data = data
+        self._read = read  # entry name -> stored bytes, if data is not held
+        self._array = array
+        self._sha1 = None
+
+    def __repr__(self):
+        state = 'modified' if self.modified else 'decoded' if self in self._cache else 'encoded'
+        return 'ImageHandle(%s, %s)' % (self.name, state)
+
+    @property
+    def modified(self) -> bool:
+        return self._array is not None
+
+    @property
+    def is_decoded(self) -> bool:
+        return self.modified or self in self._cache
+
+    @property
+    def data(self) -> bytes:
+        """The stored bytes, None for a modified image."""
+        if self._array is not None:
+            return None
+        return self._data if self._data is not None else self._read(self.name)
+
+    @property
+    def array(self) -> np.ndarray:
+        """The image as rows, columns and channels, decoded on first access."""
+        if self._array is not None:
+            return self._array
+        return self._cache.get(self)
+
+    @array.setter
+    def array(self, value: np.ndarray):
+        self._cache.discard(self)
+        self._array = value
+        self._sha1 = None
+
+    @property
+    def sha1(self) -> bytes:
+        """The sha1 digest of the stored bytes, computed once, None for a modified image."""
+        if self._array is not None:
+            return None
+        if self._sha1 is None:
+            self._sha1 = hashlib.sha1(self.data).digest()
+        return self._sha1
+
+    def content_key(self) -> tuple:
+        """Equal for images with the same stored bytes, respectively for modified images with the same pixels."""
+        if self._array is None:
+            return 'stored', self.sha1
+        array = np.ascontiguousarray(self._array)
+        return 'array', array.shape, array.dtype.str, hashlib.sha1(array.data).digest()
+
+    @property
+    def content(self) -> Union[np.ndarray, 'ImageHandle']:
+        """What is written for the image, the array of a modified image and the handle (its stored bytes) otherwise."""
+        return self._array if self._array is not None else self
+
+    def decode(self, data: bytes = None) -> np.ndarray:
+        """Decodes the stored bytes, or data if given, to a read-only array."""
+        array = np.asarray(Image.open(BytesIO(self.data if data is None else data)))
+        array.setflags(write=False)
+        return array
+
+    def stored(self, read: Callable[[str], bytes]):
+        """Records that the image was saved to an archive that read reads it from, a modified array is released."""
+        if self._array is not None:
+            array, self._array = self._array, None
+            array.setflags(write=False)  # stands for the stored image now, as a decoded one
+            self._cache.put(self, array)
+            self._data = None
+            self._sha1 = None
+        self._read = read
+
+
+class ImageStore(MutableMapping):
+    """
+    Images by entry name. Arrays and bytes assigned to a name are wrapped into (modified, respectively encoded)
+    handles, handles are kept as they are.
+    """
+
+    def __init__(self, cache: ImageCache = None):
+        self.cache = ImageCache() if cache is None else cache
+        self._handles: Dict[str, ImageHandle] = {}
+
+    def add(self, name: str, data: bytes = None, read: Callable[[str], bytes] = None) -> ImageHandle:
+        """Adds the stored image name, held as data or read when needed."""
+        handle = self._handles[name] = ImageHandle(name, self.cache, data=data, read=read)
+        return handle
+
+    def duplicates(self) -> Dict[str, str]:
+        """
+        The names of images with the same content as another one -> the name of that one. Stored images are compared
+        by their bytes and kept over modified ones, which are compared by their pixels. Otherwise the first name is
+        kept.
+        """
+        kept: Dict[tuple, str] = {}
+        ret = {}
+        for handle in sorted(self._handles.values(), key=lambda h: h.modified):
+            key = handle.content_key()
+            if key in kept:
+                ret[handle.name] = kept[key]
+            else:
+                kept[key] = handle.name
+        return ret
+
+    def __getitem__(self, name: str) -> ImageHandle:
+        return self._handles[name]
+
+    def __setitem__(self, name: str, value: Union[ImageHandle, np.ndarray, bytes]):
+        old = self._handles.get(name)
+        if old is not None:
+            self.cache.discard(old)
+        if isinstance(value, ImageHandle):
+            handle = value
+        elif isinstance(value, np.ndarray):
+            handle = ImageHandle(name, self.cache, array=value)
+        else:
+            handle = ImageHandle(name, self.cache, data=bytes(value))
+        self._handles[name] = handle
+
+    def __delitem__(self, name: str):
+        self.cache.discard(self._handles.pop(name))
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._handles)
+
+    def __len__(self):
+        return len(self._handles)
+
+
+def rewrite_refs(root, renamed: Dict[str, str], sha1s: Dict[str, bytes] = None) -> bool:
+    """
+    Points the references (objects and dicts with a _ref, i.e. fills, bitmap layers and image overrides) below root
+    to the images in renamed at the names they map to. With sha1s (name -> digest), the sha1 of data references
+    (MSJSONOriginalDataReference) is set to that of the image they refer to. Fields are only assigned if their value
+    changes. Returns whether anything changed.
+    """
+    changed = False
+    stack = [root]
+    while stack:
+        o = stack.pop()
+        if isinstance(o, dict):
+            fields = o
+        elif isinstance(o, list):
+            stack.extend(o)
+            continue
+        elif hasattr(o, '__dict__') and not isinstance(o, Enum):
+            fields = o.__dict__
+        else:
+            continue
+
+        ref = fields.get('_ref')
+        if isinstance(ref, str):
+            if ref in renamed:
+                ref = fields['_ref'] = renamed[ref]
+                changed = True
+            if sha1s is not None and ref in sha1s and fields.get('_class') == 'MSJSONOriginalDataReference':
+                changed |= _set_sha1(fields, base64.b64encode(sha1s[ref]).decode('ascii'))
+        stack.extend(v for k, v in fields.items() if k not in sketch_types.TRANSIENT_FIELDS)
+    return changed
+
+
+def json_forms(text: str) -> Set[bytes]:
+    """
+    The byte strings text can be written as inside a json string: as it is or with \\u escapes, each with plain and
+    with escaped slashes (images\\/x.png, as Sketch writes them).
+    """
+    forms = set()
+    for encoded in (json.dumps(text, ensure_ascii=False)[1:-1], json.dumps(text)[1:-1]):
+        forms.add(encoded.encode('utf-8'))
+        forms.add(encoded.replace('/', '\\/').encode('utf-8'))
+    return forms
+
+
+def _set_sha1(fields, encoded: str) -> bool:
+    sha1 = fields.get('sha1')
+    current = sha1.get('_data') if isinstance(sha1, dict) else getattr(sha1, '_data', None)
+    if current == encoded:
+        return False
+    if isinstance(sha1, dict):
+        sha1['_data'] = encoded
+    else:
+        value = sketch_types.SJImageDataReference_sha1()
+        value._data = encoded
+        fields['sha1'] = value
+    return True
@@ -0,0 +1,443 @@
+"""
+Indexes over the layer trees and symbols of a SketchFile, kept up to date by the mutation helpers of sketch_types and
+sketch_api.
+"""
+import bisect
+import warnings
+from typing import Dict, List, Any
+
+from . import sketch_types
+
+ARTBOARD_CLASSES = {'artboard', 'symbolMaster'}
+
+
+class DocumentIndex:
+    """
+    Maps the pages and layers of a file by do_objectID, _class and name, and every one of them to its parent, page
+    and artboard. Built once from the loaded pages (loading lazy pages and layers), then updated incrementally by
+    add_layer, remove_layer, set_name, add_artboard, remove_artboard, group_coords, add_page and remove_page.
+    Attributes assigned directly (i.e. layer.name = ...) are not tracked.
+    """
+
+    def __init__(self, file=None):
+        self._file = file
+        # id(obj) -> (obj, parent, page, artboard, name it is indexed under)
+        self._info: Dict[int, tuple] = {}
+        self._by_id: Dict['sketch_types.SJObjectId', Any] = {}
+        self._by_class: Dict[str, Dict[int, Any]] = {}
+        self._by_name: Dict[str, Dict[int, Any]] = {}
+
+        if file is not None:
+            for page in file.sketch_pages:
+                self.add(page.load() if hasattr(page, 'load') else page, file)
+        sketch_types.add_mutation_listener(self, file)
+
+    def __len__(self):
+        return len(self._info)
+
+    def __contains__(self, obj):
+        return id(obj) in self._info
+
+    def get(self, object_id: 'sketch_types.SJObjectId'):
+        return self._by_id.get(object_id)
+
+    def by_class(self, cls: str) -> List[Any]:
+        return list(self._by_class.get(cls, {}).values())
+
+    def by_name(self, name: str) -> List[Any]:
+        return list(self._by_name.get(name, {}).values())
+
+    def parent_of(self, obj):
+        """The layer or page whose layers contain obj, the file for pages."""
+        return self._info[id(obj)][1]
+
+    def page_of(self, obj) -> 'sketch_types.SketchPage':
+        return self._info[id(obj)][2]
+
+    def artboard_of(self, obj):
+        """The artboard or symbol master obj is part of (obj itself for artboards), None for layers outside of one."""
+        return self._info[id(obj)][3]
+
+    def add(self, layer, parent):
+        """Indexes layer and everything below it as a child of parent (re-indexing it if it was indexed elsewhere)."""
+        if id(layer) in self._info:
+            self.remove(layer)
+
+        if parent is self._file and self._file is not None:
+            page, artboard = None, None
+        else:
+            _, _, page, artboard, _ = self._info[id(parent)]
+
+        stack = [(layer, parent, page, artboard)]
+        while stack:
+            obj, parent, page, artboard = stack.pop()
+            if not hasattr(obj, '__dict__'):  # unknown layer types are kept as raw dicts
+                continue
+            if page is None:
+                page = obj
+            if getattr(obj, '_class', None) in ARTBOARD_CLASSES:
+                artboard = obj
+            self._insert(obj, parent, page, artboard)
+            layers = getattr(obj, 'layers', None)
+            if layers:
+                stack.extend((c, obj, page, artboard) for c in reversed(layers))
+
+    def remove(self, layer):
+        """Removes layer and everything below it."""
+        stack = [layer]
+        while stack:
+            obj = stack.pop()
+            if self._drop(obj):
+                stack.extend(getattr(obj, 'layers', None) or [])
+
+    def on_mutation(self, event, obj, container, details):
+        if event == 'add':
+            if container is self._file and self._file is not None or id(container) in self._info:
+                self.add(obj, container)
+        elif event == 'remove':
+            info = self._info.get(id(obj))
+            if info is not None and info[1] is container:
+                self.remove(obj)
+        elif event == 'rename':
+            info = self._info.get(id(obj))
+            if info is not None:
+                _discard(self._by_name, info[4], obj)
+                self._by_name.setdefault(obj.name, {})[id(obj)] = obj
+                self._info[id(obj)] = info[:4] + (obj.name,)
+
+    def _insert(self, obj, parent, page, artboard):
+        name = getattr(obj, 'name', None)
+        self._info[id(obj)] = (obj, parent, page, artboard, name)
+        oid = getattr(obj, 'do_objectID', None)
+        if oid is not None:
+            self._by_id[oid] = obj
+        self._by_class.setdefault(getattr(obj, '_class', None), {})[id(obj)] = obj
+        self._by_name.setdefault(name, {})[id(obj)] = obj
+
+    def _drop(self, obj) -> bool:
+        info = self._info.pop(id(obj), None)
+        if info is None:
+            return False
+        oid = getattr(obj, 'do_objectID', None)
+        if self._by_id.get(oid) is obj:
+            del self._by_id[oid]
+        _discard(self._by_class, getattr(obj, '_class', None), obj)
+        _discard(self._by_name, info[4], obj)
+        return True
+
+
+def _discard(index: Dict[Any, Dict[int, Any]], key, obj):
+    bucket = index.get(key)
+    if bucket is not None:
+        bucket.pop(id(obj), None)
+        if not bucket:
+            del index[key]
+
+
+LOCAL = 'local'  # symbol masters on the pages of the file
+FOREIGN = 'foreign'  # originalMaster of the foreign symbols of the document
+LINKED = 'linked'  # symbolMaster of the foreign symbols, the copy used in the file
+
+
+class SymbolRegistry:
+    """
+    Symbol masters of a file by symbolID, do_objectID and name. Local masters are found anywhere below the pages and
+    follow add_layer, remove_layer, add_artboard, remove_artboard, set_name, add_page and remove_page. Foreign symbols
+    are re-read whenever sketch_document.foreignSymbols was replaced or changed its length. Ids and names assigned
+    directly are not tracked.
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self._seq = 0
+        # id(master) -> (order, master, kind, name, ids)
+        self._entries: Dict[int, tuple] = {}
+        self._by_id: Dict['sketch_types.SJObjectId', Dict[int, Any]] = {}
+        self._by_name: Dict[str, Dict[int, Any]] = {}
+        self._sorted_names = None
+        self._containers = set()  # ids of the pages and layers with sub-layers that are part of the file
+        self._foreign = None  # (list, length) the foreign symbols were read from
+
+        for page in file.sketch_pages:
+            if page is not None:
+                self._add_tree(page.load() if hasattr(page, 'load') else page)
+        self._sync_foreign()
+        sketch_types.add_mutation_listener(self, file)
+
+    def __len__(self):
+        self._sync_foreign()
+        return len(self._entries)
+
+    def get(self, object_id: 'sketch_types.SJObjectId'):
+        """The master with this symbolID or do_objectID, local and foreign masters before linked ones."""
+        self._sync_foreign()
+        bucket = self._by_id.get(object_id)
+        if not bucket:
+            return None
+        if len(bucket) == 1:
+            for master in bucket.values():
+                return master
+        return min((self._entries[k] for k in bucket), key=lambda e: (e[2] == LINKED, e[0]))[1]
+
+    def available(self) -> list:
+        """Local masters and the original masters of foreign symbols."""
+        return self._select(self._entries.keys(), (LOCAL, FOREIGN))
+
+    def linked(self) -> list:
+        return self._select(self._entries.keys(), (LINKED,))
+
+    def by_name(self, name: str, kinds=(LOCAL, FOREIGN, LINKED)) -> list:
+        return self._select(self._by_name.get(name, ()), kinds)
+
+    def with_prefix(self, prefix: str, kinds=(LOCAL, FOREIGN, LINKED)) -> list:
+        self._sync_foreign()
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self._by_name)
+        names = self._sorted_names
+        keys = []
+        for i in range(bisect.bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix):
+                break
+            keys.extend(self._by_name[names[i]])
+        return self._select(keys, kinds)
+
+    def containing(self, text: str, kinds=(LOCAL, FOREIGN, LINKED)) -> list:
+        self._sync_foreign()
+        keys = [k for name, bucket in self._by_name.items() if text in name for k in bucket]
+        return self._select(keys, kinds)
+
+    def on_mutation(self, event, obj, container, details):
+        if event == 'add':
+            if container is self._file or id(container) in self._containers:
+                self._add_tree(obj)
+        elif event == 'remove':
+            if container is self._file or id(container) in self._containers:
+                self._remove_tree(obj)
+        elif event == 'rename':
+            entry = self._entries.get(id(obj))
+            if entry is not None:
+                self._drop(obj)
+                self._insert(obj, entry[2], entry[0])
+
+    def _select(self, keys, kinds) -> list:
+        self._sync_foreign()
+        entries = sorted(self._entries[k] for k in keys if self._entries[k][2] in kinds)
+        return [e[1] for e in entries]
+
+    def _add_tree(self, root):
+        stack = [root]
+        while stack:
+            l = stack.pop()
+            if l is None or not hasattr(l, '__dict__'):  # unknown layer types are kept as raw dicts
+                continue
+            if getattr(l, '_class', None) == 'symbolMaster':
+                self._insert(l, LOCAL)
+            layers = getattr(l, 'layers', None)
+            if layers is not None:
+                self._containers.add(id(l))
+                stack.extend(reversed(layers))
+
+    def _remove_tree(self, root):
+        stack = [root]
+        while stack:
+            l = stack.pop()
+            if l is None or not hasattr(l, '__dict__'):
+                continue
+            if id(l) in self._entries and self._entries[id(l)][2] == LOCAL:
+                self._drop(l)
+            self._containers.discard(id(l))
+            stack.extend(getattr(l, 'layers', None) or [])
+
+    def _sync_foreign(self):
+        foreign = self._file.sketch_document.foreignSymbols
+        if self._foreign is not None and self._foreign[0] is foreign and self._foreign[1] == len(foreign):
+            return
+
+        for entry in list(self._entries.values()):
+            if entry[2] != LOCAL:
+                self._drop(entry[1])
+        for s in foreign:
+            self._insert(s.originalMaster, FOREIGN)
+        for s in foreign:
+            self._insert(s.symbolMaster, LINKED)
+        self._foreign = (foreign, len(foreign))
+
+    def _insert(self, master, kind, order=None):
+        if master is None:
+            return
+        if id(master) in self._entries:  # i.e. the same object as original and linked master
+            return
+        if order is None:
+            order = self._seq
+            self._seq += 1
+        ids = {master.symbolID, master.do_objectID} - {None}
+        self._entries[id(master)] = (order, master, kind, master.name, ids)
+        for i in ids:
+            self._by_id.setdefault(i, {})[id(master)] = master
+        if master.name not in self._by_name:
+            self._sorted_names = None
+        self._by_name.setdefault(master.name, {})[id(master)] = master
+
+    def _drop(self, master):
+        _, _, _, name, ids = self._entries.pop(id(master))
+        for i in ids:
+            _discard(self._by_id, i, master)
+        _discard(self._by_name, name, master)
+        if name not in self._by_name:
+            self._sorted_names = None
+
+
+class SymbolCycleWarning(UserWarning):
+    """A symbol master contains an instance of itself (directly or through other masters), the instance closing the
+    cycle is not expanded."""
+
+    def __init__(self, master, instance):
+        super().__init__('Symbol %r (%s) contains an instance of itself' % (master.name, master.symbolID))
+        self.master = master
+        self.instance = instance
+
+
+class MasterCache:
+    """
+    Base for results computed per symbol master. Results of a master are dropped, together with those of every master
+    nesting an instance of it, when layers are added to or removed from its tree or the overrides of an instance in
+    its tree change. Everything is dropped when symbol masters or pages are added or removed.
+
+    Subclasses register the layers of a master's tree with _own, nested masters with _use, store their results with
+    _keep and drop them in _forget.
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self._masters: Dict[int, Any] = {}  # masters with results
+        self._owner: Dict[int, int] = {}  # id(master, group or instance in its tree) -> id(master)
+        self._users: Dict[int, set] = {}  # id(master) -> ids of the masters that contain instances of it
+        sketch_types.add_mutation_listener(self, file)
+
+    def invalidate(self, master=None):
+        """Drops the results of master and of the masters that nest it, of all masters if None."""
+        if master is None:
+            for mid in list(self._masters):
+                self._forget(mid)
+            self._masters.clear()
+            self._owner.clear()
+            self._users.clear()
+            return
+
+        stack = [id(master)]
+        while stack:
+            mid = stack.pop()
+            if self._masters.pop(mid, None) is None:
+                continue
+            self._forget(mid)
+            stack.extend(self._users.pop(mid, ()))
+
+    def on_mutation(self, event, obj, container, details):
+        if event == 'override':
+            owner = self._owner.get(id(obj))
+        elif event in ('add', 'remove'):
+            if container is self._file or _contains_master(obj):
+                self.invalidate()
+                return
+            owner = self._owner.get(id(container))
+        else:
+            return
+        master = self._masters.get(owner)
+        if master is not None:
+            self.invalidate(master)
+
+    def _own(self, master, layer):
+        self._owner[id(layer)] = id(master)
+
+    def _use(self, master, nested):
+        self._users.setdefault(id(nested), set()).add(id(master))
+
+    def _keep(self, master):
+        self._masters[id(master)] = master
+
+    def _forget(self, mid: int):
+        """Drops the stored results of the master with id mid, overridden by the subclasses that store any."""
+
+
+class SymbolExpansion(MasterCache):
+    """
+    Flattened descendants of symbol masters, as used by find_layers. The layers of a master and those of the masters
+    of nested symbol instances are walked once per master and class, nested masters are expanded once and their
+    results composed with the path of each instance.
+    """
+
+    def __init__(self, file):
+        super().__init__(file)
+        self._matches: Dict[int, Dict[str, list]] = {}  # id(master) -> cls -> relative paths (tuples of layers)
+        self._images: Dict[int, set] = {}  # id(master) -> image refs of fills in its expanded tree
+
+    def find(self, master, cls: str, images_to_copy: set = None):
+        """Yields the path (list of layers below master) of every layer of class cls, in depth-first order."""
+        paths, images = self._expand(master, cls, [], set())
+        if images_to_copy is not None:
+            images_to_copy.update(images)
+        for path in paths:
+            yield list(path)
+
+    def _forget(self, mid: int):
+        self._matches.pop(mid, None)
+        self._images.pop(mid, None)
+
+    def _expand(self, master, cls: str, stack: list, partial: set):
+        """
+        (paths, images) of master. stack holds the masters being expanded, masters on a cycle are marked in partial
+        instead of being cached.
+        """
+        mid = id(master)
+        if cls in self._matches.get(mid, ()):
+            return self._matches[mid][cls], self._images[mid]
+
+        stack.append(master)
+        paths, images = [], set()
+        walk = [(l, ()) for l in reversed(master.layers or [])]
+        self._own(master, master)
+        while walk:
+            l, parent_path = walk.pop()
+            path = parent_path + (l,)
+            fills = getattr(getattr(l, 'style', None), 'fills', None)
+            if fills is not None:
+                images.update(f.image._ref for f in fills if f.image is not None)
+            c = getattr(l, '_class', None)
+            if c == cls:
+                paths.append(path)
+            if c == 'symbolInstance':
+                ref = self._file.get_symbol_by_id(l.symbolID)
+                if ref is not None and ref.layers is not None:
+                    if any(ref is s for s in stack):
+                        warnings.warn(SymbolCycleWarning(ref, l), stacklevel=4)
+                        # the results of all masters on the cycle depend on where the expansion started
+                        i = next(i for i, s in enumerate(stack) if s is ref)
+                        partial.update(id(s) for s in stack[i:])
+                    else:
+                        nested, nested_images = self._expand(ref, cls, stack, partial)
+                        paths.extend(path + p for p in nested)
+                        images |= nested_images
+                        self._use(master, ref)
+            layers = getattr(l, 'layers', None)
+            if layers:
+                self._own(master, l)
+                walk.extend((child, path) for child in reversed(layers))
+        stack.pop()
+
+        if mid in partial:
+            partial.discard(mid)
+        else:
+            self._keep(master)
+            self._matches.setdefault(mid, {})[cls] = paths
+            self._images[mid] = images
+        return paths, images
+
+
+def _contains_master(layer) -> bool:
+    stack = [layer]
+    while stack:
+        l = stack.pop()
+        if getattr(l, '_class', None) == 'symbolMaster':
+            return True
+        stack.extend(getattr(l, 'layers', None) or [])
+    return False
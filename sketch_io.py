@@ -1,73 +1,28 @@
 import json
-import os
+from contextlib import contextmanager
+from enum import Enum
 from json import JSONEncoder
+from operator import attrgetter
+from types import MappingProxyType
 from typing import Dict, Any, List
 
+from . import sketch_compact
+from . import sketch_decoders
+from . import sketch_schema
 from . import sketch_types
 
-with open(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'sketch_types.py'), 'r') as f:
-    lines = f.readlines()
-
 
 class SketchToPy:
-    type_map_ext = {}
-    type_map = {}
-
-    @classmethod
-    def _get_type(cls, cls_name, field):
-        if cls_name in cls.type_map_ext and field in cls.type_map_ext[cls_name]:
-            return cls.type_map_ext[cls_name][field]
-
-        is_right = False
-        for l in lines:
-            if 'class %s(' % cls_name in l or 'class %s:' % cls_name in l:
-                is_right = True
-
-                if '(' in l and ')' in l:  # extends
-                    tt = cls._get_type(l.split('(')[1].split(')')[0].strip(), field)
-                    if tt is not None:
-                        if cls_name not in cls.type_map_ext:
-                            cls.type_map_ext[cls_name] = {}
-                        cls.type_map_ext[cls_name][field] = tt
-                        return tt
-            elif 'class ' in l and ':' in l:
-                is_right = False
-
-            if is_right and 'self.%s:' % field in l:
-                if ':' not in l:
-                    if '[]' in l:
-                        cls.type_map_ext[cls_name][field] = 'list'
-                        return 'list'
-                    if '{}' in l:
-                        cls.type_map_ext[cls_name][field] = 'dict'
-                        return 'dict'
-                dtype = l.split(':')[1].split('=')[0].strip()
-                tt = cls.get_full_type(dtype)
-                if cls_name not in cls.type_map_ext:
-                    cls.type_map_ext[cls_name] = {}
-                cls.type_map_ext[cls_name][field] = tt
-                return tt
-
-        if cls_name not in cls.type_map_ext:
-            cls.type_map_ext[cls_name] = {}
-        cls.type_map_ext[cls_name][field] = None
-        return None
-
-    @classmethod
-    def get_full_type(cls, ttype):
-        if ttype in ['int', 'str', 'bool', 'float', 'list', 'dict']:
-            return ttype
-
-        for l in lines:
-            if 'class' in l and ' ' + ttype in l and ':' in l:
-                return ttype
-            if ttype + ' ' in l and '=' in l and ':' not in l:
-                return l.split('=')[1].strip()
-
-        return ttype
-
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, lazy_layers=False, compact=False):
+        """
+        With lazy_layers, only the layers directly on a page are converted while parsing, deeper layer lists are
+        converted on first access (see sketch_decoders.LazyLayerList). Use get_objects_by_id / get_objects_by_class
+        instead of the maps to also find objects that were not converted yet. Has no effect in debug mode.
+
+        With compact, objects are created as their __slots__ based variants (see sketch_compact).
+        """
         self.debug = debug
+        self.compact = compact
         if self.debug:
             print('Debugging...')
 
@@ -76,190 +31,213 @@ class SketchToPy:
 
         self._observed_fields_map: Dict[str, set] = {}
 
-    def parse_meta(self, meta_contents):
-        # pprint(meta_contents)
-        meta = self.js_to_py(sketch_types.SketchMeta, meta_contents, p='meta.json')
-        return meta
+        self._schema = sketch_schema.get_schema()
+        self._engine = sketch_decoders.get_engine(lazy_layers, compact)
 
-    @classmethod
-    def _eval(cls, ttype):
-        if ttype in cls.type_map:
-            return cls.type_map[ttype]
-        else:
-            r = eval(ttype)
-            cls.type_map[ttype] = r
-            return r
+        # entry name -> objects converted for it while recording (None if unknown), see sketch_changes
+        self.registries: Dict[str, List[Any]] = {}
+        self._decoded: List[Any] = None
 
-    @classmethod
-    def str_to_type(cls, ttype):
-        ttype = ttype.strip()
-        ttype = ttype.replace('python_sketch_api.', '')
-        ftype = 'sketch_types.' + ttype if 'sketch_types.' not in ttype else ttype
+        self._lazy_unindexed: List[sketch_decoders.LazyLayerList] = []
+        self._lazy_covering = 0
+        self._lazy_ids: Dict[sketch_types.SJObjectId, List[tuple]] = None
+        self._lazy_classes: Dict[str, List[tuple]] = None
 
-        if ttype in ['str', 'list', 'dict', 'float', 'int', 'bool']:
-            return cls._eval(ttype)
+    @contextmanager
+    def recording(self, entry: str):
+        """Records the objects converted in the block (and later in its lazy layer lists) in registries[entry]."""
+        objects, previous = [], self._decoded
+        self._decoded = objects
+        try:
+            yield objects
+        finally:
+            self._decoded = previous
+        self.registries[entry] = None if self.debug else objects  # the generic path does not record
+
+    def merge_maps(self, object_maps, class_maps):
+        """Appends the lookup maps of another parser, i.e. of a page converted in a worker process."""
+        for k, v in object_maps.items():
+            self._object_maps.setdefault(k, []).extend(v)
+        for k, v in class_maps.items():
+            self._class_maps.setdefault(k, []).extend(v)
+
+    def get_objects_by_id(self, sid) -> List[Any]:
+        self._index_lazy()
+        for chain in self._lazy_ids.pop(sid, []):
+            self._resolve_lazy(chain)
+        return self._object_maps[sid]
+
+    def get_objects_by_class(self, cls: str) -> List[Any]:
+        self._index_lazy()
+        for chain in self._lazy_classes.pop(cls, []):
+            self._resolve_lazy(chain)
+        return self._class_maps[cls]
+
+    def _index_lazy(self):
+        """Records for every object in the layer lists that are not yet converted the raw layer dicts leading to it."""
+        if self._lazy_ids is None:
+            self._lazy_ids = {}
+            self._lazy_classes = {}
+
+        pending, self._lazy_unindexed = self._lazy_unindexed, []
+        for lst in pending:
+            if not lst.is_materialized:
+                lst._indexed = True
+                for raw in list.__iter__(lst):
+                    self._scan_lazy(raw, (lst, raw))
+
+    def _scan_lazy(self, node, chain):
+        if type(node) is list:
+            for v in node:
+                self._scan_lazy(v, chain)
+            return
+        if type(node) is not dict:
+            return
 
-        return cls._eval(ftype)
+        sid = None
+        if 'do_objectID' in node:
+            sid = node['do_objectID']
+        if 'sharedObjectID' in node:
+            sid = node['sharedObjectID']
+        if 'symbolID' in node:
+            sid = node['symbolID']
+        if sid is not None:
+            self._lazy_ids.setdefault(sid, []).append(chain)
+        if '_class' in node:
+            self._lazy_classes.setdefault(node['_class'], []).append(chain)
+
+        for k, v in node.items():
+            if k == 'layers' and type(v) is list:
+                for child in v:
+                    self._scan_lazy(child, chain + (child,))
+            elif type(v) is dict or type(v) is list:
+                self._scan_lazy(v, chain)
+
+    @staticmethod
+    def _resolve_lazy(chain):
+        lst = chain[0]
+        for i, raw in enumerate(chain[1:]):
+            lst.materialize()
+            if i == len(chain) - 2 or lst._origin is None:
+                return
+            lst = getattr(lst._origin.get(id(raw)), 'layers', None)
+            if not isinstance(lst, sketch_decoders.LazyLayerList):
+                return
 
-    def js_to_py_dict(self, ft, js, d, p):
-        if 'Dict[' not in ft:
+    def parse_meta(self, meta_contents):
+        # pprint(meta_contents)
+        meta = self.js_to_py(sketch_types.SketchMeta, meta_contents, p='meta.json')
+        return meta
+
+    def js_to_py_dict(self, ft: 'sketch_schema.FieldType', js, d, p):
+        if ft.value is None:
             return js
         else:
-            is_union = False
-
-            if 'Union' in ft:
-                keytype, valtype = ft.split('Dict[')[1].replace(']]', ']').split(',', 1)
-                keytype = self.str_to_type(keytype)
-                dn = {}
+            keytype = ft.key.py if ft.key.kind == sketch_schema.FieldType.SCALAR else None
 
-                for sk, sv in js.items():
-                    # print(valtype)
-                    skk = keytype(sk)
-                    dn[skk] = self.js_to_union(valtype, sv, d=d + 1, p=p + '.' + sk)
-                    # dn[skk] = js_to_py(valtype, sv, d=d + 1, p=p + '.' + sk)
-
-                return dn
-            else:
-                keytype, valtype = ft.split('Dict[')[1].replace(']', '').split(',')
-                keytype = self.str_to_type(keytype)
-                valtype = self.str_to_type(valtype)
+            dn = {}
 
-                dn = {}
+            for sk, sv in js.items():
+                skk = keytype(sk) if keytype is not None else sk
+                dn[skk] = self._decode(ft.value, sv, d=d + 1, p=p + '.' + sk)
 
-                for sk, sv in js.items():
-                    # print(valtype)
-                    skk = keytype(sk)
+            return dn
 
-                    # dn[skk] = js_to_union(valtype, sv, d=d + 1, p=p + '.' + sk)
-                    dn[skk] = self.js_to_py(valtype, sv, d=d + 1, p=p + '.' + sk)
-
-                return dn
-
-    def js_to_py_list(self, ft, js, d, p):
-        if 'List' not in ft:
+    def js_to_py_list(self, ft: 'sketch_schema.FieldType', js, d, p):
+        if ft.item is None:
             return js
         else:
-            keytype = ft.split('List[')[1].split(']')[0]
-            keytype = self.str_to_type(keytype)
-
             dret = []
             for _, v in enumerate(js):
-                dret.append(self.js_to_py(keytype, v, d=d + 1, p=p + '[%d]' % _))
+                dret.append(self._decode(ft.item, v, d=d + 1, p=p + '[%d]' % _))
 
             return dret
 
-    def js_to_union(self, ft, js, d, p):
-        avtypes = ft.split('Union[')[1].split(']')[0].split(',')
-        for av in avtypes:
-            av = av.strip()
-            if av == 'str':
-                if type(js) is str:
-                    return js
-                continue
-            if av == 'dict' and type(js) is dict:
-                return js
-            avt = self.str_to_type(av)
-            if 'typing.Dict' in str(avt) and type(js) == dict:
-                if '_class' in js:
-                    continue
-                if 'symbolID' in js:
-                    continue
-                else:
-                    return self.js_to_py(avt, js, d, p)
-
-            test = avt().__dict__
-            if '_class' in js and '_class' in test and js['_class'] == test['_class']:
-                return self.js_to_py(avt, js, d, p)
-            elif 'symbolID' in test and 'SymbolOverride' in av:
-                return self.js_to_py(avt, js, d, p)
-        print('Unknown value %s for union type %s at %s' % (js, ft, p))
-        return js
+    def js_to_union(self, ft: 'sketch_schema.FieldType', js, d, p):
+        member = self._schema.union_dispatch(ft).resolve(js)
+        if member is None:
+            sketch_schema.report_unknown_value(ft, js, p)
+            return js
+        return self._decode(member, js, d, p)
 
     def js_to_py(self, cls, js, d=0, p=''):
-        x = str(cls)
+        ft = self._schema.field_type_for(cls)
+        if self.debug:  # the generic path reports missing and unknown properties
+            return self._decode(ft, js, d, p)
+        return self._engine.decode(ft, js, self, p)
+
+    def _decode(self, ft: 'sketch_schema.FieldType', js, d=0, p=''):
+        kind = ft.kind
 
-        if 'typing.Union' in x:
-            return self.js_to_union(x, js, d, p)
-        if 'NewType' in x:
-            return cls(js)
-        if 'dict' in x or 'Dict' in x:
-            return self.js_to_py_dict(x, js, d, p)
-        elif cls is list:
-            ret = js
-        elif 'Enum' in x or 'enum' in x:
-            return cls(js)
-        elif 'float' in x:
-            return float(js)
-        elif 'int' in x and not 'sketch_types' in x:
-            return int(js)
-        elif 'str' in x:
+        if kind == sketch_schema.FieldType.UNION:
+            return self.js_to_union(ft, js, d, p)
+        if kind == sketch_schema.FieldType.NEWTYPE or kind == sketch_schema.FieldType.ANY:
+            return js
+        if kind == sketch_schema.FieldType.DICT:
+            return self.js_to_py_dict(ft, js, d, p)
+        if kind == sketch_schema.FieldType.LIST:
+            return self.js_to_py_list(ft, js, d, p)
+        if kind == sketch_schema.FieldType.ENUM:
+            return ft.py(js)
+        if kind == sketch_schema.FieldType.SCALAR:
+            return js if ft.py is str else ft.py(js)
+
+        cls = ft.py
+        cs = self._schema[cls]
+        if cs.raw_dict:
             return js
-        elif 'bool' in x:
-            return bool(js)
-        else:
-            ret = cls()
 
-            available_keys = set(js.keys())
-            optional_keys = set(ret.__dict__.keys())
+        x = str(cls)
+        ret = sketch_compact.compact_class(cls)() if self.compact else cls()
 
-            if x in self._observed_fields_map:
-                self._observed_fields_map[x] = self._observed_fields_map[x].intersection(available_keys)
-            else:
-                self._observed_fields_map[x] = available_keys
+        available_keys = set(js.keys())
+        optional_keys = set(ret.__dict__.keys())
 
-            for bcls in cls.__bases__:
-                if bcls is object:
-                    continue
-                z = bcls()
-                optional_keys = optional_keys.union(set(z.__dict__.keys()))
+        if x in self._observed_fields_map:
+            self._observed_fields_map[x] = self._observed_fields_map[x].intersection(available_keys)
+        else:
+            self._observed_fields_map[x] = available_keys
 
-            required_keys = set([r for r in optional_keys if ret.__dict__[r] is not None])
-            # optional_keys = set([r for r in required_keys if ret.__dict__[r] is not None])
+        required_keys = set([r for r in optional_keys if ret.__dict__[r] is not None])
 
-            missing_keys = required_keys.difference(available_keys)
-            unknown_keys = available_keys.difference(optional_keys)
+        missing_keys = required_keys.difference(available_keys)
+        unknown_keys = available_keys.difference(optional_keys)
 
-            if len(missing_keys) > 0 and self.debug:
-                print('Missing some properties required by type file, but not found in sketch file in %s [%s]: %s' % (
+        if len(missing_keys) > 0 and self.debug:
+            print('Missing some properties required by type file, but not found in sketch file in %s [%s]: %s' % (
                 p, x, missing_keys))
 
-            if len(unknown_keys) > 0 and self.debug:
-                print('Found unknown props in sketch file in %s with type %s' % (p, x))
-                for uk in unknown_keys:
-                    jsuk = js[uk]
-                    print('\t%s => %s: \n\t\t%s' % (uk, type(jsuk), jsuk))
-                return
+        if len(unknown_keys) > 0 and self.debug:
+            print('Found unknown props in sketch file in %s with type %s' % (p, x))
+            for uk in unknown_keys:
+                jsuk = js[uk]
+                print('\t%s => %s: \n\t\t%s' % (uk, type(jsuk), jsuk))
+            return
 
-            for k, v in ret.__dict__.items():
-                # print('>',k,v)
-                ft = self._get_type(cls.__name__, k)
-                # print(k, 'TYPE', ft)
-
-                prop = p + '.' + k
-                if k in js:
-                    vn = js[k]
-
-                    if self._do_types_match(v, vn, ft):
-                        ret.__dict__[k] = vn
-                        # print('\t' * d + 'COPY', k)
-                    else:
-                        # print(v,vn)
-                        if 'Dict[' in ft:
-                            if type(vn) is dict:
-                                ret.__dict__[k] = self.js_to_py_dict(ft, vn, d=d + 1, p=prop)
-                            else:
-                                print('Couldnt match dict property %s to type %s' % (prop, ft))
-                            continue
-                        if 'List[' in ft:
-                            if type(vn) is list:
-                                ret.__dict__[k] = self.js_to_py_list(ft, vn, d=d + 1, p=prop)
-                            else:
-                                print('Couldnt match list property %s to type %s' % (prop, ft))
-                            continue
-                        ret.__dict__[k] = self.js_to_py(self.str_to_type(ft), vn, d=d + 1, p=prop)
+        fields = cs.fields
+        for k, v in ret.__dict__.items():
+            ft = fields.get(k) or sketch_schema.FieldType(sketch_schema.FieldType.ANY)
 
+            prop = p + '.' + k
+            if k in js:
+                vn = js[k]
+
+                if self._do_types_match(v, vn, ft):
+                    ret.__dict__[k] = vn
                 else:
-                    pass  # print('Couldnt find expected property %s' % prop)
+                    if ft.kind == sketch_schema.FieldType.DICT and ft.value is not None:
+                        if type(vn) is dict:
+                            ret.__dict__[k] = self.js_to_py_dict(ft, vn, d=d + 1, p=prop)
+                        else:
+                            print('Couldnt match dict property %s to type %s' % (prop, ft))
+                        continue
+                    if ft.kind == sketch_schema.FieldType.LIST and ft.item is not None:
+                        if type(vn) is list:
+                            ret.__dict__[k] = self.js_to_py_list(ft, vn, d=d + 1, p=prop)
+                        else:
+                            print('Couldnt match list property %s to type %s' % (prop, ft))
+                        continue
+                    ret.__dict__[k] = self._decode(ft, vn, d=d + 1, p=prop)
 
         sid = None
         if 'do_objectID' in js:
@@ -281,14 +259,14 @@ class SketchToPy:
         return ret
 
     @classmethod
-    def _do_types_match(cls, obj1, obj2, ft=None):
+    def _do_types_match(cls, obj1, obj2, ft: 'sketch_schema.FieldType' = None):
         t1 = type(obj1)
         t2 = type(obj2)
 
         if obj1 == obj2:
             return True
 
-        if t1 == t2 and ft is None:
+        if t1 == t2 and (ft is None or ft.kind == sketch_schema.FieldType.ANY):
             return True
 
         if t1 == float and t2 == int or t2 == float and t1 == int:
@@ -300,9 +278,8 @@ class SketchToPy:
         if t1 is list:
 
             if min(len(obj1), len(obj2)) == 0:
-                if 'List' in ft and len(obj2) > 0:
-                    exp_type = ft.split('List[')[1].split(']')[0].strip()
-                    return type(obj2[0]).__name__ == exp_type
+                if ft.kind == sketch_schema.FieldType.LIST and ft.item is not None and len(obj2) > 0:
+                    return ft.item.kind == sketch_schema.FieldType.SCALAR and type(obj2[0]) is ft.item.py
                 else:
                     return True
             else:
@@ -329,6 +306,9 @@ class SketchToPy:
     def parse_page(self, page_contents, file):
         return self.js_to_py(sketch_types.SketchPage, page_contents, p=file)
 
+    def parse_layer(self, layer_contents, p=''):
+        return self.js_to_py(sketch_types.SJLayer, layer_contents, p=p)
+
 
 def del_none(d):
     """
@@ -355,57 +335,115 @@ def del_none(d):
     return d
 
 
-class AdvancedEncoder(JSONEncoder):
-    def default(self, o):
-        try:
-            stype = str(type(o))
-
-            if 'mappingproxy' in stype:  # Enum
-                return None
+def _encode_object(o) -> dict:
+    skipped = sketch_types.TRANSIENT_FIELDS  # looked up here, sketch_types imports this module
+    return {k: v for k, v in o.__dict__.items() if v is not None and k not in skipped}
 
-            if 'enum' in stype:
-                return o.value
 
-            if hasattr(o, '__dict__'):
-                d = o.__dict__
-                if '_raw' in d:
-                    del d['_raw']
-                if '_parent' in d:
-                    del d['_parent']
+def _encode_compact(o) -> dict:
+    # reads the slots directly instead of going through the SlotDict view, fields that were never set hold their
+    # class-level default and the mutable ones (created on read) are never None
+    cls = type(o)
+    absent = o._absent
+    skipped = sketch_types.TRANSIENT_FIELDS
+    d = {}
+    for k, getter in cls._slot_getters.items():
+        try:
+            v = getter(o)
+        except AttributeError:
+            if absent is not None and k in absent:
+                continue
+            v = cls._defaults[k] if k in cls._defaults else cls._factories[k]()
+        if v is not None and k not in skipped:
+            d[k] = v
+    if o._extra is not None:
+        d.update((k, v) for k, v in o._extra.items() if v is not None and k not in skipped)
+    return d
 
-                for k, v in list(d.items()):
-                    if v is None:
-                        del d[k]
 
-                return d
+def _plan(o):
+    """The function that converts objects of the type of o to what the json encoder writes in their place."""
+    cls = type(o)
+    if cls is MappingProxyType:
+        return lambda _: None
+    if issubclass(cls, Enum):
+        return attrgetter('value')
+    if getattr(cls, '_slot_getters', None) is not None:
+        return _encode_compact
+    if hasattr(o, '__dict__'):
+        return _encode_object
+    if issubclass(cls, str):
+        return str
+    if issubclass(cls, bytes):
+        return lambda b: b.decode('utf-8')
+    return lambda x: x
 
-            if issubclass(type(o), str):
-                return str(o)
 
-            if issubclass(type(o), bytes):
-                return o.decode('utf-8')
+class AdvancedEncoder(JSONEncoder):
+    """
+    Writes objects as the dict of their fields without None values and sketch_types.TRANSIENT_FIELDS, and enums by
+    value. The objects are not modified. The conversion is chosen once per type. The objects written as dicts are
+    appended to objects if given.
+    """
+    _plans = {}
 
-            return o
+    def __init__(self, *args, objects: list = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.objects = objects
 
-        except Exception as e:
-            print(e)
-            print(str(o))
+    def default(self, o):
+        plan = self._plans.get(type(o))
+        if plan is None:
+            plan = self._plans[type(o)] = _plan(o)
+        if self.objects is not None and (plan is _encode_object or plan is _encode_compact):
+            self.objects.append(o)
+        return plan(o)
+
+
+def _layers_of(o):
+    layers = o.get('layers') if isinstance(o, dict) else getattr(o, 'layers', None)
+    return layers if isinstance(layers, list) else None
+
+
+def _write_chunks(encoder: AdvancedEncoder, o, write):
+    # objects with layers are written as the fields around their layers and then the layers, runs of layers without
+    # layers of their own in one piece
+    if not _layers_of(o):
+        write(encoder.encode(o))
+        return
+
+    fields = list((o if isinstance(o, dict) else encoder.default(o)).items())
+    at = next((i for i, (k, _) in enumerate(fields) if k == 'layers'), None)
+    if at is None:
+        write(encoder.encode(dict(fields)))
+        return
+    head = encoder.encode(dict(fields[:at]))
+    tail = encoder.encode(dict(fields[at + 1:]))
+    write(head[:-1] + (', "layers": [' if at else '"layers": ['))
+
+    sep = ''
+    run = []
+    for layer in fields[at][1]:
+        if not _layers_of(layer):
+            run.append(layer)
+            continue
+        if run:
+            write(sep + encoder.encode(run)[1:-1])
+            sep, run = ', ', []
+        write(sep)
+        _write_chunks(encoder, layer, write)
+        sep = ', '
+    if run:
+        write(sep + encoder.encode(run)[1:-1])
+    write(']' + (', ' + tail[1:] if len(tail) > 2 else '}'))
 
 
 class PyToSketch:
     @classmethod
-    def write(cls, obj):
-        cp = None
-
-        if hasattr(obj, '_parent'):
-            cp = obj._parent
-            del obj._parent
-
-        d = json.dumps(obj, cls=AdvancedEncoder, check_circular=False)
+    def write(cls, obj, objects: list = None):
+        return json.dumps(obj, cls=AdvancedEncoder, check_circular=False, objects=objects)
 
-        # print(len(d))
-
-        if cp is not None:
-            obj._parent = cp
-
-        return d
+    @classmethod
+    def write_to(cls, obj, fp, objects: list = None):
+        """Writes the same json as write to the text stream fp, one layer at a time."""
+        _write_chunks(AdvancedEncoder(check_circular=False, objects=objects), obj, fp.write)
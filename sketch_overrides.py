@@ -0,0 +1,244 @@
+"""
+Resolution of symbol instances to the layers they show, with the overrides of the instance applied.
+"""
+import warnings
+from functools import lru_cache
+from typing import Dict, List, Any, Tuple
+
+from . import sketch_index
+from . import sketch_types
+
+OverridePath = Tuple[str, ...]  # do_objectIDs from a layer of the master down into nested instances
+
+
+@lru_cache(maxsize=1 << 16)
+def parse_override_name(name: str) -> Tuple[OverridePath, str]:
+    """
+    Splits an overrideName into the path of layer ids and the overridden property, i.e.
+    'A/B_stringValue' -> (('A', 'B'), 'stringValue').
+    """
+    head, _, last = name.rpartition('/')
+    layer_id, _, prop = last.partition('_')
+    path = tuple(head.split('/')) + (layer_id,) if head else (layer_id,)
+    return path, prop
+
+
+def parse_overrides(instance: 'sketch_types.SJSymbolInstanceLayer') -> Dict[OverridePath, Dict[str, Any]]:
+    """Overrides of an instance by layer path, from overrideValues and the legacy overrides dict."""
+    ret = {}
+    if instance.overrides:
+        _parse_legacy(instance.overrides, (), ret)
+    for ov in instance.overrideValues or []:
+        path, prop = parse_override_name(ov.overrideName)
+        ret.setdefault(path, {})[prop] = ov.value
+    return ret
+
+
+def _parse_legacy(overrides: dict, path: OverridePath, ret: dict):
+    # {layer id: text, layer id: {'symbolID': ..., nested layer id: ...}} as written before Sketch 53
+    for k, v in overrides.items():
+        if isinstance(v, dict):
+            for kk, vv in v.items():
+                if kk == 'symbolID':
+                    ret.setdefault(path + (k,), {})['symbolID'] = vv
+                else:
+                    _parse_legacy({kk: vv}, path + (k,), ret)
+        elif isinstance(v, str):
+            ret.setdefault(path + (k,), {})['stringValue'] = v
+
+
+class ResolvedLayer:
+    """
+    A layer as shown by a symbol instance. Nodes of the trees of masters without overrides are shared between
+    instances (shared is set), they must not be modified.
+    """
+    __slots__ = ('layer', 'symbol', 'children', 'overrides', 'style_override', 'shared')
+
+    def __init__(self, layer, symbol=None, children=(), overrides=None, style_override=None, shared=False):
+        self.layer = layer  # the layer of the master (or the instance itself for the root)
+        self.symbol: 'sketch_types.SJSymbolMaster' = symbol  # effective master of symbol instances
+        self.children: List[ResolvedLayer] = children
+        self.overrides: Dict[str, Any] = overrides  # overridden properties, i.e. {'stringValue': 'Hello'}
+        self.style_override: 'sketch_types.SJStyle' = style_override
+        self.shared = shared
+
+    def __repr__(self):
+        return 'ResolvedLayer(%s, name=%s)' % (self.layer._class, self.layer.name)
+
+    @property
+    def name(self) -> str:
+        return self.layer.name
+
+    @property
+    def text(self) -> str:
+        """The effective string of text layers, None for other layers."""
+        if self.overrides and 'stringValue' in self.overrides:
+            return self.overrides['stringValue']
+        attributed = getattr(self.layer, 'attributedString', None)
+        return None if attributed is None else attributed.string
+
+    @property
+    def style(self) -> 'sketch_types.SJStyle':
+        return self.layer.style if self.style_override is None else self.style_override
+
+    def walk(self):
+        """Yields this node and all nodes below it, depth-first."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def find(self, cls: str) -> List['ResolvedLayer']:
+        return [n for n in self.walk() if n.layer._class == cls]
+
+
+class OverrideResolver(sketch_index.MasterCache):
+    """
+    Resolves symbol instances of a file. The resolved tree of every master without overrides, together with its
+    layers by do_objectID and their parents, is built once and shared. Resolving an instance only creates nodes on
+    the paths to its overridden layers. Text (stringValue), nested symbol swaps (symbolID) and layer and text styles
+    (layerStyle, textStyle, resolved through the shared styles of the document) are applied, all other overridden
+    properties are available in ResolvedLayer.overrides.
+    """
+
+    def __init__(self, file):
+        super().__init__(file)
+        self._trees: Dict[int, List[ResolvedLayer]] = {}  # id(master) -> nodes of its layers without overrides
+        self._layouts: Dict[int, tuple] = {}  # id(master) -> (layers by do_objectID, parents by id(layer))
+        self._styles = None
+        self._style_sources = None
+
+    def resolve(self, instance: 'sketch_types.SJSymbolInstanceLayer') -> ResolvedLayer:
+        """The tree shown by instance, its root stands for the instance itself."""
+        self._sync_styles()
+        symbol = self._file.get_symbol_by_id(instance.symbolID)
+        children = self._resolve(symbol, parse_overrides(instance), [], set()) if symbol is not None else []
+        return ResolvedLayer(instance, symbol, children)
+
+    def resolve_page(self, page: 'sketch_types.SketchPage'):
+        """Yields (instance, resolved tree) for every symbol instance on page, in depth-first order."""
+        self._sync_styles()
+        stack = list(reversed(page.layers or []))
+        while stack:
+            l = stack.pop()
+            if getattr(l, '_class', None) == 'symbolInstance':
+                yield l, self.resolve(l)
+            stack.extend(reversed(getattr(l, 'layers', None) or []))
+
+    def _forget(self, mid: int):
+        self._trees.pop(mid, None)
+        self._layouts.pop(mid, None)
+
+    def _resolve(self, master, overrides, stack: list, partial: set) -> List[ResolvedLayer]:
+        if master.layers is None:
+            return []
+        tree = self._tree(master, stack, partial)
+        if not overrides:
+            return tree
+
+        by_id, parents = self._layouts[id(master)]
+        by_first: Dict[str, Dict[OverridePath, Dict[str, Any]]] = {}
+        touched = set()  # ids of the layers on the way to overridden layers
+        for path, props in overrides.items():
+            by_first.setdefault(path[0], {})[path[1:]] = props
+            layer = by_id.get(path[0])
+            while layer is not None and id(layer) not in touched:
+                touched.add(id(layer))
+                layer = parents.get(id(layer))
+        if not touched:
+            return tree
+
+        def apply(node: ResolvedLayer) -> ResolvedLayer:
+            layer = node.layer
+            if id(layer) not in touched:
+                return node
+
+            own = by_first.get(layer.do_objectID, {})
+            props = own.get(())
+            nested = {p: v for p, v in own.items() if p}
+            symbol, children = node.symbol, node.children
+            if props and 'symbolID' in props:
+                symbol = self._file.get_symbol_by_id(props['symbolID'])
+            if layer._class == 'symbolInstance':
+                if symbol is not node.symbol or nested:
+                    children = self._nested(master, layer, symbol, nested, stack, partial)
+            else:
+                children = [apply(c) for c in children]
+            return ResolvedLayer(layer, symbol, children, props, self._style_of(props))
+
+        return [apply(n) for n in tree]
+
+    def _nested(self, master, instance, symbol, outer, stack: list, partial: set) -> List[ResolvedLayer]:
+        """Children of an instance inside master, its own overrides merged with those from outside (which win)."""
+        if symbol is None:
+            return []
+        if any(symbol is s for s in stack):
+            warnings.warn(sketch_index.SymbolCycleWarning(symbol, instance), stacklevel=5)
+            i = next(i for i, s in enumerate(stack) if s is symbol)
+            partial.update(id(s) for s in stack[i:])
+            return []
+
+        overrides = parse_overrides(instance)
+        for path, props in outer.items():
+            overrides[path] = dict(overrides.get(path, {}), **props)
+        self._use(master, symbol)
+        return self._resolve(symbol, overrides, stack, partial)
+
+    def _tree(self, master, stack: list, partial: set) -> List[ResolvedLayer]:
+        mid = id(master)
+        if mid in self._trees:
+            return self._trees[mid]
+
+        stack.append(master)
+        by_id, parents = {}, {}
+        self._own(master, master)
+
+        def build(layer, parent) -> ResolvedLayer:
+            if layer.do_objectID is not None:
+                by_id[layer.do_objectID] = layer
+            parents[id(layer)] = parent
+            symbol, children = None, []
+            if layer._class == 'symbolInstance':
+                self._own(master, layer)
+                symbol = self._file.get_symbol_by_id(layer.symbolID)
+                children = self._nested(master, layer, symbol, {}, stack, partial)
+            elif layer.layers:
+                self._own(master, layer)
+                children = [build(c, layer) for c in layer.layers if hasattr(c, '__dict__')]
+            return ResolvedLayer(layer, symbol, children, shared=True)
+
+        tree = [build(l, None) for l in master.layers if hasattr(l, '__dict__')]
+        stack.pop()
+
+        # the layout is needed to apply overrides even if the tree is not kept
+        self._layouts[mid] = (by_id, parents)
+        if mid in partial:
+            partial.discard(mid)
+        else:
+            self._keep(master)
+            self._trees[mid] = tree
+        return tree
+
+    def _sync_styles(self):
+        doc = self._file.sketch_document
+        sources = (doc.layerStyles.objects, doc.layerTextStyles.objects, doc.foreignLayerStyles, doc.foreignTextStyles)
+        key = tuple((id(s), len(s)) for s in sources)
+        if key == self._style_sources:
+            return
+
+        styles = {}
+        for shared in sources[0] + sources[1]:
+            styles[shared.do_objectID] = shared.value
+        for foreign in sources[2] + sources[3]:
+            if foreign.localSharedStyle is not None:
+                styles.setdefault(foreign.localSharedStyle.do_objectID, foreign.localSharedStyle.value)
+                styles.setdefault(foreign.remoteStyleID, foreign.localSharedStyle.value)
+        self._styles = styles
+        self._style_sources = key
+
+    def _style_of(self, props):
+        if not props:
+            return None
+        style_id = props.get('layerStyle', props.get('textStyle'))
+        return None if style_id is None else self._styles.get(style_id)
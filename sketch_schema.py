@@ -0,0 +1,374 @@
+import ast
+import builtins
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import typing
+import warnings
+from enum import Enum
+from typing import Dict, List, Union
+
+from . import sketch_types
+
+SCHEMA_VERSION = 1
+SCHEMA_CACHE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'sketch_types.schema.json')
+
+# Classes whose JSON counterpart is a loose dictionary that is kept verbatim instead of being materialized.
+RAW_DICT_CLASSES = {'SJPresetDict'}
+
+
+class FieldType:
+    ANY = 'any'
+    SCALAR = 'scalar'
+    NEWTYPE = 'newtype'
+    ENUM = 'enum'
+    OBJECT = 'object'
+    LIST = 'list'
+    DICT = 'dict'
+    UNION = 'union'
+
+    def __init__(self, kind: str, ref: str = None, py=None, item: 'FieldType' = None, key: 'FieldType' = None,
+                 value: 'FieldType' = None, members: List['FieldType'] = None):
+        self.kind: str = kind
+        self.ref: str = ref  # name of the scalar, class, enum or NewType
+        self.py = py  # resolved python object for ref
+        self.item: FieldType = item  # list element type
+        self.key: FieldType = key  # dict key type
+        self.value: FieldType = value  # dict value type
+        self.members: List[FieldType] = members  # union members, in declaration order
+
+    def __repr__(self):
+        if self.kind == FieldType.LIST:
+            return 'List[%s]' % (self.item,) if self.item is not None else 'List'
+        if self.kind == FieldType.DICT:
+            return 'Dict[%s, %s]' % (self.key, self.value) if self.value is not None else 'Dict'
+        if self.kind == FieldType.UNION:
+            return 'Union[%s]' % ', '.join(repr(m) for m in self.members)
+        if self.kind == FieldType.ANY:
+            return 'Any'
+        return self.ref
+
+    def to_json(self) -> dict:
+        d = {'kind': self.kind}
+        if self.ref is not None:
+            d['ref'] = self.ref
+        for k in ['item', 'key', 'value']:
+            v = getattr(self, k)
+            if v is not None:
+                d[k] = v.to_json()
+        if self.members is not None:
+            d['members'] = [m.to_json() for m in self.members]
+        return d
+
+    @staticmethod
+    def from_json(d: dict) -> 'FieldType':
+        sub = {k: FieldType.from_json(d[k]) for k in ['item', 'key', 'value'] if k in d}
+        members = [FieldType.from_json(m) for m in d['members']] if 'members' in d else None
+        ref = d.get('ref')
+        return FieldType(d['kind'], ref=ref, py=_lookup(ref) if ref is not None else None, members=members, **sub)
+
+    @staticmethod
+    def from_hint(hint) -> 'FieldType':
+        if hint is None:
+            return FieldType(FieldType.ANY)
+        if hint in (int, float, str, bool):
+            return FieldType(FieldType.SCALAR, ref=hint.__name__, py=hint)
+        if hint is list:
+            return FieldType(FieldType.LIST)
+        if hint is dict:
+            return FieldType(FieldType.DICT)
+
+        origin = typing.get_origin(hint)
+        args = typing.get_args(hint)
+        if origin is list:
+            return FieldType(FieldType.LIST, item=FieldType.from_hint(args[0]) if args else None)
+        if origin is dict:
+            if not args:
+                return FieldType(FieldType.DICT)
+            return FieldType(FieldType.DICT, key=FieldType.from_hint(args[0]), value=FieldType.from_hint(args[1]))
+        if origin is Union:
+            return FieldType(FieldType.UNION, members=[FieldType.from_hint(a) for a in args])
+
+        if isinstance(hint, typing.NewType):
+            return FieldType(FieldType.NEWTYPE, ref=hint.__name__, py=hint,
+                             item=FieldType.from_hint(hint.__supertype__))
+        if isinstance(hint, type) and issubclass(hint, Enum):
+            return FieldType(FieldType.ENUM, ref=hint.__name__, py=hint)
+        if isinstance(hint, type) and hint.__module__ == sketch_types.__name__:
+            return FieldType(FieldType.OBJECT, ref=hint.__name__, py=hint)
+
+        return FieldType(FieldType.ANY)
+
+
+class ClassSchema:
+    def __init__(self, name: str, bases: List[str], fields: Dict[str, FieldType]):
+        self.name: str = name
+        self.cls = _lookup(name)
+        self.bases: List[str] = bases
+        self.fields: Dict[str, FieldType] = fields  # in the order the instance __dict__ is populated
+        self.raw_dict: bool = name in RAW_DICT_CLASSES
+
+    def __repr__(self):
+        return 'ClassSchema(%s, %d fields)' % (self.name, len(self.fields))
+
+
+class UnknownValueWarning(UserWarning):
+    """Issued for values that match no member of a union, the value itself is kept as-is."""
+
+    def __init__(self, union: FieldType, value, path: str):
+        self.union: FieldType = union
+        self.value = value
+        self.value_class: str = value.get('_class') if isinstance(value, dict) else None
+        self.path: str = path
+        super().__init__('Unknown value %s for union type %s at %s' % (
+            self.value_class if self.value_class is not None else type(value).__name__, union, path))
+
+
+def report_unknown_value(union: FieldType, value, path: str):
+    warnings.warn(UnknownValueWarning(union, value, path), stacklevel=3)
+
+
+class UnionDispatch:
+    """
+    Resolves the member of a union a json value belongs to with a single lookup: dicts by their _class, overrides by
+    their symbolID, the rest by type. Gives the same result as trying the members in declaration order.
+    """
+
+    def __init__(self, ft: FieldType):
+        self.union: FieldType = ft
+        classes = {}  # member -> default _class of its instances
+        overrides = set()
+        for m in ft.members:
+            if m.kind == FieldType.OBJECT:
+                test = m.py().__dict__
+                classes[id(m)] = test.get('_class')
+                if 'symbolID' in test and 'SymbolOverride' in m.ref:
+                    overrides.add(id(m))
+
+        def first(match) -> FieldType:
+            return next((m for m in ft.members if match(m)), None)
+
+        def raw_dict(m):
+            return m.kind == FieldType.DICT and m.value is None
+
+        self.string: FieldType = first(lambda m: m.kind == FieldType.SCALAR and m.py is str)
+        # dicts without _class and symbolID
+        self.plain: FieldType = first(lambda m: m.kind == FieldType.DICT or id(m) in overrides)
+        # dicts with symbolID but without _class
+        self.symbol: FieldType = first(lambda m: raw_dict(m) or id(m) in overrides)
+        # dicts with an unknown _class
+        self.class_fallback: FieldType = self.symbol
+        self.by_class: Dict[str, FieldType] = {}
+        for c in classes.values():
+            if c is not None and c not in self.by_class:
+                self.by_class[c] = first(lambda m: raw_dict(m) or id(m) in overrides or classes.get(id(m)) == c)
+
+    def resolve(self, js) -> FieldType:
+        """Returns the member js belongs to, None if there is none."""
+        if js.__class__ is dict:
+            if '_class' in js:
+                return self.by_class.get(js['_class'], self.class_fallback)
+            return self.symbol if 'symbolID' in js else self.plain
+        if js.__class__ is str:
+            return self.string
+        return None
+
+
+class Schema:
+    def __init__(self, classes: Dict[str, ClassSchema], source_hash: str = None):
+        self.classes: Dict[str, ClassSchema] = classes
+        self.source_hash: str = source_hash
+        self._by_cls = {c.cls: c for c in classes.values()}
+        self._hints = {}
+        self._unions = {}
+
+    def __getitem__(self, cls) -> ClassSchema:
+        return self._by_cls[cls]
+
+    def __contains__(self, cls):
+        return cls in self._by_cls
+
+    def get_field_type(self, cls, field: str) -> FieldType:
+        return self._by_cls[cls].fields.get(field)
+
+    def field_type_for(self, hint) -> FieldType:
+        """Resolves a class or typing hint (such as sketch_types.SketchUserData) to its FieldType."""
+        key = id(hint)
+        if key not in self._hints:
+            self._hints[key] = (hint, FieldType.from_hint(hint))
+        return self._hints[key][1]
+
+    def union_dispatch(self, ft: FieldType) -> UnionDispatch:
+        key = id(ft)
+        if key not in self._unions:
+            self._unions[key] = (ft, UnionDispatch(ft))
+        return self._unions[key][1]
+
+    def to_json(self) -> dict:
+        return {
+            'version': SCHEMA_VERSION,
+            'source_hash': self.source_hash,
+            'classes': [{
+                'name': c.name,
+                'bases': c.bases,
+                'fields': [[k, v.to_json()] for k, v in c.fields.items()]
+            } for c in self.classes.values()]
+        }
+
+    @staticmethod
+    def from_json(d: dict) -> 'Schema':
+        classes = {}
+        for c in d['classes']:
+            fields = {k: FieldType.from_json(v) for k, v in c['fields']}
+            classes[c['name']] = ClassSchema(c['name'], c['bases'], fields)
+        return Schema(classes, d.get('source_hash'))
+
+
+def _lookup(ref: str):
+    if hasattr(sketch_types, ref):
+        return getattr(sketch_types, ref)
+    return getattr(builtins, ref)
+
+
+def _resolve_annotation(node, ns):
+    if isinstance(node, ast.Name):
+        return ns[node.id] if node.id in ns else getattr(builtins, node.id)
+    if isinstance(node, ast.Attribute):
+        return getattr(_resolve_annotation(node.value, ns), node.attr)
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return _resolve_annotation(ast.parse(node.value, mode='eval').body, ns)
+    if isinstance(node, ast.Subscript):
+        base = _resolve_annotation(node.value, ns)
+        if isinstance(node.slice, ast.Tuple):
+            return base[tuple(_resolve_annotation(e, ns) for e in node.slice.elts)]
+        return base[_resolve_annotation(node.slice, ns)]
+    raise ValueError('Unsupported annotation %s' % ast.dump(node))
+
+
+def _self_attribute(node):
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'self':
+        return node.attr
+    return None
+
+
+def compile_schema(source: str = None) -> Schema:
+    """Builds the schema from the annotated assignments in the __init__ of every class in sketch_types."""
+    if source is None:
+        source = inspect.getsource(sketch_types)
+
+    from . import sketch_api  # the annotations of _parent, sketch_types only imports it for type checking
+    ns = dict(vars(sketch_types), sketch_api=sketch_api)
+    classes: Dict[str, ClassSchema] = {}
+
+    for node in ast.parse(source).body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        cls = ns.get(node.name)
+        if not isinstance(cls, type) or issubclass(cls, Enum):
+            continue
+
+        bases = [b.id for b in node.bases if isinstance(b, ast.Name) and b.id in classes]
+        init = [s for s in node.body if isinstance(s, ast.FunctionDef) and s.name == '__init__']
+
+        fields: Dict[str, FieldType] = {}
+        if len(init) == 0:
+            for b in bases:
+                fields.update(classes[b].fields)
+
+        for stmt in init[0].body if len(init) > 0 else []:
+            if isinstance(stmt, ast.AnnAssign) and _self_attribute(stmt.target) is not None:
+                hint = _resolve_annotation(stmt.annotation, ns)
+                fields[_self_attribute(stmt.target)] = FieldType.from_hint(hint)
+            elif isinstance(stmt, ast.Assign):
+                for t in stmt.targets:
+                    if _self_attribute(t) is not None and _self_attribute(t) not in fields:
+                        fields[_self_attribute(t)] = FieldType(FieldType.ANY)
+            elif isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Call):
+                call = stmt.value
+                if isinstance(call.func, ast.Attribute) and call.func.attr == '__init__' \
+                        and isinstance(call.func.value, ast.Call) and getattr(call.func.value.func, 'id', '') == 'super':
+                    for b in bases:
+                        for k, v in classes[b].fields.items():
+                            fields.setdefault(k, v)
+                elif getattr(call.func, 'id', '') == 'setattr' and len(call.args) >= 2 \
+                        and isinstance(call.args[1], ast.Constant) and call.args[1].value not in fields:
+                    fields[call.args[1].value] = FieldType(FieldType.ANY)
+
+        classes[node.name] = ClassSchema(node.name, bases, fields)
+
+    return Schema(classes, hashlib.sha1(source.encode('utf-8')).hexdigest())
+
+
+def load_schema(path: str = SCHEMA_CACHE_PATH) -> Schema:
+    """
+    Returns the schema of sketch_types, compiling it from source if the cache at path is missing, unreadable or
+    outdated. The cache is shipped with the package, so that bytecode-only installs (without the source) use it as-is.
+    """
+    try:
+        source = inspect.getsource(sketch_types)
+    except (OSError, TypeError):
+        source = None
+
+    cached = _read_cache(path)
+    if source is None:
+        if cached is None:
+            raise RuntimeError('sketch_types source is not available and no schema cache exists at %s' % path)
+        return Schema.from_json(cached)
+
+    source_hash = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    if cached is not None and cached.get('source_hash') == source_hash:
+        return Schema.from_json(cached)
+
+    schema = compile_schema(source)
+    write_schema(schema, path)
+    return schema
+
+
+def write_schema(schema: Schema, path: str = SCHEMA_CACHE_PATH):
+    """
+    Writes the schema cache to path through a temporary file, so that processes loading the schema at the same time
+    (i.e. the workers of SketchFile) never read a partial file. A directory that is not writable is ignored.
+    """
+    try:
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(path) + '.', dir=os.path.dirname(path))
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(schema.to_json(), f, indent=1, sort_keys=True)
+        os.chmod(tmp, 0o644)  # mkstemp creates it readable by the owner only
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _read_cache(path: str):
+    """The cached schema json at path, None if it is missing, unreadable or of another SCHEMA_VERSION."""
+    try:
+        with open(path, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):  # ValueError includes JSONDecodeError and UnicodeDecodeError
+        return None
+    if not isinstance(cached, dict) or cached.get('version') != SCHEMA_VERSION:
+        return None
+    return cached
+
+
+_schema: Schema = None
+
+
+def get_schema() -> Schema:
+    global _schema
+    if _schema is None:
+        _schema = load_schema()
+    return _schema
+
+
+if __name__ == '__main__':
+    # regenerates the shipped cache after sketch_types changed: python -m python_sketch_api.sketch_schema
+    write_schema(compile_schema(inspect.getsource(sketch_types)))
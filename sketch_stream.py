@@ -0,0 +1,169 @@
+"""
+Incremental parsing of page json straight from a (zip entry) stream.
+
+The tokenizer emits pull events instead of building the whole dict tree, the page builders only ever hold the raw dict
+of the top-level layer that is currently being read and convert it to objects as soon as it is complete.
+"""
+import codecs
+import json
+from json import JSONDecodeError
+
+from . import sketch_io
+from . import sketch_types
+
+CHUNK_SIZE = 1 << 16
+
+START_MAP = 'start_map'
+END_MAP = 'end_map'
+START_ARRAY = 'start_array'
+END_ARRAY = 'end_array'
+KEY = 'key'
+VALUE = 'value'
+
+_DECODER = json.JSONDecoder()
+_NUMBER_CHARS = frozenset('0123456789.eE+-')
+
+
+class JsonEventReader:
+    """
+    Pull tokenizer over a binary utf-8 json stream. Iterating yields (event, value) tuples, read_value() decodes the
+    next complete value at once with the C scanner of the json module. Only the unconsumed part of the stream is
+    buffered.
+    """
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self._read = stream.read
+        self._chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._stack = []  # True for maps, False for arrays
+        self._key_next = False
+
+    def _fill(self, size=None):
+        """Appends the next chunk to the unconsumed text, returns False at the end of the stream."""
+        if self._eof:
+            return False
+        data = self._read(size or self._chunk_size)
+        self._eof = not data
+        self._buf = self._buf[self._pos:] + self._decoder.decode(data, final=self._eof)
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Skips separators and returns the next significant character, None at the end of the stream."""
+        while True:
+            buf, pos = self._buf, self._pos
+            n = len(buf)
+            while pos < n and buf[pos] in ' \t\n\r:,':
+                if buf[pos] == ',':
+                    self._key_next = self._stack[-1]
+                pos += 1
+            self._pos = pos
+            if pos < n:
+                return buf[pos]
+            if not self._fill():
+                return None
+
+    def read_value(self):
+        """Decodes the next complete value (scalar, object or array), reading more of the stream as needed."""
+        if self.peek() is None:
+            raise JSONDecodeError('Expecting value', self._buf, self._pos)
+        size = self._chunk_size
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._buf, self._pos)
+            except JSONDecodeError:
+                if not self._fill(size):
+                    raise
+                size *= 2  # grow geometrically so large values are rescanned only a few times
+                continue
+            if isinstance(value, (int, float)) and not self._eof \
+                    and (end >= len(self._buf) or self._buf[end] in _NUMBER_CHARS):
+                self._fill(size)  # the number might continue in the next chunk
+                continue
+            self._pos = end
+            self._key_next = False
+            return value
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        c = self.peek()
+        if c is None:
+            raise StopIteration
+
+        if c == '{':
+            self._stack.append(True)
+            self._key_next = True
+            self._pos += 1
+            return START_MAP, None
+        if c == '}':
+            self._stack.pop()
+            self._key_next = False
+            self._pos += 1
+            return END_MAP, None
+        if c == '[':
+            self._stack.append(False)
+            self._key_next = False
+            self._pos += 1
+            return START_ARRAY, None
+        if c == ']':
+            self._stack.pop()
+            self._pos += 1
+            return END_ARRAY, None
+
+        is_key = self._key_next
+        value = self.read_value()
+        return (KEY if is_key else VALUE), value
+
+
+def _iter_page(reader: JsonEventReader, parser: 'sketch_io.SketchToPy', p: str):
+    """Yields ('layer', obj) for every converted top-level layer and finally ('page', raw page dict without layers)."""
+    event, _ = next(reader)
+    if event != START_MAP:
+        raise JSONDecodeError('Expecting page object', '', 0)
+
+    page_js = {}
+    for event, key in reader:
+        if event == END_MAP:
+            break
+        if key == 'layers' and reader.peek() == '[':
+            next(reader)
+            i = 0
+            while reader.peek() != ']':
+                yield 'layer', parser.parse_layer(reader.read_value(), '%s.layers[%d]' % (p, i))
+                i += 1
+            next(reader)
+            page_js[key] = []
+        else:
+            page_js[key] = reader.read_value()
+
+    yield 'page', page_js
+
+
+def parse_page(stream, parser: 'sketch_io.SketchToPy', p='') -> 'sketch_types.SketchPage':
+    """Parses a page from a json stream, only the raw dict of one top-level layer is held at any time."""
+    layers = []
+    for kind, value in _iter_page(JsonEventReader(stream), parser, p):
+        if kind == 'layer':
+            layers.append(value)
+        else:
+            page = parser.parse_page(value, p)
+            page.layers = layers
+            return page
+
+
+def iter_page_layers(stream, p='', debug=False):
+    """
+    Yields the converted top-level layers of a page json stream one by one. The layers are not kept anywhere, so
+    memory is bounded by the largest single top-level layer.
+    """
+    parser = sketch_io.SketchToPy(debug=debug)
+    for kind, value in _iter_page(JsonEventReader(stream), parser, p):
+        if kind == 'layer':
+            yield value
+            parser._object_maps.clear()
+            parser._class_maps.clear()
@@ -0,0 +1,434 @@
+"""
+Extraction of all texts of a file, including the texts set by symbol overrides, as a stream of records.
+"""
+import bisect
+import csv
+import json
+import os
+import re
+from typing import NamedTuple, Tuple, Iterator, Optional, Dict, List, Set
+
+from . import sketch_index
+from . import sketch_types
+
+LAYER = 'layer'  # the string of a text layer
+OVERRIDE = 'override'  # a string override of a symbol instance, for a text layer of its master
+
+
+class TextRecord(NamedTuple):
+    page: str
+    artboard: Optional[str]
+    path: Tuple[str, ...]  # layer names from the top-level layer down to the text layer (through the instance)
+    object_id: str  # do_objectID of the text layer (in the master for overrides)
+    instance_id: Optional[str]  # do_objectID of the symbol instance for overrides
+    source: str
+    string: str
+    font_name: Optional[str]
+    font_size: Optional[float]
+    color: Optional[str]  # #RRGGBBAA
+    x: float  # frame in page coordinates, for overrides as placed in an instance that is not resized
+    y: float
+    width: float
+    height: float
+    run: Optional[int]  # index of the attribute run, None for records of whole layers
+
+
+FIELDS = TextRecord._fields
+
+INDEX_SUFFIX = '.textindex'  # a persisted TextIndex is kept next to the file, i.e. MyFile.sketch.textindex
+INDEX_VERSION = 1
+NGRAM = 3
+_TOKEN = re.compile(r'\w+')
+
+
+class TextHit(NamedTuple):
+    page: str
+    artboard: Optional[str]
+    path: Tuple[str, ...]
+    object_id: str
+    instance_id: Optional[str]
+    source: str
+    string: str
+
+
+def iter_texts(file, runs=False, overrides=True) -> Iterator[TextRecord]:
+    """
+    Yields a record for every text layer of file (one for every attribute run if runs), and with overrides one for
+    every string override of the symbol instances. Pages are walked once depth-first; pages of a lazily opened file
+    that were not loaded yet are streamed instead of being kept.
+    """
+    resolver = file.overrides if overrides else None
+    shared = {}  # id(shared resolved node) -> (node, override texts below it)
+    for page in file.sketch_pages:
+        if hasattr(page, 'is_loaded') and not page.is_loaded:
+            top_layers = file.iter_page_layers(page.do_objectID)
+        else:
+            top_layers = page.layers or []
+        for layer in top_layers:
+            artboard = layer.name if getattr(layer, '_class', None) in sketch_index.ARTBOARD_CLASSES else None
+            yield from _iter_layer(layer, page.name, artboard, (), 0, 0, resolver, runs, shared)
+
+
+def _iter_layer(top, page_name, artboard, path, x, y, resolver, runs, shared):
+    stack = [(top, path, x, y)]
+    while stack:
+        layer, path, ox, oy = stack.pop()
+        if not hasattr(layer, '__dict__'):  # unknown layer types are kept as raw dicts
+            continue
+        path = path + (layer.name,)
+        x, y = ox + layer.frame.x, oy + layer.frame.y
+        cls = layer._class
+        if cls == 'text':
+            yield from _records(layer, layer.attributedString.string, page_name, artboard, path, None, LAYER,
+                                x, y, layer.frame, runs)
+        elif cls == 'symbolInstance' and resolver is not None:
+            for rel, tx, ty, text_layer, string in _overrides(resolver.resolve(layer).children, shared):
+                yield from _records(text_layer, string, page_name, artboard, path + rel, layer.do_objectID,
+                                    OVERRIDE, x + tx, y + ty, text_layer.frame, runs)
+        if layer.layers:
+            stack.extend((c, path, x, y) for c in reversed(layer.layers))
+
+
+def _overrides(nodes, shared: dict) -> list:
+    """
+    (relative path, x, y, text layer, string) of the text overrides below nodes, relative to their parent. The results
+    for shared nodes (the trees of masters without the overrides of the instance) are computed once.
+    """
+    ret = []
+    for node in nodes:
+        if node.shared and id(node) in shared:
+            ret.extend(shared[id(node)][1])
+            continue
+
+        layer = node.layer
+        own = []
+        if node.overrides and 'stringValue' in node.overrides and layer._class == 'text':
+            own.append(((layer.name,), layer.frame.x, layer.frame.y, layer, node.overrides['stringValue']))
+        for rel, x, y, text_layer, string in _overrides(node.children, shared):
+            own.append(((layer.name,) + rel, layer.frame.x + x, layer.frame.y + y, text_layer, string))
+        if node.shared:
+            shared[id(node)] = (node, own)
+        ret.extend(own)
+    return ret
+
+
+def _records(layer, string, page_name, artboard, path, instance_id, source, x, y, frame, runs):
+    attributes = layer.attributedString.attributes or []
+    if not runs or source == OVERRIDE:  # overrides replace the whole string, runs would not line up
+        font_name, font_size, color = _style(attributes[0] if attributes else None)
+        yield TextRecord(page_name, artboard, path, layer.do_objectID, instance_id, source, string, font_name,
+                         font_size, color, x, y, frame.width, frame.height, None)
+        return
+
+    units = None if string is None or string.isascii() else string.encode('utf-16-le')
+    for i, run in enumerate(attributes):
+        font_name, font_size, color = _style(run)
+        yield TextRecord(page_name, artboard, path, layer.do_objectID, instance_id, source,
+                         _run_text(string, units, run.location, run.length),
+                         font_name, font_size, color,
+                         x, y, frame.width, frame.height, i)
+
+
+def _run_text(string, units, location, length):
+    # run locations and lengths count utf-16 code units (NSString), characters outside the BMP take two
+    if units is None:
+        return None if string is None else string[location:location + length]
+    return units[2 * location:2 * (location + length)].decode('utf-16-le', errors='replace')
+
+
+def _style(run: 'sketch_types.MSStringAttribute'):
+    if run is None or run.attributes is None:
+        return None, None, None
+    font = run.attributes.MSAttributedStringFontAttribute
+    font_attributes = font.attributes if font is not None else None
+    return (getattr(font_attributes, 'name', None), getattr(font_attributes, 'size', None),
+            color_to_hex(run.attributes.MSAttributedStringColorAttribute))
+
+
+def color_to_hex(color: 'sketch_types.SJColorNoClass') -> Optional[str]:
+    if color is None:
+        return None
+    return '#' + ''.join('%02X' % round(max(0.0, min(1.0, c)) * 255)
+                         for c in (color.red, color.green, color.blue, color.alpha))
+
+
+def write_jsonl(records: Iterator[TextRecord], fp) -> int:
+    """Writes one json object per line to the text file fp, returns the number of records."""
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    n = 0
+    for record in records:
+        fp.write(encode(dict(zip(FIELDS, record))) + '\n')
+        n += 1
+    return n
+
+
+def write_csv(records: Iterator[TextRecord], fp, path_separator=' > ') -> int:
+    """Writes a header and one row per record to the text file fp (opened with newline=''), returns the number of
+    records."""
+    writer = csv.writer(fp)
+    writer.writerow(FIELDS)
+    n = 0
+    for record in records:
+        writer.writerow(record._replace(path=path_separator.join(record.path)))
+        n += 1
+    return n
+
+
+def extract_texts(file, fp, fmt='jsonl', **kwargs) -> int:
+    """Writes the records of iter_texts(file, **kwargs) to fp as 'jsonl' or 'csv'."""
+    if fmt == 'jsonl':
+        return write_jsonl(iter_texts(file, **kwargs), fp)
+    if fmt == 'csv':
+        return write_csv(iter_texts(file, **kwargs), fp)
+    raise ValueError('fmt has to be jsonl or csv, not %r' % fmt)
+
+
+def tokenize(string: str) -> List[str]:
+    """Case folded words of string."""
+    return _TOKEN.findall(string.casefold()) if string else []
+
+
+def ngrams(string: str) -> Set[str]:
+    """Case folded NGRAM character substrings of string."""
+    folded = string.casefold() if string else ''
+    return {folded[i:i + NGRAM] for i in range(len(folded) - NGRAM + 1)}
+
+
+class TextIndex:
+    """
+    Inverted index of the records of iter_texts(file) (without runs), by token, token prefix and substring (through
+    character n-grams). Updated incrementally by set_text, the override helpers, set_name, add_layer and remove_layer;
+    adding or removing pages, and changes inside symbol masters (which move the overrides of all their instances),
+    rebuild the index on the next search. Can be saved next to the file and loaded without reading its pages.
+    """
+
+    def __init__(self, file, build=True):
+        self._file = file
+        self._entries: List[Optional[tuple]] = []  # TextHit fields, None for removed entries
+        self._live = 0
+        self._by_object: Dict[str, Set[int]] = {}  # object_id -> entries of the text layer
+        self._by_instance: Dict[str, Set[int]] = {}  # instance_id -> override entries of the instance
+        self._tokens: Dict[str, Set[int]] = {}
+        self._grams: Dict[str, Set[int]] = {}
+        self._sorted_tokens = None
+        self._stale = build
+        sketch_types.add_mutation_listener(self, file)
+
+    def __len__(self):
+        self._sync()
+        return self._live
+
+    def search(self, query: str) -> List[TextHit]:
+        """Entries that contain all words of query."""
+        return self._hits(self._intersect(self._tokens, tokenize(query)))
+
+    def search_prefix(self, prefix: str) -> List[TextHit]:
+        """Entries with a word starting with prefix."""
+        self._sync()
+        prefix = prefix.casefold()
+        if self._sorted_tokens is None:
+            self._sorted_tokens = sorted(self._tokens)
+        tokens = self._sorted_tokens
+        found = set()
+        for i in range(bisect.bisect_left(tokens, prefix), len(tokens)):
+            if not tokens[i].startswith(prefix):
+                break
+            found |= self._tokens[tokens[i]]
+        return self._hits(found)
+
+    def search_substring(self, text: str) -> List[TextHit]:
+        """Entries whose string contains text, ignoring case."""
+        folded = text.casefold()
+        if len(folded) < NGRAM:
+            self._sync()
+            candidates = (i for i, e in enumerate(self._entries) if e is not None)
+        else:
+            candidates = self._intersect(self._grams, ngrams(folded))
+        return self._hits(i for i in candidates if folded in (self._entries[i][6] or '').casefold())
+
+    def rebuild(self):
+        for attr in (self._by_object, self._by_instance, self._tokens, self._grams):
+            attr.clear()
+        self._entries = []
+        self._live = 0
+        self._sorted_tokens = None
+        self._stale = False
+        for record in iter_texts(self._file):
+            self._insert(record)
+
+    def save(self, fn=None, source=None):
+        """
+        Writes the index to fn, by default next to source. source is the .sketch file the index is valid for, by
+        default the one the file was opened from (pass the new path after saving the file elsewhere).
+        """
+        self._sync()
+        source = source or self._file._path
+        if fn is None:
+            if not isinstance(source, str):
+                raise ValueError('the file was not opened from a path, source or fn is needed')
+            fn = source + INDEX_SUFFIX
+        data = {
+            'version': INDEX_VERSION,
+            'source': _fingerprint(source),
+            'entries': self._entries,
+        }
+        data.update({k: {t: sorted(ids) for t, ids in getattr(self, '_' + k).items()} for k in ('tokens', 'grams')})
+        with open(fn, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+
+    @staticmethod
+    def load(file, fn=None) -> Optional['TextIndex']:
+        """
+        The index saved to fn (by default next to the file), None if there is none or it was saved for a different
+        version of the file.
+        """
+        source = file._path
+        if fn is None:
+            fn = source + INDEX_SUFFIX
+        if not os.path.exists(fn):
+            return None
+        with open(fn, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != INDEX_VERSION or data.get('source') != _fingerprint(source):
+            return None
+
+        index = TextIndex(file, build=False)
+        for i, e in enumerate(data['entries']):
+            if e is None:
+                index._entries.append(None)
+                continue
+            e[2] = tuple(e[2])
+            index._entries.append(tuple(e))
+            index._live += 1
+            index._by_object.setdefault(e[3], set()).add(i)
+            if e[4] is not None:
+                index._by_instance.setdefault(e[4], set()).add(i)
+        index._tokens = {t: set(ids) for t, ids in data['tokens'].items()}
+        index._grams = {g: set(ids) for g, ids in data['grams'].items()}
+        return index
+
+    def on_mutation(self, event, obj, container, details):
+        if self._stale or event not in ('add', 'remove', 'rename', 'text', 'override'):
+            return
+        if container is self._file or getattr(obj, '_class', None) == 'page':
+            self._stale = True
+            return
+
+        doc = self._file.index
+        if event in ('add', 'remove'):
+            if container not in doc:  # i.e. a group that is not part of the file yet
+                return
+            parent, name = container, obj.name
+        else:
+            if obj not in doc:
+                return
+            parent, name = doc.parent_of(obj), details.get('old', obj.name)
+        if _in_master(doc, parent) or event != 'text' and sketch_index._contains_master(obj):
+            self._stale = True
+            return
+
+        page_name, artboard, path = self._location(doc, parent)
+        self._drop(page_name, path + (name,), obj)
+        if event != 'remove':
+            artboard = artboard or (obj.name if obj._class in sketch_index.ARTBOARD_CLASSES else None)
+            for record in _iter_layer(obj, page_name, artboard, path, 0, 0, self._file.overrides, False, {}):
+                self._insert(record)
+
+    def _sync(self):
+        if self._stale:
+            self.rebuild()
+
+    def _intersect(self, postings: Dict[str, Set[int]], keys) -> Set[int]:
+        self._sync()
+        keys = sorted(keys, key=lambda k: len(postings.get(k, ())))
+        if not keys:
+            return set()
+        ret = set(postings.get(keys[0], ()))
+        for k in keys[1:]:
+            if not ret:
+                break
+            ret &= postings.get(k, set())
+        return ret
+
+    def _hits(self, ids) -> List[TextHit]:
+        return [TextHit(*self._entries[i]) for i in sorted(ids)]
+
+    def _insert(self, record: TextRecord):
+        i = len(self._entries)
+        self._entries.append(record[:7])
+        self._live += 1
+        self._by_object.setdefault(record.object_id, set()).add(i)
+        if record.instance_id is not None:
+            self._by_instance.setdefault(record.instance_id, set()).add(i)
+        for token in set(tokenize(record.string)):
+            if token not in self._tokens:
+                self._tokens[token] = set()
+                self._sorted_tokens = None
+            self._tokens[token].add(i)
+        for gram in ngrams(record.string):
+            self._grams.setdefault(gram, set()).add(i)
+
+    def _drop(self, page_name, prefix, root):
+        # entries of the text layers and instances below root, at its place (a layer can be in a page more than once)
+        candidates = set()
+        stack = [root]
+        while stack:
+            layer = stack.pop()
+            if not hasattr(layer, '__dict__'):
+                continue
+            candidates |= self._by_object.get(layer.do_objectID, set())
+            candidates |= self._by_instance.get(layer.do_objectID, set())
+            stack.extend(layer.layers or [])
+
+        n = len(prefix)
+        for i in candidates:
+            e = self._entries[i]
+            if e is None or e[0] != page_name or e[2][:n] != prefix:
+                continue
+            self._entries[i] = None
+            self._live -= 1
+            _discard(self._by_object, e[3], i)
+            if e[4] is not None:
+                _discard(self._by_instance, e[4], i)
+            for token in set(tokenize(e[6])):
+                if _discard(self._tokens, token, i):
+                    self._sorted_tokens = None
+            for gram in ngrams(e[6]):
+                _discard(self._grams, gram, i)
+
+    @staticmethod
+    def _location(doc: sketch_index.DocumentIndex, parent):
+        """Page name, artboard name and layer path of parent (empty for pages)."""
+        path = []
+        page = doc.page_of(parent)
+        while parent is not page:
+            path.append(parent.name)
+            top, parent = parent, doc.parent_of(parent)
+        if not path:
+            return page.name, None, ()
+        artboard = top.name if top._class in sketch_index.ARTBOARD_CLASSES else None
+        return page.name, artboard, tuple(reversed(path))
+
+
+def _in_master(doc: sketch_index.DocumentIndex, layer) -> bool:
+    artboard = doc.artboard_of(layer)
+    return artboard is not None and artboard._class == 'symbolMaster'
+
+
+def _discard(postings: dict, key, i) -> bool:
+    """Removes i from postings[key], True if the key is gone."""
+    ids = postings.get(key)
+    if ids is None:
+        return False
+    ids.discard(i)
+    if not ids:
+        del postings[key]
+        return True
+    return False
+
+
+def _fingerprint(path) -> Optional[list]:
+    if path is None or not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
@@ -2,12 +2,16 @@ import base64
 import copy
 import math
 import secrets
+import weakref
 from enum import Enum
-from typing import NewType, Union, List, Dict
+from typing import NewType, Union, List, Dict, TYPE_CHECKING
 
 from biplist import readPlistFromString, writePlistToString
 
-from . import sketch_api
+from . import sketch_geometry
+
+if TYPE_CHECKING:  # sketch_api imports modules that need this one at import time
+    from . import sketch_api
 
 SJObjectId = NewType('SJObjectId', str)
 
@@ -22,6 +26,69 @@ def get_object_id():
     return '-'.join(o).upper()
 
 
+# id -> weak reference, held in dicts because the helpers iterate them and a WeakSet is slow to iterate
+_mutation_listeners: Dict[int, weakref.ref] = {}  # listeners of the mutations of all objects
+_mutation_owners: Dict[int, weakref.ref] = {}  # i.e. the open files
+_owned_listeners: Dict[int, Dict[int, weakref.ref]] = {}  # id(owner) -> listeners of the mutations of its objects
+
+# attributes that are caches or back references and not part of the file
+TRANSIENT_FIELDS = frozenset(('_raw', '_parent'))
+
+
+def add_mutation_listener(listener, owner=None):
+    """
+    Registers an object whose on_mutation(event, obj, container, details) is called by the mutation helpers, i.e.
+    ('add', layer, parent), ('remove', layer, parent), ('rename', layer, None, {'old': name}),
+    ('text', text layer, None, {'old': string}), ('override', instance) when overrides were added to a symbol
+    instance, ('change', obj) when a helper set fields of obj (i.e. the font of an attributed string) and
+    ('frames', None, page or None, {'layers': layers}) when a FrameStore wrote the frames of layers back. With owner (see add_mutation_owner), the listener only gets the mutations of the objects of owner.
+    Listeners are held weakly.
+    """
+    if owner is None:
+        _hold(_mutation_listeners, listener)
+    else:
+        _hold(_owned_listeners[id(owner)], listener)
+
+
+def remove_mutation_listener(listener):
+    _mutation_listeners.pop(id(listener), None)
+    for listeners in _owned_listeners.values():
+        listeners.pop(id(listener), None)
+
+
+def add_mutation_owner(owner):
+    """
+    Registers an object (a SketchFile) whose owns(obj) tells if obj is one of its objects. A mutation goes to the
+    listeners of the owners of its container (of the object without one), or of all owners if none claims it, i.e.
+    for layers that were never part of a file. Owners are held weakly.
+    """
+    key = id(owner)
+    _owned_listeners[key] = {}
+    _mutation_owners[key] = weakref.ref(owner, lambda _: (_mutation_owners.pop(key, None),
+                                                          _owned_listeners.pop(key, None)))
+
+
+def notify_mutation(event: str, obj, container=None, **details):
+    target = obj if container is None else container
+    owners = [(k, r()) for k, r in list(_mutation_owners.items())]
+    owners = [k for k, o in owners if o is not None and o.owns(target)] or [k for k, o in owners if o is not None]
+    for key in owners:
+        for listener in _alive(_owned_listeners.get(key, {})):
+            listener.on_mutation(event, obj, container, details)
+    if _mutation_listeners:
+        for listener in _alive(_mutation_listeners):
+            listener.on_mutation(event, obj, container, details)
+
+
+def _hold(refs: Dict[int, weakref.ref], obj):
+    key = id(obj)
+    refs[key] = weakref.ref(obj, lambda _: refs.pop(key, None))
+
+
+def _alive(refs: Dict[int, weakref.ref]) -> list:
+    return [o for o in [r() for r in list(refs.values())] if o is not None]
+
+
 class SJIDBase:
     def __init__(self):
         self.do_objectID: SJObjectId = None  # get_object_id()
@@ -525,9 +592,16 @@ class _SJLayerBase(SJIDBase):
             self.layers = []
 
         self.layers.append(r)
+        notify_mutation('add', r, self)
 
     def remove_layer(self, r):
         self.layers.remove(r)
+        notify_mutation('remove', r, self)
+
+    def set_name(self, name: str):
+        old = self.name
+        self.name = name
+        notify_mutation('rename', self, old=old)
 
     def get_layer_by_type(self, class_str):
         return [x for x in self.layers if x._class == class_str]
@@ -554,34 +628,13 @@ class SJSimpleGrid(SJIDBase):
 
 
 def find_layers(file, symbol: 'SJSymbolMaster', cls: str, images_to_copy=None) -> List[List[_SJLayerBase]]:
-    p = []
-
-    def search(layers, path):
-        opath = path.copy()
-        if layers is None:
-            return
-        for l in layers:
-            path = opath.copy()
-            path.append(l)
-            if hasattr(l, 'style') and l.style is not None and getattr(l.style, 'fills',
-                                                                       None) is not None and images_to_copy is not None:
-                for f in l.style.fills:
-                    if f.image is not None:
-                        # print('Adding image from fill')
-                        images_to_copy.add(f.image._ref)
-            if l._class == cls:
-                yield path
-            if l._class == 'symbolInstance':
-                sid = l.symbolID
-                new_reference = file.get_symbol_by_id(sid)
-                if new_reference is not None and new_reference.layers is not None:
-                    yield from search(new_reference.layers, path)
-            if hasattr(l, 'layers') and l.layers is not None and len(l.layers) > 0:
-                yield from search(l.layers, path)
-
+    """
+    Paths to all layers of class cls below symbol, following symbol instances into their masters. Image refs of fills
+    found on the way are added to images_to_copy. Expansions are cached per master in file.symbol_expansion.
+    """
     if symbol.layers is None:
         return
-    yield from search(symbol.layers, p)
+    yield from file.symbol_expansion.find(symbol, cls, images_to_copy)
 
 
 class SJSymbolMaster(_SJArtboardBase):
@@ -661,11 +714,16 @@ class SJSymbolInstanceLayer(_SJLayerBase):
         ov.overrideName = key
         ov.value = value
         self.overrideValues.append(ov)
+        notify_mutation('override', self)
 
     def add_text_override(self, target_text_ids: List[_SJLayerBase], new_text: str):
         target_text_ids = [t for t in target_text_ids if t._class in ['symbolInstance', 'text']]
         self.add_nested(target_text_ids, new_text, '_stringValue')
 
+    def resolve(self, file):
+        """The layers this instance shows, with its overrides applied (see sketch_overrides.OverrideResolver)."""
+        return file.overrides.resolve(self)
+
     def __init__(self):
         super().__init__()
         self._class: str = 'symbolInstance'
@@ -761,31 +819,14 @@ class SJTextLayer(_SJLayerBase):
         return self.attributedString.string
 
     def set_text(self, text: str):
+        old = self.attributedString.string
         self.attributedString.set_text(text)
+        notify_mutation('text', self, old=old)
 
 
 def group_coords(main_group, layer_list: List[_SJLayerBase]):
-    min_x = math.inf
-    min_y = math.inf
-    max_x = -math.inf
-    max_y = -math.inf
-
-    for l in layer_list:
-        x = l.frame.x
-        y = l.frame.y
-
-        if x < min_x:
-            min_x = x
-        if y < min_y:
-            min_y = y
-
-        x += l.frame.width
-        y += l.frame.height
-
-        if x > max_x:
-            max_x = x
-        if y > max_y:
-            max_y = y
+    frames = sketch_geometry.FrameStore(layer_list)
+    min_x, min_y, max_x, max_y = frames.bounds()
 
     main_group.frame = SJRect()
     main_group.frame.x = min_x
@@ -794,14 +835,14 @@ def group_coords(main_group, layer_list: List[_SJLayerBase]):
     main_group.frame.height = max_y - min_y
     main_group.layers = []
 
-    for l in layer_list:
-        l.frame.x -= min_x
-        l.frame.y -= min_y
+    frames.translate(-min_x, -min_y)
 
+    for l in layer_list:
         if main_group.layers is None:
             main_group.layers = []
 
         main_group.layers.append(l)
+        notify_mutation('add', l, main_group)
 
     # sketch_api._link_to_parent(main_group.layers, main_group)
 
@@ -1069,6 +1110,7 @@ class KeyValueArchive:
         dt = writePlistToString(archive)
         bstr = base64.b64encode(dt)
         self._archive = bstr
+        notify_mutation('change', self)
 
     def get_val(self, val: int):
         return self.get_archive()['$objects'][val]
@@ -1248,12 +1290,14 @@ class MSAttributedString:
     def set_text(self, text: str):
         self.string = text
         self.attributes[0].length = len(self.string)
+        notify_mutation('change', self)
 
     def set_font(self, font_family: str, font_size: float = 12):
         fD = SJFontDescriptor()
         fD.attributes.name = font_family
         fD.attributes.size = font_size
         self.attributes[0].attributes.MSAttributedStringFontAttribute = fD
+        notify_mutation('change', self)
 
     def get_font(self):
         return self.attributes[0].attributes.MSAttributedStringFontAttribute if len(self.attributes) > 0 else None
@@ -1263,6 +1307,7 @@ class MSAttributedString:
 
     def set_color(self, color: SJColor):
         self.attributes[0].attributes.MSAttributedStringColorAttribute = color
+        notify_mutation('change', self)
 
     def get_alignment(self):
         ps = self.attributes[0].attributes.paragraphStyle
@@ -1272,6 +1317,7 @@ class MSAttributedString:
         s = SJParagraphStyle()
         s.alignment = align
         self.attributes[0].attributes.paragraphStyle = s
+        notify_mutation('change', self)
 
 
 class MSJSONFileReference:
@@ -1386,6 +1432,7 @@ class SketchPage(_SJLayerBase):
             self.layers = []
 
         self.layers.append(artboard)
+        notify_mutation('add', artboard, self)
         x = self._parent.sketch_meta.pagesAndArtboards[self.do_objectID]
         m = SJArtboardDescription()
         m.name = artboard.name
@@ -1395,6 +1442,7 @@ class SketchPage(_SJLayerBase):
 
     def remove_artboard(self, artboard: SJArtboardLayer):
         self.layers.remove(artboard)
+        notify_mutation('remove', artboard, self)
         del self._parent.sketch_meta.pagesAndArtboards[self.do_objectID].artboards[artboard.do_objectID]
 
 
@@ -0,0 +1,446 @@
+"""
+Writing zip archives entry by entry: copying entries of another archive as the bytes they are stored as, without
+inflating and deflating them again, writing entries with a compression policy and deflating blocks of large entries in
+a thread pool. Reading single entries of a memory-mapped archive.
+"""
+import io
+import mmap
+import os
+import shutil
+import struct
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import Executor
+from typing import Dict, List
+
+_LOCAL_HEADER = struct.Struct(zipfile.structFileHeader)
+_CENTRAL_DIRECTORY = struct.Struct(zipfile.structCentralDir)
+_END_RECORD = struct.Struct(zipfile.structEndArchive)
+_DESCRIPTOR = struct.Struct('<4L')
+_DESCRIPTOR_SIGNATURE = 0x08074b50
+_NAME_LENGTH = 10  # fields of the local file header, as zipfile._FH_FILENAME_LENGTH and _FH_EXTRA_FIELD_LENGTH
+_EXTRA_LENGTH = 11
+_DATA_DESCRIPTOR = 0x08
+_UTF8_NAME = 0x800
+_CHUNK = 1 << 20
+_BLOCK = 1 << 18  # bytes of an entry deflated by one task
+_WINDOW = 1 << 15  # the preset dictionary of a block is the end of the block before it, as far as deflate looks back
+
+# policy -> (compress_type, compresslevel)
+COMPRESSION = {
+    'store': (zipfile.ZIP_STORED, None),
+    'fast': (zipfile.ZIP_DEFLATED, 1),
+    'default': (zipfile.ZIP_DEFLATED, None),
+    'best': (zipfile.ZIP_DEFLATED, 9),
+}
+
+
+class ArchiveWriter:
+    """
+    Writes a zip archive to a path or a writable file object, one entry at a time: new entries are compressed while
+    they are written (see open), entries of another archive can be copied as the bytes they are stored as (see copy).
+    The central directory is written on close. Local headers get the sizes and CRC of the entry, written ahead for
+    copies and patched after the data if the target can seek, followed by a data descriptor otherwise. Archives
+    beyond the limits of zip (4 GB, 65535 entries) are not supported, zip64 is not written.
+    """
+
+    def __init__(self, target):
+        self._own = isinstance(target, (str, bytes, os.PathLike))
+        self.fp = open(target, 'wb') if self._own else target
+        try:
+            self._start = self.fp.tell()
+            self._seekable = True
+        except (AttributeError, OSError):
+            self._start = None
+            self._seekable = False
+        self._written = 0  # bytes written since _start, the offset of the next header
+        self._writing = False
+        self.filelist: List[zipfile.ZipInfo] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self, info: zipfile.ZipInfo, level=None, pool: Executor = None, workers=1) -> io.BufferedIOBase:
+        """
+        A stream writing the new entry info, stored or deflated at level as its compress_type says. With a pool of
+        workers threads, deflated entries are compressed in blocks by them (zlib releases the GIL) while the caller
+        produces the next data.
+        """
+        _check_method(info)
+        if info.compress_type == zipfile.ZIP_STORED:
+            compressor = None
+        elif pool is not None:
+            compressor = ParallelDeflate(pool, level, workers)
+        else:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED,
+                                          -zlib.MAX_WBITS)
+        info.CRC = info.compress_size = info.file_size = 0
+        if not self._seekable:
+            info.flag_bits |= _DATA_DESCRIPTOR
+        self._begin(info)
+        return _EntryWriter(self, info, compressor)
+
+    def copy(self, source: 'MappedArchive', name: str):
+        """Adds the entry name of source as it is stored there, with its CRC, sizes, date and attributes."""
+        stored = source.getinfo(name)
+        info = zipfile.ZipInfo(stored.filename, stored.date_time)
+        for field in ('compress_type', 'comment', 'create_system', 'external_attr', 'CRC', 'compress_size',
+                      'file_size'):
+            setattr(info, field, getattr(stored, field))
+        info.flag_bits = stored.flag_bits & ~_DATA_DESCRIPTOR  # the sizes are known and written to the local header
+        self._begin(info)
+        with source.view(name) as data:
+            for i in range(0, len(data), _CHUNK):
+                self._write(data[i:i + _CHUNK])
+        self._finish(info, patch=False)
+
+    def close(self):
+        if self.fp is None:
+            return
+        if self._writing:
+            raise ValueError("Can't close the ZIP file while there is an open writing handle on it.")
+        try:
+            if len(self.filelist) > 0xFFFF or self._written > zipfile.ZIP64_LIMIT:
+                raise zipfile.LargeZipFile('Archives beyond 4 GB or 65535 entries (zip64) are not supported')
+            offset = self._written
+            for info in self.filelist:
+                name, flags = _encoded_name(info)
+                self._write(_CENTRAL_DIRECTORY.pack(
+                    zipfile.stringCentralDir, info.create_version, info.create_system, _extract_version(info), 0,
+                    flags, info.compress_type, *_dos_time(info), info.CRC, info.compress_size, info.file_size,
+                    len(name), 0, len(info.comment), 0, info.internal_attr, info.external_attr, info.header_offset))
+                self._write(name)
+                self._write(info.comment)
+            size = self._written - offset
+            self._write(_END_RECORD.pack(zipfile.stringEndArchive, 0, 0, len(self.filelist), len(self.filelist),
+                                         size, offset, 0))
+            self.fp.flush()
+        finally:
+            fp, self.fp = self.fp, None
+            if self._own:
+                fp.close()
+
+    def _begin(self, info: zipfile.ZipInfo):
+        if self.fp is None:
+            raise ValueError('Attempt to write to ZIP archive that was already closed')
+        if self._writing:
+            raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+        if self._written > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('Archives beyond 4 GB (zip64) are not supported')
+        info.header_offset = self._written
+        self._writing = True
+        self._write(self._local_header(info))
+
+    def _finish(self, info: zipfile.ZipInfo, patch=True):
+        self._writing = False
+        if info.compress_size > zipfile.ZIP64_LIMIT or info.file_size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('Entries beyond 4 GB (zip64) are not supported: %s' % info.filename)
+        if info.flag_bits & _DATA_DESCRIPTOR:
+            self._write(_DESCRIPTOR.pack(_DESCRIPTOR_SIGNATURE, info.CRC, info.compress_size, info.file_size))
+        elif patch:
+            end = self.fp.tell()
+            self.fp.seek(self._start + info.header_offset)
+            self.fp.write(self._local_header(info))
+            self.fp.seek(end)
+        self.filelist.append(info)
+
+    def _write(self, data):
+        self.fp.write(data)
+        self._written += len(data)
+
+    @staticmethod
+    def _local_header(info: zipfile.ZipInfo) -> bytes:
+        name, flags = _encoded_name(info)
+        return _LOCAL_HEADER.pack(zipfile.stringFileHeader, _extract_version(info), 0, flags, info.compress_type,
+                                  *_dos_time(info), info.CRC, info.compress_size, info.file_size, len(name),
+                                  0) + name
+
+
+class _EntryWriter(io.BufferedIOBase):
+    """The content of a new entry, compressed, counted and checksummed on its way to the archive."""
+
+    def __init__(self, archive: ArchiveWriter, info: zipfile.ZipInfo, compressor):
+        self._archive = archive
+        self._info = info
+        self._compressor = compressor
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        with memoryview(data) as view:
+            n = view.nbytes
+        self._info.file_size += n
+        self._info.CRC = zlib.crc32(data, self._info.CRC)
+        self._emit(self._compressor.compress(data) if self._compressor is not None else data)
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._compressor is not None:
+                self._emit(self._compressor.flush())
+        finally:
+            super().close()
+            self._archive._finish(self._info)
+
+    def _emit(self, data):
+        self._info.compress_size += len(data)
+        self._archive._write(data)
+
+
+def copy_entry(src: 'MappedArchive', name: str, dst: ArchiveWriter, policy='default', pool: Executor = None,
+               workers=1):
+    """
+    Copies the entry name of src to dst as it is stored if policy is 'default' or if it is stored or deflated as
+    policy says (at whatever level), decompresses and compresses it again otherwise.
+    """
+    source = src.getinfo(name)
+    if policy == 'default' or source.compress_type == entry_info(name, policy).compress_type:
+        dst.copy(src, name)
+        return
+    with src.open(name) as fp, open_entry(dst, name, policy, pool, source.date_time, workers) as out:
+        shutil.copyfileobj(fp, out, _CHUNK)
+
+
+def entry_info(name: str, policy='default', date_time=None) -> zipfile.ZipInfo:
+    """A new entry compressed as policy says, with the date and permissions ZipFile.writestr gives a name."""
+    if policy not in COMPRESSION:
+        raise ValueError('compression has to be one of %s, not %r' % (', '.join(COMPRESSION), policy))
+    info = zipfile.ZipInfo(name, date_time or time.localtime(time.time())[:6])
+    info.compress_type = COMPRESSION[policy][0]
+    info.external_attr = 0o600 << 16
+    return info
+
+
+def open_entry(dst: ArchiveWriter, name: str, policy='default', pool: Executor = None, date_time=None, workers=1):
+    """Opens the new entry name of dst for writing, compressed as policy says (see ArchiveWriter.open)."""
+    return dst.open(entry_info(name, policy, date_time), COMPRESSION[policy][1], pool, workers)
+
+
+class ParallelDeflate:
+    """
+    Compressor with the interface of zlib.compressobj that deflates blocks of the data in a pool, each block
+    primed with the end of the one before it. The blocks end on a byte boundary (Z_SYNC_FLUSH) and the last one
+    finishes the stream, so their concatenation is one deflate stream. Results are returned in order, at most
+    two blocks per worker of the pool are held at a time.
+    """
+
+    def __init__(self, pool: Executor, level=None, workers=1):
+        self._pool = pool
+        self._level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+        self._limit = 2 * max(1, workers)
+        self._buffer = bytearray()
+        self._previous = b''
+        self._pending = deque()
+
+    def compress(self, data) -> bytes:
+        self._buffer += data
+        while len(self._buffer) >= _BLOCK:
+            self._submit(bytes(self._buffer[:_BLOCK]), zlib.Z_SYNC_FLUSH)
+            del self._buffer[:_BLOCK]
+        done = []
+        while self._pending and (self._pending[0].done() or len(self._pending) > self._limit):
+            done.append(self._pending.popleft().result())
+        return b''.join(done)
+
+    def flush(self) -> bytes:
+        self._submit(bytes(self._buffer), zlib.Z_FINISH)
+        self._buffer = bytearray()
+        done = [f.result() for f in self._pending]
+        self._pending.clear()
+        return b''.join(done)
+
+    def _submit(self, block: bytes, mode):
+        self._pending.append(self._pool.submit(_deflate, block, self._previous, self._level, mode))
+        self._previous = block[-_WINDOW:]
+
+
+def _deflate(block: bytes, zdict: bytes, level: int, mode) -> bytes:
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return c.compress(block) + c.flush(mode)
+
+
+class MappedArchive:
+    """
+    A zip archive (a path or a file object) read through a memory map. Only the central directory is read when it is
+    opened, an entry is only touched when it is read: view returns the stored bytes without copying them (the content
+    of stored entries), open streams the content and inflates deflated entries as it is read. Views have to be
+    released before the archive is closed, or the map stays open until they are.
+    """
+
+    def __init__(self, source):
+        if isinstance(source, (str, bytes, os.PathLike)):
+            with open(source, 'rb') as fp:
+                self._infos = _read_directory(fp)
+                self._buffer = _map(fp)
+        else:
+            self._infos = _read_directory(source)
+            if hasattr(source, 'getbuffer'):
+                self._buffer = source.getbuffer()  # i.e. BytesIO, released by close
+            else:
+                try:
+                    self._buffer = _map(source)
+                except (AttributeError, OSError):
+                    source.seek(0)
+                    self._buffer = memoryview(source.read())
+        self._offsets: Dict[str, int] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self._infos
+
+    def close(self):
+        buffer, self._buffer = self._buffer, None
+        if buffer is None:
+            return
+        obj = buffer.obj
+        buffer.release()
+        if isinstance(obj, mmap.mmap):
+            try:
+                obj.close()
+            except BufferError:
+                pass  # unmapped when the last view is released
+
+    def infolist(self) -> List[zipfile.ZipInfo]:
+        return list(self._infos.values())
+
+    def namelist(self) -> List[str]:
+        return list(self._infos)
+
+    def getinfo(self, name: str) -> zipfile.ZipInfo:
+        try:
+            return self._infos[name]
+        except KeyError:
+            raise KeyError('There is no item named %r in the archive' % name) from None
+
+    def view(self, name: str) -> memoryview:
+        """The bytes name is stored as, its content if it is stored uncompressed."""
+        info = self.getinfo(name)
+        if info.flag_bits & 0x1:
+            raise RuntimeError('File %r is encrypted, password required for extraction' % name)
+        if self._buffer is None:
+            raise ValueError('Attempt to use ZIP archive that was already closed')
+        start = self._offsets.get(name)
+        if start is None:
+            start = self._offsets[name] = self._data_offset(info)
+        return self._buffer[start:start + info.compress_size]
+
+    def read(self, name: str) -> bytes:
+        info = self.getinfo(name)
+        _check_method(info)
+        with self.view(name) as data:
+            if info.compress_type == zipfile.ZIP_STORED:
+                content = bytes(data)
+            else:
+                content = zlib.decompress(data, -zlib.MAX_WBITS, max(info.file_size, 1))
+        if zlib.crc32(content) != info.CRC:
+            raise zipfile.BadZipFile('Bad CRC-32 for file %r' % name)
+        return content
+
+    def open(self, name: str) -> io.BufferedReader:
+        """A stream of the content of name, inflated in chunks while it is read."""
+        info = self.getinfo(name)
+        _check_method(info)
+        return io.BufferedReader(_EntryStream(info, self.view(name)), _CHUNK)
+
+    def _data_offset(self, info: zipfile.ZipInfo) -> int:
+        header = _LOCAL_HEADER.unpack_from(self._buffer, info.header_offset)
+        if header[0] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile('Bad magic number for file header of %s' % info.filename)
+        return info.header_offset + _LOCAL_HEADER.size + header[_NAME_LENGTH] + header[_EXTRA_LENGTH]
+
+
+class _EntryStream(io.RawIOBase):
+    """The content of an entry read from its stored bytes, checked against the CRC of the entry at the end."""
+
+    def __init__(self, info: zipfile.ZipInfo, data: memoryview):
+        self._info = info
+        self._data = data
+        self._pos = 0
+        self._crc = 0
+        self._left = info.file_size
+        self._inflate = zlib.decompressobj(-zlib.MAX_WBITS) if info.compress_type == zipfile.ZIP_DEFLATED else None
+        self._tail = b''  # input the decompressor did not consume yet
+
+    def readable(self):
+        return True
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self._left)
+        if n <= 0:
+            return 0
+        if self._inflate is None:
+            chunk = self._data[self._pos:self._pos + n]
+            self._pos += n
+        else:
+            chunk = b''
+            while not chunk:
+                if not self._tail:
+                    self._tail = self._data[self._pos:self._pos + _CHUNK]
+                    self._pos += len(self._tail)
+                    if not self._tail:
+                        raise zipfile.BadZipFile('Truncated entry %s' % self._info.filename)
+                chunk = self._inflate.decompress(self._tail, n)
+                self._tail = self._inflate.unconsumed_tail
+            n = len(chunk)
+        b[:n] = chunk
+        self._crc = zlib.crc32(chunk, self._crc)
+        self._left -= n
+        if self._left == 0 and self._crc != self._info.CRC:
+            raise zipfile.BadZipFile('Bad CRC-32 for file %r' % self._info.filename)
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._data.release()
+        super().close()
+
+
+def _check_method(info: zipfile.ZipInfo):
+    if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        raise NotImplementedError('compression method %d of %s is not supported' % (info.compress_type, info.filename))
+
+
+def _encoded_name(info: zipfile.ZipInfo):
+    try:
+        return info.filename.encode('ascii'), info.flag_bits & ~_UTF8_NAME
+    except UnicodeEncodeError:
+        return info.filename.encode('utf-8'), info.flag_bits | _UTF8_NAME
+
+
+def _extract_version(info: zipfile.ZipInfo) -> int:
+    return max(info.extract_version, 20 if info.compress_type == zipfile.ZIP_DEFLATED else 10)
+
+
+def _dos_time(info: zipfile.ZipInfo):
+    year, month, day, hour, minute, second = info.date_time
+    return hour << 11 | minute << 5 | second // 2, (year - 1980) << 9 | month << 5 | day
+
+
+def _read_directory(fp) -> Dict[str, zipfile.ZipInfo]:
+    # ZipFile reads the central directory only, the entries are read through the map
+    with zipfile.ZipFile(fp, mode='r') as zf:
+        return {info.filename: info for info in zf.infolist()}
+
+
+def _map(fp) -> memoryview:
+    if os.fstat(fp.fileno()).st_size == 0:
+        raise zipfile.BadZipFile('File is not a zip file')
+    return memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))